@@ -0,0 +1,438 @@
+#! python3
+# encoding: utf-8
+
+# 処理の段階ごとの所要時間とメモリ使用量を測るベンチマーク。
+# dataset フォルダと同じ形式の台本 (と教師ラベル) を乱数で作り、作業フォルダの中で
+# 形態素解析、特徴量抽出 (特徴量ごとの内訳も)、学習用データの作成、データセットの読み込み、
+# 学習、予測のそれぞれを測る。ネットワークには接続しない。
+# --save-baseline で結果を JSON に保存し、--baseline で保存した結果と比べる。
+# 基準より遅くなった段階があれば、終了コード 1 で終わる。
+# 新しいプロセスで import psclib.psc にかかる時間 (import_psc) が --import-budget を超えた場合も、
+# 終了コード 1 で終わる。
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import psclib.psc as psc
+from psclib.extract import Extractor
+from psclib.npmodel import NumpyPscModel
+import psc_maketrain
+
+
+# 新しいプロセスで import psclib.psc にかかる時間の上限 (ミリ秒)
+IMPORT_BUDGET_MS = 150
+
+# 台本を作るための語彙
+_names = ['永子', 'しの', '課長', '光子', '本田', '御堂', '女１', '男２']
+_phrases = [
+    'あ、', 'えっと', 'もしもし。', 'はい。', 'そうですか。', '電話', 'が鳴る。', '机の上に',
+    'ホワイトボード', 'を見る。', 'お願いします。', 'ていうか', '･･･', '何？　', '分かった。',
+    'インターネット', 'で検索して', '頂いて、', 'ね。', 'じゃあ、', '座っている。', '現れる。',
+    '気配', 'を消す。', 'さっき', '何て言ったっけ', '『マイナス30才肌』', 'サポート部', 'です。'
+]
+
+
+def make_line(rng, n_words):
+    """
+    乱数で、語句を n_words 個つなげた文を作る
+    """
+    return ''.join(rng.choice(_phrases) for _ in range(n_words))
+
+
+def make_script(rng, n_lines):
+    """
+    乱数で、n_lines 行の台本を作る
+
+    Returns
+    -------
+    lines : list
+        行 (str) のリスト
+    labels : list
+        各行のラベル (str) のリスト
+    """
+    rows = [
+        ('TITLE', make_line(rng, 2)),
+        ('EMPTY', ''),
+        ('AUTHOR', '　' * 18 + rng.choice(_names)),
+        ('EMPTY', ''),
+        ('CHARSHEADLINE', '　登場人物'),
+        ('EMPTY', '')
+    ]
+    rows.extend(('CHARACTER', name + '　　') for name in _names)
+    scene = 0
+    while len(rows) < n_lines - 1:
+        rows.append(('EMPTY', ''))
+        kind = rng.random()
+        if kind < 0.05:
+            scene += 1
+            rows.append(('H1', 'シーン{}'.format(scene)))
+        elif kind < 0.35:
+            for i in range(rng.randint(1, 4)):
+                label = 'DIRECTION' if i == 0 else 'DIRECTION_CONTINUED'
+                rows.append((label, '　　' + make_line(rng, rng.randint(2, 6))))
+        else:
+            for _ in range(rng.randint(1, 8)):
+                name = rng.choice(_names)
+                rows.append(('DIALOGUE', '{}　　　「{}」'.format(
+                    name, make_line(rng, rng.randint(1, 8)))))
+                if rng.random() < 0.2:
+                    rows.append(('DIALOGUE_CONTINUED', '　' * 6 + make_line(rng, 3) + '」'))
+    rows = rows[:n_lines - 1]
+    rows.append(('ENDMARK', '　' * 10 + '終わり'))
+    return [x[1] for x in rows], [x[0] for x in rows]
+
+
+def make_workdir(work_dir, n_scripts, n_lines, seed, fts_file=None):
+    """
+    作業フォルダに、台本と教師ラベル、ベンチマーク用のモデルフォルダを作る
+
+    台本の 8 割を学習用、残りを評価用とする。CSV の読み込みを測るために、
+    特徴量ストアを作らないモデルフォルダ (bench_csv) も作る。
+
+    Returns
+    -------
+    filenames : list
+        台本のファイル名 (拡張子なし) のリスト
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(work_dir, 'dataset'), exist_ok=True)
+    filenames = []
+    for i in range(n_scripts):
+        fn = '{:0>6}'.format(i + 1)
+        lines, labels = make_script(rng, n_lines)
+        with open(os.path.join(work_dir, 'dataset', fn + '.txt'), 'w', encoding='utf-8') as f:
+            f.writelines(line + '\n' for line in lines)
+        with open(os.path.join(work_dir, 'dataset', fn + '_lbl.txt'), 'w', encoding='utf-8') as f:
+            f.writelines(label + '\n' for label in labels)
+        filenames.append(fn)
+
+    n_train = max(1, int(n_scripts * 0.8))
+    for model_name in ['bench', 'bench_csv']:
+        model_dir = os.path.join(work_dir, 'models', model_name)
+        os.makedirs(model_dir, exist_ok=True)
+        if fts_file is not None:
+            shutil.copyfile(fts_file, os.path.join(model_dir, 'mdl_fts.txt'))
+        else:
+            with open(os.path.join(model_dir, 'mdl_fts.txt'), 'w', encoding='utf-8') as f:
+                f.writelines(ft + '\n' for ft in psc.features)
+        for list_type, names in [('train', filenames[:n_train]), ('eval', filenames[n_train:])]:
+            os.makedirs(os.path.join(model_dir, list_type), exist_ok=True)
+            with open(os.path.join(model_dir, 'ds_{}_list.txt'.format(list_type)), 'w') as f:
+                f.writelines(str(int(fn)) + '\n' for fn in names)
+    return filenames
+
+
+class Bench:
+    """
+    段階ごとの所要時間とメモリ使用量を測って記録するクラス
+    """
+
+    def __init__(self, repeat=3, memory=True):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        repeat : int
+            時間を測る回数 (最も短いものを記録する)
+        memory : bool
+            メモリ使用量も測るか
+        """
+        self.repeat = repeat
+        self.memory = memory
+        self.results = {}
+
+    def run(self, stage, func, lines=None):
+        """
+        func を実行して所要時間を測り、stage の結果として記録するメソッド
+
+        時間は tracemalloc を止めた状態で repeat 回測り、最も短いものを記録する。
+        その後、もう一度 tracemalloc を動かして実行し、メモリ使用量のピークを記録する。
+
+        Parameters
+        ----------
+        stage : str
+            段階の名前
+        func : function
+            引数なしで呼び出す関数
+        lines : int
+            処理した行数 (1行あたりの時間を計算するため)
+
+        Returns
+        -------
+        result : object
+            最後に実行した func の返り値
+        """
+        times = []
+        for _ in range(self.repeat):
+            t0 = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - t0)
+
+        entry = {'seconds': min(times)}
+        if lines:
+            entry['lines'] = lines
+            entry['us_per_line'] = min(times) / lines * 1e6
+        if self.memory:
+            tracemalloc.start()
+            result = func()
+            entry['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.results[stage] = entry
+        return result
+
+    def run_startup(self, stage, code):
+        """
+        新しい Python のプロセスで code を実行する時間を測り、stage の結果として記録するメソッド
+
+        何もしないプロセスの起動時間を引いたものを記録する (メモリ使用量は測らない)。
+        時間は repeat 回測り、最も短いものを記録する。
+        """
+        # psclib を読み込めるように、このファイルのあるフォルダを PYTHONPATH に加える。
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(__file__))] + env.get('PYTHONPATH', '').split(os.pathsep))
+
+        def run(code):
+            times = []
+            for _ in range(self.repeat):
+                t0 = time.perf_counter()
+                subprocess.run([sys.executable, '-c', code], env=env, check=True)
+                times.append(time.perf_counter() - t0)
+            return min(times)
+
+        self.results[stage] = {'seconds': max(0., run(code) - run('pass'))}
+
+
+def run_benchmarks(bench, filenames, epochs=2, skip_train=False):
+    """
+    作業フォルダ (カレントディレクトリ) で、各段階のベンチマークを実行する
+    """
+    ftels = psc.read_feature_elements('models/bench/mdl_fts.txt')
+
+    # 起動時間 (読み込みと Tokenizer の準備)
+    bench.run_startup('import_psc', 'import psclib.psc')
+    bench.run_startup('tokenizer_init', 'import psclib.psc; psclib.psc.get_tokenizer()')
+
+    scripts = []
+    for fn in filenames:
+        with open('dataset/{}.txt'.format(fn), 'r', encoding='utf_8_sig') as f:
+            scripts.append([l.rstrip() for l in f.readlines()])
+    n_lines = sum(len(lines) for lines in scripts)
+
+    # 形態素解析
+    token_lines = bench.run('tokenize',
+        lambda: [psc.tokenize_lines(lines) for lines in scripts], n_lines)
+
+    # 特徴量抽出 (全特徴量をまとめて、行ごとの計算と列ごとの計算のそれぞれ)
+    bench.run('extract_lines',
+        lambda: [Extractor(tl, ftels).extract() for tl in token_lines], n_lines)
+    bench.run('extract_array',
+        lambda: [Extractor(tl, ftels).extract_array() for tl in token_lines], n_lines)
+
+    # 特徴量ごとの内訳 (共通の前処理も含めて、特徴量ごとに別の Extractor で測る)
+    for ftel in ftels:
+        bench.run('feature:' + ftel[0],
+            lambda: [Extractor(tl, [ftel]).extract_array() for tl in token_lines], n_lines)
+
+    # 学習用データの作成 (psc_maketrain.py と同じ処理)
+    def maketrain(model_name, write_csv):
+        psc_maketrain.init_worker('models/{}/mdl_fts.txt'.format(model_name),
+            'models/{}/ft_cache'.format(model_name), force=True, write_csv=write_csv)
+        for list_type in ['train', 'eval']:
+            dest_dir = 'models/{}/{}'.format(model_name, list_type)
+            with open('models/{}/ds_{}_list.txt'.format(model_name, list_type)) as f:
+                names = ['{:0>6}'.format(int(x)) for x in f]
+            for fn in names:
+                psc_maketrain.make_files((fn, dest_dir))
+            # ("... created." の表示は省く)
+            with redirect_stdout(io.StringIO()):
+                psc_maketrain.make_store(dest_dir, names)
+        shutil.rmtree('models/{}/ft_cache'.format(model_name))
+
+    bench.run('maketrain', lambda: maketrain('bench', False), n_lines)
+
+    # CSV だけのモデルフォルダを作る (時間は測らない)
+    maketrain('bench_csv', True)
+    for list_type in ['train', 'eval']:
+        dest_dir = 'models/bench_csv/{}'.format(list_type)
+        for name in os.listdir(dest_dir):
+            if name.endswith('.npy') or name == 'store_index.txt':
+                os.remove(os.path.join(dest_dir, name))
+
+    # データセットの読み込み (特徴量ストアと CSV)
+    def load(model_name):
+        ds = psc.make_dataset(model_name, 'train', as_array=True)
+        # メモリマップの場合も、実際に読み込ませる
+        return psc.ArrayDataset(np.array(ds.features), np.array(ds.labels))
+
+    ds_train = bench.run('load_store', lambda: load('bench'))
+    bench.run('load_csv', lambda: load('bench_csv'), len(ds_train))
+
+    # 予測 (NumPy だけで、乱数の重みで順伝播する)
+    rng = np.random.RandomState(0)
+    in_dim, hid_dim, out_dim = ds_train.features.shape[1], 20, len(psc.classes)
+    model = NumpyPscModel({
+        'l1_W': rng.randn(hid_dim, in_dim), 'l1_b': np.zeros(hid_dim),
+        'l2_W': rng.randn(hid_dim, hid_dim), 'l2_b': np.zeros(hid_dim),
+        'l3_W': rng.randn(out_dim, hid_dim), 'l3_b': np.zeros(out_dim)
+    })
+    bench.run('predict_numpy', lambda: model.predict(ds_train.features), len(ds_train))
+
+    # 学習 (Chainer がなければ省略する)
+    if skip_train:
+        return
+    try:
+        from chainer import optimizers
+        from psclib.chain import PscChain
+    except ImportError:
+        print('Chainer is not available. Skipped training.')
+        return
+
+    def train():
+        chain = PscChain(hid_dim, out_dim)
+        optimizer = optimizers.SGD(lr=0.01).setup(chain)
+        chain.train(dataset=ds_train, batch_size=100, max_epoch=epochs,
+            optimizer=optimizer, gpu_id=-1, verbose=False)
+
+    bench.run('train', train, len(ds_train) * epochs)
+
+
+def compare(results, baseline, tolerance, min_diff=0.001):
+    """
+    ベースラインと比べて、段階ごとの比 (今回 / ベースライン) を表示する
+
+    差が min_diff 秒に満たない段階は、測定のばらつきとみなして遅くなったとは判定しない。
+
+    Returns
+    -------
+    regressions : list
+        ベースラインより tolerance を超えて遅くなった段階の名前のリスト
+    """
+    regressions = []
+    print('{:<40} {:>10} {:>10} {:>7}'.format('stage', 'base_ms', 'now_ms', 'ratio'))
+    for stage, entry in results['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None:
+            continue
+        ratio = entry['seconds'] / base['seconds'] if base['seconds'] > 0 else float('inf')
+        mark = ''
+        if ratio > 1 + tolerance and entry['seconds'] - base['seconds'] >= min_diff:
+            regressions.append(stage)
+            mark = ' SLOWER'
+        print('{:<40} {:>10.2f} {:>10.2f} {:>7.2f}{}'.format(
+            stage, base['seconds'] * 1000, entry['seconds'] * 1000, ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='python psc_bench.py [--scripts N] [--lines N] [--save-baseline FILE] [--baseline FILE]')
+    parser.add_argument('--scripts', type=int, default=10,
+        help='number of synthetic scripts (default: 10)')
+    parser.add_argument('--lines', type=int, default=1000,
+        help='number of lines per script (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed for the synthetic scripts (default: 0)')
+    parser.add_argument('--fts', help='feature setting file (default: all features)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of timed runs per stage; the fastest is recorded (default: 3)')
+    parser.add_argument('--epochs', type=int, default=2,
+        help='number of epochs for the training stage (default: 2)')
+    parser.add_argument('--no-train', action='store_true', help='skip the training stage')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory')
+    parser.add_argument('--work-dir',
+        help='directory for the synthetic dataset (default: a temporary directory)')
+    parser.add_argument('--save-baseline', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='allowed slowdown against the baseline (default: 0.2 = 20%%)')
+    parser.add_argument('--min-diff', type=float, default=1.,
+        help='ignore slowdowns smaller than this, in ms (default: 1)')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_MS,
+        help='max time for importing psclib.psc in a new process, in ms (default: {})'.format(
+            IMPORT_BUDGET_MS))
+    args = parser.parse_args()
+
+    fts_file = os.path.abspath(args.fts) if args.fts else None
+    baseline_file = os.path.abspath(args.baseline) if args.baseline else None
+    save_file = os.path.abspath(args.save_baseline) if args.save_baseline else None
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='psc_bench_')
+    cwd = os.getcwd()
+    bench = Bench(repeat=args.repeat, memory=not args.no_memory)
+    try:
+        filenames = make_workdir(work_dir, args.scripts, args.lines, args.seed, fts_file)
+        os.chdir(work_dir)
+        run_benchmarks(bench, filenames, epochs=args.epochs, skip_train=args.no_train)
+    finally:
+        os.chdir(cwd)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'config': {
+            'scripts': args.scripts,
+            'lines': args.lines,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'epochs': args.epochs
+        },
+        'env': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine()
+        },
+        'stages': bench.results
+    }
+
+    print('{:<40} {:>10} {:>10} {:>10}'.format('stage', 'ms', 'us/line', 'peak_MB'))
+    for stage, entry in bench.results.items():
+        print('{:<40} {:>10.2f} {:>10} {:>10}'.format(
+            stage, entry['seconds'] * 1000,
+            '{:.2f}'.format(entry['us_per_line']) if 'us_per_line' in entry else '-',
+            '{:.2f}'.format(entry['peak_bytes'] / 2**20) if 'peak_bytes' in entry else '-'))
+
+    if save_file is not None:
+        with open(save_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('{} created.'.format(save_file))
+
+    failed = False
+    import_ms = bench.results['import_psc']['seconds'] * 1000
+    if import_ms > args.import_budget:
+        print('import psclib.psc took {:.1f} ms (budget: {:.1f} ms).'.format(
+            import_ms, args.import_budget))
+        failed = True
+
+    if baseline_file is not None:
+        with open(baseline_file, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print('Warning: The baseline was measured with a different configuration.')
+        print()
+        regressions = compare(results, baseline, args.tolerance, args.min_diff / 1000)
+        if regressions:
+            print('{} stage(s) slower than the baseline: {}'.format(
+                len(regressions), ', '.join(regressions)))
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#! python3
+# encoding: utf-8
+
+# pickle で保存された (以前の形式の) 予測モデルの重みを、NumPy だけで予測に使える .npz に書き出すプログラム。
+# 特徴量設定ファイルを指定すると、マニフェスト (.json) も保存する (psc_train.py が保存するものと同じ形式)。
+
+import sys
+import pickle
+
+import psclib.psc as psc
+from psclib.artifact import save_model
+
+
+args = sys.argv
+if len(args) < 3:
+    print('Usage: python psc_export.py model_file npz_save_file [feature_setting_file]')
+    sys.exit(1)
+
+# パラメタを再定義
+mdl_file = args[1]
+npz_file = args[2]
+fts_file = args[3] if len(args) > 3 else None
+
+# モデルを読み込む
+with open(mdl_file, mode='rb') as f:
+    model = pickle.load(f)
+
+# 重みを書き出す
+model.to_cpu()
+if fts_file is None:
+    model.export_npz(npz_file)
+    print("Weights are saved as {}.".format(npz_file))
+else:
+    save_model(npz_file, model, psc.read_feature_elements(fts_file))
+    print("Model is saved as {}.".format(npz_file))
@@ -4,81 +4,292 @@
 # モデルごとの学習用中間データ (特徴量ファイルと教師ラベルファイル)
 # および評価用データ (特徴量ファイルと教師ラベルファイル) を作るプログラム。
 # モデル名は、モデルフォルダ (models フォルダのサブフォルダ) の名前。
-# 出力される特徴量データは csv 形式。
+# 出力される特徴量データは台本ごとの .npy 形式 (--csv を指定すると csv も出力する)。
+# 最後に、学習用と評価用のそれぞれについて、全台本分をつなげたバイナリの特徴量ストア
+# (store_ft.npy, store_lbl.npy, store_index.txt) を作る。
+# --jobs N を指定すると、N 個のプロセスで並列に処理する。
+# 特徴量は列ごとに models/<モデル名>/ft_cache にキャッシュされ、台本、特徴量設定とユーザー辞書が
+# 前回から変わっていなければ、その台本の処理は省略される (--force で作り直す)。
+# --trace FILE (または環境変数 PSC_TRACE) を指定すると、処理の段階ごとの所要時間を記録する。
 
 import sys
 import os
 import shutil
 import csv
+import json
+import hashlib
+import argparse
+from multiprocessing import Pool
 
+import numpy as np
+
+import psclib.psc as psc
+from psclib import trace
 from psclib.extract import extract_file
+from psclib.cache import TokenCache, FeatureCache, CACHE_DIR_ENV, CACHE_FORMAT_VERSION, \
+    janome_version, user_dic_key
+
+
+# ワーカープロセスごとに一つだけ読み込む特徴量設定と、キャッシュ
+# (Tokenizer は psc.get_tokenizer() により、プロセスごとに一つだけ作られる)
+_ftels = None
+_cache = None
+_ft_cache = None
+_force = False
+_write_csv = False
+
+
+def init_worker(fts_path, ft_cache_dir, force=False, write_csv=False,
+        cache_dir=None, cache_size=None):
+    """
+    ワーカープロセスの初期化 (特徴量設定の読み込みとキャッシュの準備)
+    """
+    global _ftels, _cache, _ft_cache, _force, _write_csv
+    _ftels = psc.read_feature_elements(fts_path)
+    _ft_cache = FeatureCache(ft_cache_dir)
+    _force = force
+    _write_csv = write_csv
+    _cache = TokenCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+
+
+def file_hash(path):
+    """
+    ファイルの内容のハッシュを返す。ファイルがなければ None を返す。
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def make_stamp(in_file, lbl_file):
+    """
+    台本1冊分の出力を作った時の入力と設定の記録 (*_ft.stamp の内容) を返す
+
+    形態素解析の結果は Janome のバージョンとユーザー辞書によって変わるので、それも含める。
+    """
+    return {
+        'version': CACHE_FORMAT_VERSION,
+        'script': file_hash(in_file),
+        'labels': file_hash(lbl_file),
+        'janome': janome_version(),
+        'user_dic': user_dic_key(),
+        'features': [ftel[0] for ftel in _ftels],
+        'csv': _write_csv
+    }
+
 
+def make_files(task):
+    """
+    台本1冊分の特徴量ファイルと教師ラベルファイルを作る
 
-args = sys.argv
-if len(args) < 2:
-    print('Usage: python psc_maketrain.py model_name')
-    sys.exit(1)
+    Parameters
+    ----------
+    task : tuple
+        (ファイル名 (拡張子なし), 保存先ディレクトリ)
 
-# モデル名と特徴量設定ファイル
-model_name = args[1]
-fts_path = "models/" + model_name + "/mdl_fts.txt"
+    Returns
+    -------
+    messages : list
+        表示するメッセージのリスト
+    """
+    with trace.span('make_files', script=task[0]):
+        return _make_files(task)
 
-if not os.path.isfile(fts_path):
-    print('{} doesn\'t exist. Terminated.'.format(fts_path))
-    sys.exit(1)
 
-for basename in ['train', 'eval']: # 学習用と評価用
+def _make_files(task):
+    """
+    台本1冊分の特徴量ファイルと教師ラベルファイルを作る (make_files() の本体)
+    """
+    fn, dest_dir = task
+    messages = []
 
-    # 番号リストファイル
-    list_path = "models/" + model_name + "/ds_" + basename + "_list.txt"
+    in_file = "dataset/{}.txt".format(fn)
+    lbl_file = "dataset/{}_lbl.txt".format(fn)
+    ft_path = dest_dir + "/{}_ft.npy".format(fn)
+    csv_path = dest_dir + "/{}_ft.csv".format(fn)
+    lbl_path = dest_dir + "/{}_lbl.txt".format(fn)
+    stamp_path = dest_dir + "/{}_ft.stamp".format(fn)
 
+    # 入力と設定が前回と同じで、出力もそろっていれば何もしない。
+    stamp = make_stamp(in_file, lbl_file)
+    if not _force and os.path.isfile(ft_path) \
+            and (not _write_csv or os.path.isfile(csv_path)) \
+            and (stamp['labels'] is None or os.path.isfile(lbl_path)):
+        try:
+            with open(stamp_path, 'r', encoding='utf-8') as f:
+                if json.load(f) == stamp:
+                    messages.append('{} is up to date.'.format(ft_path))
+                    return messages
+        except (FileNotFoundError, ValueError):
+            pass
+
+    # 特徴量ファイルを作る (キャッシュにない特徴量の列だけを抽出する)
+    if _write_csv:
+        ft_list = extract_file(in_file, ftels=_ftels, cache=_cache, ft_cache=_ft_cache)
+        ft_array = np.array(ft_list, dtype=np.float32).reshape(len(ft_list), len(_ftels))
+    else:
+        ft_array = extract_file(in_file, ftels=_ftels, cache=_cache, ft_cache=_ft_cache,
+            as_array=True)
+    psc.save_array(ft_path, ft_array)
+    messages.append('{} created.'.format(ft_path))
+
+    if _write_csv:
+        def write_csv(path):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerows(ft_list)
+
+        psc.write_atomic(csv_path, write_csv)
+        messages.append('{} created.'.format(csv_path))
+
+    # 教師ラベルファイル
     # ファイルの存在確認
-    if not os.path.isfile(list_path):
-        print('{} doesn\'t exist. Skipped.'.format(list_path))
-        continue
-
-    # 保存先ディレクトリ
-    dest_dir = "models/" + model_name + "/" + basename
-
-    # ds_train_list.txt (または ds_eval_list.txt) を読み込み、
-    # ファイル名（拡張子なし）リストを作る
-    filenames = []
-    with open(list_path, 'r', encoding='utf_8_sig') as f:
-        for i, line in enumerate(f):
-            try:
-                num = int(line.strip())
-                filenames.append("{:0>6}".format(num))
-            except ValueError:
-                print('Warning: {}: Line {} is not number. Ignored.'.format(list_path, i+1))
+    if not os.path.isfile(lbl_file):
+        messages.append('{} doesn\'t exist. Skipped.'.format(lbl_file))
+    else:
+        # 教師ラベルをコピー
+        dest_path = lbl_path
+        psc.write_atomic(dest_path, lambda path: shutil.copyfile(lbl_file, path))
+        messages.append('{} created.'.format(dest_path))
 
-    for fn in filenames:
-        # 台本ファイル
-        in_file = "dataset/{}.txt".format(fn)
+    # 次回の判定のために、入力と設定を記録しておく。
+    def write_stamp(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(stamp, f)
 
-        # ファイルの存在確認
-        if not os.path.isfile(in_file):
-            print('{} doesn\'t exist. Skipped.'.format(in_file))
+    psc.write_atomic(stamp_path, write_stamp)
+
+    return messages
+
+
+def make_store(dest_dir, filenames):
+    """
+    台本ごとの特徴量ファイルと教師ラベルファイルから、特徴量ストアを作る
+
+    Parameters
+    ----------
+    dest_dir : str
+        保存先ディレクトリ
+    filenames : list
+        ファイル名 (拡張子なし) のリスト。この順に並べる。
+    """
+    names = []
+    ft_arrays = []
+    lbl_arrays = []
+    for fn in filenames:
+        ft_path = dest_dir + "/{}_ft.npy".format(fn)
+        lbl_path = dest_dir + "/{}_lbl.txt".format(fn)
+        if not os.path.isfile(ft_path) or not os.path.isfile(lbl_path):
+            print('Warning: {} is not in the feature store.'.format(fn))
+            continue
+        # 台本ごとの特徴量はメモリマップで開き、ストアに書き込む時に読み込む。
+        ft = np.load(ft_path, mmap_mode='r')
+        with open(lbl_path, 'r', encoding='utf_8_sig') as f:
+            lbl = np.array([psc.classes.index(line.strip()) for line in f], dtype=np.int32)
+        if len(ft) != len(lbl):
+            print('Warning: {} has {} lines but {} labels. Not in the feature store.'.format(
+                fn, len(ft), len(lbl)))
             continue
+        names.append(fn)
+        ft_arrays.append(ft)
+        lbl_arrays.append(lbl)
+
+    psc.write_feature_store(dest_dir, names, ft_arrays, lbl_arrays)
+    print('{}/store_ft.npy created.'.format(dest_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='python psc_maketrain.py model_name [--jobs N] [--force] [--csv] [--cache-dir DIR] [--cache-size MB] [--trace FILE]')
+    parser.add_argument('model_name')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of worker processes (default: 1)')
+    parser.add_argument('--force', action='store_true',
+        help='rebuild all files even if they are up to date')
+    parser.add_argument('--csv', action='store_true',
+        help='also write features as csv files')
+    parser.add_argument('--cache-dir', default=os.environ.get(CACHE_DIR_ENV),
+        help='tokenization cache directory (default: ${})'.format(CACHE_DIR_ENV))
+    parser.add_argument('--cache-size', type=int, default=256,
+        help='max size of the tokenization cache and of the feature cache in MB (default: 256)')
+    parser.add_argument('--trace', metavar='FILE',
+        help='record per-stage timings to FILE (JSON lines, or Chrome trace if FILE ends with .json)')
+    args = parser.parse_args()
 
-        # 特徴量ファイルを作る
-        ft_list = extract_file(in_file, fts_path)
-        dest_path = dest_dir + "/{}_ft.csv".format(fn)
-        with open(dest_path, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerows(ft_list)
-        
-        print('{} created.'.format(dest_path))
-        
-        # 教師ラベルファイル
-        lbl_file = "dataset/{}_lbl.txt".format(fn)
+    if args.trace:
+        trace.enable(args.trace)
+
+    # モデル名と特徴量設定ファイル
+    model_name = args.model_name
+    fts_path = "models/" + model_name + "/mdl_fts.txt"
+
+    if not os.path.isfile(fts_path):
+        print('{} doesn\'t exist. Terminated.'.format(fts_path))
+        sys.exit(1)
+
+    tasks = []
+    stores = []
+    for basename in ['train', 'eval']: # 学習用と評価用
+
+        # 番号リストファイル
+        list_path = "models/" + model_name + "/ds_" + basename + "_list.txt"
 
         # ファイルの存在確認
-        if not os.path.isfile(lbl_file):
-            print('{} doesn\'t exist. Skipped.'.format(lbl_file))
+        if not os.path.isfile(list_path):
+            print('{} doesn\'t exist. Skipped.'.format(list_path))
             continue
 
-        # 教師ラベルをコピー
-        dest_path = dest_dir + "/{}_lbl.txt".format(fn)
-        shutil.copyfile(lbl_file, dest_path)
-        
-        print('{} created.'.format(dest_path))
+        # 保存先ディレクトリ
+        dest_dir = "models/" + model_name + "/" + basename
+
+        # ds_train_list.txt (または ds_eval_list.txt) を読み込み、
+        # ファイル名（拡張子なし）リストを作る
+        filenames = []
+        with open(list_path, 'r', encoding='utf_8_sig') as f:
+            for i, line in enumerate(f):
+                try:
+                    num = int(line.strip())
+                    filenames.append("{:0>6}".format(num))
+                except ValueError:
+                    print('Warning: {}: Line {} is not number. Ignored.'.format(list_path, i+1))
+
+        for fn in filenames:
+            # 台本ファイル
+            in_file = "dataset/{}.txt".format(fn)
+
+            # ファイルの存在確認
+            if not os.path.isfile(in_file):
+                print('{} doesn\'t exist. Skipped.'.format(in_file))
+                continue
+
+            tasks.append((fn, dest_dir))
+
+        stores.append((dest_dir, filenames))
+
+    ft_cache_dir = "models/" + model_name + "/ft_cache"
+    initargs = (fts_path, ft_cache_dir, args.force, args.csv, args.cache_dir, args.cache_size)
+    if args.jobs > 1:
+        # 大きいファイルから順に処理して、最後に大きいファイルだけが残らないようにする。
+        tasks.sort(key=lambda t: os.path.getsize("dataset/{}.txt".format(t[0])), reverse=True)
+        with Pool(args.jobs, initializer=init_worker, initargs=initargs) as pool:
+            for messages in pool.imap_unordered(make_files, tasks):
+                for msg in messages:
+                    print(msg)
+    else:
+        init_worker(*initargs)
+        for task in tasks:
+            for msg in make_files(task):
+                print(msg)
+
+    # 特徴量ストアを作る
+    for dest_dir, filenames in stores:
+        make_store(dest_dir, filenames)
+
+    # 特徴量のキャッシュが上限を超えていたら、最近使われていない台本の分から消す
+    FeatureCache(ft_cache_dir, args.cache_size * 1024 * 1024).evict()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,122 +2,308 @@
 # encoding: utf-8
 
 # 予測モデル, 特徴量データを入力として、予測結果 (ラベル) を出力するプログラム。
-
+# 予測結果は、教師データと同じ "ラベル,行" の形式で保存する。
+# --out-dir を指定すると、複数の台本 (ファイルまたはディレクトリ) をまとめて予測する。
+# その場合、モデルと特徴量設定は一度だけ読み込み、複数の台本の行をまとめて順伝播する。
+# 1冊だけ予測する場合は、台本を chunk_lines 行ずつ読み込んで予測する (環境変数
+# PSC_TOKEN_CACHE でキャッシュを使う場合を除く)。
+# model_file が .npz (PscChain.export_npz() で保存したもの) なら、Chainer を使わずに
+# NumPy だけで予測する。
+# --trace FILE (または環境変数 PSC_TRACE) を指定すると、処理の段階ごとの所要時間を記録する。
+# --tokenize-jobs N を指定すると、形態素解析を N 個のプロセスで並列に行う。
+# --constrained (または --constraints FILE) を指定すると、行ごとに最大値を取る代わりに、
+# 行の種類の並びの制約を満たす、台本全体で最もありそうなラベルの並びを求める。
+
+import os
 import sys
-import pickle
-
-import psclib.psc as psc
-from psclib.extract import Extractor
+import glob
+import argparse
 
 import numpy as np
-import cupy
-from chainer import Chain
-import pandas as pd
-
-
-# In[ ]:
-
-
-args = sys.argv
-if len(args) < 5:
-    print('Usage: python psc_predict.py model_file, feature_setting_file, script_file, result_save_file')
-    sys.exit()
-"""
-args = [
-    "psc_predict.py",
-    "model/mdl_0000.pkl",
-    "model/mdl_0000_ft.txt",
-    "predict/prd_0000_sc.txt",
-    "predict/prd_0000_lbl.txt"
-]
-"""
-
-
-# In[ ]:
-
-
-# パラメタを再定義
-mdl_file = args[1]
-ft_setting_file = args[2]
-sc_file = args[3]
-lbl_file = args[4]
-
-
-# In[ ]:
-
-
-# 入力データをリストに
-with open(sc_file, 'r', encoding='utf_8_sig') as f:
-    lines = [l.rstrip() for l in f.readlines()]
-
-# 形態素解析
-token_lines = psc.tokenize_lines(lines)
-
-
-# In[ ]:
-
-
-# 特徴量設定を読み込む
-ftels = psc.read_feature_elements(ft_setting_file)
-
-# 特徴量抽出
-ex = Extractor(token_lines, ftels)
-ft_list = ex.extract()
-
-
-# In[ ]:
-
-
-# モデルを読み込む
-with open(mdl_file, mode='rb') as f:
-    model = pickle.load(f)
-
-# GPU を使うかのフラグ (使うなら 0, 使わないなら -1)
-gpu_id = 0
-
-if gpu_id >= 0:
-    model.to_gpu(gpu_id)
-
-
-# In[ ]:
-
-
-# 特徴量データの ndarray を作成
-if gpu_id >= 0:
-    in_dataset = cupy.cupy.array(ft_list, dtype=np.float32)
-else:
-    in_dataset = np.array(ft_list, dtype=np.float32)
-
-
-# In[ ]:
-
-
-# 順伝播
-out = model(in_dataset)
-
-# 個々の出力の最大値のインデックスをリストにする
-out_idx = out.data.argmax(axis = 1).tolist()
-
-# ラベルを表す文字列にする
-lbls = [psc.classes[i] for i in out_idx]
-
-
-# In[ ]:
-
-
-# 表示用に DataFrame にする
-df = pd.DataFrame({"line": [l.rstrip() for l in open(sc_file, 'r', encoding='utf-8')],
-                            "label": lbls})
-
-
-# In[ ]:
-
-
-print(df)
-
-
-# In[ ]:
-
-
-
 
+import psclib.psc as psc
+from psclib import trace
+from psclib.extract import make_extractor, iter_extract_file
+from psclib.cache import TokenCache
+from psclib.tokenpool import TokenizerPool
+from psclib.predict import load_model, predict_array, predict_logits
+from psclib.decode import Constraints, viterbi
+
+
+def read_script(sc_file):
+    """
+    台本ファイルを読み込んで、行 (str) のリストを返す
+    """
+    with open(sc_file, 'r', encoding='utf_8_sig') as f:
+        return [l.rstrip() for l in f.readlines()]
+
+
+def extract_script(lines, ftels, cache=None, pool=None):
+    """
+    台本の行のリストから、特徴量の行列を作る
+    """
+    # 形態素解析 (形態素解析の結果を使う特徴量がある場合だけ。
+    # 環境変数 PSC_TOKEN_CACHE があれば、キャッシュを使う)
+    ex = make_extractor(lines, ftels, cache=cache, pool=pool)
+
+    # 特徴量抽出 (そのままモデルに入力できる float32 の行列として)
+    return ex.extract_array()
+
+
+def write_result(lbl_file, results):
+    """
+    予測結果を "ラベル,行" の形式で保存する
+
+    Parameters
+    ----------
+    lbl_file : str
+        保存先のパス
+    results : iterable
+        (行のリスト, ラベルのインデックスの配列) のタプル。ジェネレータでもよい。
+    """
+    def write(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for lines, out_idx in results:
+                for line, i in zip(lines, out_idx):
+                    f.write('{},{}\n'.format(psc.classes[i], line))
+
+    psc.write_atomic(lbl_file, write)
+
+
+# ディレクトリ内の台本ファイルでないファイル (dataset フォルダの台本の一覧)
+NON_SCRIPT_FILES = ('index.txt',)
+
+
+def list_scripts(paths, pattern='*.txt'):
+    """
+    ファイルまたはディレクトリのリストから、台本ファイルのリストを作る
+
+    ディレクトリの場合は、その中の pattern に合うファイル (*_lbl.txt と、
+    NON_SCRIPT_FILES を除く) を対象とする。
+    """
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            scripts.extend(sorted(
+                x for x in glob.glob(os.path.join(path, pattern))
+                if not x.endswith('_lbl.txt') and os.path.basename(x) not in NON_SCRIPT_FILES))
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def result_files(scripts, out_dir):
+    """
+    台本ごとの予測結果の保存先 (out_dir/<台本名>_lbl.txt) のリストを返す
+
+    違うディレクトリの同じ名前の台本があると、予測結果を上書きし合うので、
+    ValueError を送出する。
+    """
+    lbl_files = []
+    seen = {}
+    for sc_file in scripts:
+        name = os.path.splitext(os.path.basename(sc_file))[0]
+        lbl_file = os.path.join(out_dir, name + '_lbl.txt')
+        if lbl_file in seen and seen[lbl_file] != os.path.abspath(sc_file):
+            raise ValueError("{} and {} would both be saved as {}.".format(
+                seen[lbl_file], os.path.abspath(sc_file), lbl_file))
+        seen[lbl_file] = os.path.abspath(sc_file)
+        lbl_files.append(lbl_file)
+    return lbl_files
+
+
+def predict_batch(model, ftels, scripts, out_dir, batch_lines=10000, gpu_id=-1, pool=None,
+        constraints=None):
+    """
+    複数の台本をまとめて予測して、out_dir に "<台本名>_lbl.txt" として保存する
+
+    台本を順に読み込んで特徴量を抽出し、たまった行数が batch_lines を超えたら
+    まとめて順伝播する。
+
+    Parameters
+    ----------
+    model : NumpyPscModel or PscChain
+        予測モデル
+    ftels : list
+        (特徴名, ハイパーパラメータ) のタプルのリスト
+    scripts : list
+        台本ファイルのリスト
+    out_dir : str
+        予測結果の保存先ディレクトリ
+    batch_lines : int
+        一度に順伝播する行数の目安
+    gpu_id : int
+        GPU を使うなら 0 以上, 使わないなら -1
+    pool : psclib.tokenpool.TokenizerPool
+        形態素解析を並列に行うプール
+    constraints : psclib.decode.Constraints
+        行の種類の並びの制約。渡すと、台本ごとに制約付きデコードをする。
+    """
+    # 保存先が重なる台本があれば、予測を始める前にやめる。
+    lbl_files = dict(zip(scripts, result_files(scripts, out_dir)))
+    os.makedirs(out_dir, exist_ok=True)
+    cache = TokenCache.from_env()
+
+    pending = []    # (台本ファイル, 行のリスト, 特徴量の行列) のリスト
+    pending_lines = 0
+
+    def flush():
+        # たまった台本の行をつなげて一度に順伝播し、台本ごとに分けて保存する。
+        ft_array = np.concatenate([x[2] for x in pending])
+        if constraints is not None:
+            logits = predict_logits(model, ft_array, gpu_id)
+        else:
+            out_idx = predict_array(model, ft_array, gpu_id)
+        start = 0
+        for sc_file, lines, ft_array in pending:
+            end = start + len(ft_array)
+            if constraints is not None:
+                # 制約は台本ごとにかける
+                script_idx = viterbi(logits[start:end], constraints)
+            else:
+                script_idx = out_idx[start:end]
+            lbl_file = lbl_files[sc_file]
+            write_result(lbl_file, [(lines, script_idx)])
+            print('{} created.'.format(lbl_file))
+            start = end
+        pending.clear()
+
+    for sc_file in scripts:
+        if not os.path.isfile(sc_file):
+            print('{} doesn\'t exist. Skipped.'.format(sc_file))
+            continue
+        lines = read_script(sc_file)
+        pending.append((sc_file, lines, extract_script(lines, ftels, cache, pool)))
+        pending_lines += len(lines)
+        if pending_lines >= batch_lines:
+            flush()
+            pending_lines = 0
+
+    if pending:
+        flush()
+
+
+def predict(args, model, gpu_id, ftels, pool=None, constraints=None):
+    """
+    コマンドライン引数に従って予測して、予測結果を保存する
+    """
+    if args.out_dir is not None:
+        predict_batch(model, ftels, list_scripts(args.paths, args.glob), args.out_dir,
+            batch_lines=args.batch_lines, gpu_id=gpu_id, pool=pool, constraints=constraints)
+        return
+
+    sc_file, lbl_file = args.paths
+    cache = TokenCache.from_env()
+    shown_lines = []
+    shown_labels = []
+
+    def predict_chunks():
+        if cache is not None:
+            # 台本全体をまとめて形態素解析する (キャッシュを使うため)
+            lines = read_script(sc_file)
+            chunks = [(lines, extract_script(lines, ftels, cache, pool))]
+        else:
+            # chunk_lines 行ずつ特徴量抽出する
+            chunks = iter_extract_file(sc_file, ftels=ftels, chunk_lines=args.chunk_lines,
+                pool=pool)
+        if constraints is not None:
+            # 制約は台本全体にかけるので、全行の特徴量をつなげてから予測する
+            chunks = list(chunks)
+            lines = [line for x in chunks for line in x[0]]
+            ft_array = np.concatenate([x[1] for x in chunks]) if chunks else \
+                np.zeros((0, len(ftels)), dtype=np.float32)
+            out_idx = predict_array(model, ft_array, gpu_id, constraints)
+            shown_lines.extend(lines)
+            shown_labels.extend(psc.classes[i] for i in out_idx)
+            yield lines, out_idx
+            return
+        for lines, ft_array in chunks:
+            out_idx = predict_array(model, ft_array, gpu_id)
+            shown_lines.extend(lines)
+            shown_labels.extend(psc.classes[i] for i in out_idx)
+            yield lines, out_idx
+
+    # 特徴量抽出・予測して、予測結果を保存する
+    write_result(lbl_file, predict_chunks())
+
+    # 表示用に DataFrame にする
+    import pandas as pd
+    df = pd.DataFrame({"line": shown_lines, "label": shown_labels})
+    print(df)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='python psc_predict.py model_file feature_setting_file script_file result_save_file\n'
+            '       python psc_predict.py model_file feature_setting_file script_or_dir ... --out-dir DIR')
+    parser.add_argument('model_file')
+    parser.add_argument('feature_setting_file')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--out-dir',
+        help='predict all given scripts (files or directories) into this directory')
+    parser.add_argument('--glob', default='*.txt', metavar='PATTERN',
+        help='script file pattern in directories in batch mode (default: *.txt)')
+    parser.add_argument('--batch-lines', type=int, default=10000,
+        help='number of lines per forward pass in batch mode (default: 10000)')
+    parser.add_argument('--chunk-lines', type=int, default=1000,
+        help='number of lines per chunk when predicting a single script (default: 1000)')
+    parser.add_argument('--gpu', type=int, default=0,
+        help='GPU id, or -1 to use the CPU (default: 0)')
+    parser.add_argument('--constrained', action='store_true',
+        help='decode the best label sequence under the default sequence constraints')
+    parser.add_argument('--constraints', metavar='FILE',
+        help='decode under the sequence constraints in FILE (implies --constrained)')
+    parser.add_argument('--tokenize-jobs', type=int, default=1, metavar='N',
+        help='number of tokenizer processes (default: 1, tokenize in this process)')
+    parser.add_argument('--trace', metavar='FILE',
+        help='record per-stage timings to FILE (JSON lines, or Chrome trace if FILE ends with .json)')
+    args = parser.parse_args()
+
+    if args.trace:
+        trace.enable(args.trace)
+
+    if args.out_dir is None and len(args.paths) != 2:
+        parser.print_usage()
+        sys.exit(1)
+
+    # 予測結果の保存先が重なる台本があれば、モデルを読み込む前にやめる。
+    if args.out_dir is not None:
+        try:
+            result_files(list_scripts(args.paths, args.glob), args.out_dir)
+        except ValueError as e:
+            print('Error: {}'.format(e))
+            sys.exit(1)
+
+    # 特徴量設定を読み込む
+    ftels = psc.read_feature_elements(args.feature_setting_file)
+
+    # モデルを読み込む (特徴量設定が学習時と違えば、予測を始める前にやめる)
+    try:
+        model, gpu_id = load_model(args.model_file, args.gpu, ftels=ftels)
+    except ValueError as e:
+        print('Error: {}'.format(e))
+        sys.exit(1)
+
+    # 行の種類の並びの制約
+    constraints = None
+    if args.constraints:
+        try:
+            constraints = Constraints.load(args.constraints)
+        except ValueError as e:
+            print('Error: {}'.format(e))
+            sys.exit(1)
+    elif args.constrained:
+        constraints = Constraints.default()
+
+    # 形態素解析のプール (--tokenize-jobs が 2 以上の場合)
+    pool = TokenizerPool(args.tokenize_jobs) if args.tokenize_jobs > 1 else None
+    try:
+        predict(args, model, gpu_id, ftels, pool, constraints)
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+if __name__ == '__main__':
+    main()
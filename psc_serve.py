@@ -0,0 +1,337 @@
+#! python3
+# encoding: utf-8
+
+# 予測モデルと特徴量設定、Tokenizer を読み込んだまま待ち受ける、予測用のサーバー。
+# HTTP/JSON で台本の行を受け取り、予測したラベルを返す。
+#
+# POST /predict  {"lines": ["行", ...]} (または {"text": "台本全体"})
+#   -> {"labels": ["DIALOGUE", ...]}
+# GET /metrics   処理段階ごとの所要時間 (ミリ秒) の統計
+#
+# 形態素解析と特徴量抽出はワーカープロセスで行い、同時に来たリクエストは
+# まとめて一度の順伝播で予測する。
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import psclib.psc as psc
+from psclib.extract import Extractor
+from psclib.features import needs_tokens
+from psclib.predict import load_model, predict_array
+
+
+def init_worker(ftels):
+    """
+    ワーカープロセスの準備 (Tokenizer を作っておく)
+
+    Tokenizer は psc.get_tokenizer() により、プロセスごとに一つだけ作られる。
+    どのワーカープロセスで実行されるかは決まらないので、準備をしていないワーカー
+    プロセスがあっても、extract_lines() は (最初の形態素解析が遅くなるだけで) 動く。
+    """
+    if needs_tokens(ftels):
+        psc.get_tokenizer()
+
+
+def extract_lines(lines, ftels):
+    """
+    行のリストを形態素解析して、特徴量の行列と所要時間を返す (ワーカープロセスで実行)
+    """
+    t0 = time.perf_counter()
+    # 形態素解析の結果を使う特徴量がなければ、形態素解析を省く
+    token_lines = psc.tokenize_lines(lines) if needs_tokens(ftels) else None
+    t1 = time.perf_counter()
+    ft_array = Extractor(token_lines, ftels, texts=lines).extract_array()
+    t2 = time.perf_counter()
+    return ft_array, (t1 - t0) * 1000, (t2 - t1) * 1000
+
+
+class Metrics:
+    """
+    処理段階ごとの所要時間を記録するクラス
+    """
+
+    def __init__(self, window=1000):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        window : int
+            パーセンタイルの計算に使う、直近の記録の数
+        """
+        self.window = window
+        self.stages = {}
+
+    def record(self, stage, ms):
+        """
+        stage の所要時間 (ミリ秒) を記録するメソッド
+        """
+        st = self.stages.get(stage)
+        if st is None:
+            st = {'count': 0, 'total': 0., 'max': 0., 'recent': deque(maxlen=self.window)}
+            self.stages[stage] = st
+        st['count'] += 1
+        st['total'] += ms
+        st['max'] = max(st['max'], ms)
+        st['recent'].append(ms)
+
+    def summary(self):
+        """
+        段階ごとの統計を辞書にして返すメソッド
+        """
+        result = {}
+        for stage, st in self.stages.items():
+            recent = np.array(st['recent'])
+            result[stage] = {
+                'count': st['count'],
+                'mean_ms': st['total'] / st['count'],
+                'max_ms': st['max'],
+                'p50_ms': float(np.percentile(recent, 50)),
+                'p95_ms': float(np.percentile(recent, 95))
+            }
+        return result
+
+
+class Batcher:
+    """
+    同時に来たリクエストの特徴量をまとめて、一度の順伝播で予測するクラス
+    """
+
+    def __init__(self, model, gpu_id, metrics, max_wait=0.005, max_rows=10000):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        model : NumpyPscModel or PscChain
+            予測モデル
+        gpu_id : int
+            GPU を使うなら 0 以上, 使わないなら -1
+        metrics : Metrics
+            所要時間の記録先
+        max_wait : float
+            最初のリクエストが来てから、他のリクエストを待つ時間 (秒)
+        max_rows : int
+            一度に順伝播する行数の上限の目安
+        """
+        self.model = model
+        self.gpu_id = gpu_id
+        self.metrics = metrics
+        self.max_wait = max_wait
+        self.max_rows = max_rows
+        self.queue = asyncio.Queue()
+        # 順伝播はイベントループを止めないように、専用のスレッドで行う。
+        self.executor = ThreadPoolExecutor(1)
+
+    async def predict(self, ft_array):
+        """
+        特徴量の行列を予測キューに入れて、各行のラベルのインデックスを待つメソッド
+        """
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((ft_array, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        """
+        予測キューからリクエストを集めて、まとめて順伝播し続けるメソッド
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            items = [await self.queue.get()]
+            rows = len(items[0][0])
+            deadline = loop.time() + self.max_wait
+            while rows < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                rows += len(item[0])
+
+            t0 = time.perf_counter()
+            for _, _, queued in items:
+                self.metrics.record('batch_wait', (t0 - queued) * 1000)
+            self.metrics.record('batch_size', len(items))
+
+            x = np.concatenate([item[0] for item in items])
+            try:
+                out_idx = await loop.run_in_executor(
+                    self.executor, predict_array, self.model, x, self.gpu_id)
+            except Exception as e:
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.record('forward', (time.perf_counter() - t0) * 1000)
+
+            # リクエストごとに分けて返す
+            start = 0
+            for ft_array, future, _ in items:
+                end = start + len(ft_array)
+                if not future.done():
+                    future.set_result(out_idx[start:end])
+                start = end
+
+
+class PredictServer:
+    """
+    HTTP/JSON で予測を受け付けるサーバー
+    """
+
+    def __init__(self, model, gpu_id, ftels, workers=1, max_wait=0.005):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        model : NumpyPscModel or PscChain
+            予測モデル
+        gpu_id : int
+            GPU を使うなら 0 以上, 使わないなら -1
+        ftels : list
+            (特徴名, ハイパーパラメータ) のタプルのリスト
+        workers : int
+            形態素解析と特徴量抽出を行うワーカープロセスの数
+        max_wait : float
+            まとめて予測するために、他のリクエストを待つ時間 (秒)
+        """
+        self.ftels = ftels
+        self.metrics = Metrics()
+        self.batcher = Batcher(model, gpu_id, self.metrics, max_wait=max_wait)
+        self.pool = ProcessPoolExecutor(workers)
+        # ワーカーごとに Tokenizer を作っておく (最初のリクエストを待たせないため)。
+        # 特徴量設定は、リクエストごとに extract_lines() に渡す。
+        for f in [self.pool.submit(init_worker, ftels) for _ in range(workers)]:
+            f.result()
+
+    async def predict(self, lines):
+        """
+        行のリストを予測して、ラベル (str) のリストを返すメソッド
+        """
+        loop = asyncio.get_event_loop()
+        t0 = time.perf_counter()
+        ft_array, tokenize_ms, extract_ms = await loop.run_in_executor(
+            self.pool, extract_lines, lines, self.ftels)
+        t1 = time.perf_counter()
+        self.metrics.record('tokenize', tokenize_ms)
+        self.metrics.record('extract', extract_ms)
+        self.metrics.record('worker', (t1 - t0) * 1000)
+
+        out_idx = await self.batcher.predict(ft_array)
+        self.metrics.record('total', (time.perf_counter() - t0) * 1000)
+        return [psc.classes[i] for i in out_idx]
+
+    async def handle(self, reader, writer):
+        """
+        HTTP リクエストを一つ処理するメソッド
+        """
+        try:
+            status, body = await self.dispatch(reader)
+        except (ValueError, KeyError, TypeError) as e:
+            status, body = 400, {'error': str(e)}
+        except Exception as e:
+            status, body = 500, {'error': str(e)}
+
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+        writer.write('HTTP/1.1 {} {}\r\n'.format(status, reason.get(status, '')).encode('ascii'))
+        writer.write(b'Content-Type: application/json; charset=utf-8\r\n')
+        writer.write('Content-Length: {}\r\n'.format(len(data)).encode('ascii'))
+        writer.write(b'Connection: close\r\n\r\n')
+        writer.write(data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def dispatch(self, reader):
+        """
+        リクエストを読み込んで、(ステータスコード, レスポンスの辞書) を返すメソッド
+        """
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            raise ValueError('bad request line')
+        method, path = request_line[0], request_line[1]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.summary()
+
+        if method == 'POST' and path == '/predict':
+            length = int(headers.get('content-length', 0))
+            req = json.loads((await reader.readexactly(length)).decode('utf-8'))
+            if 'lines' in req:
+                lines = [str(l).rstrip() for l in req['lines']]
+            else:
+                lines = [l.rstrip() for l in str(req['text']).splitlines()]
+            return 200, {'labels': await self.predict(lines)}
+
+        return 404, {'error': 'not found'}
+
+    async def serve(self, host, port):
+        """
+        サーバーを起動して、止められるまで待ち受けるメソッド
+        """
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://{}:{}/'.format(host, port))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            batcher_task.cancel()
+            self.pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='python psc_serve.py model_file feature_setting_file [--host HOST] [--port PORT]')
+    parser.add_argument('model_file')
+    parser.add_argument('feature_setting_file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of tokenizer worker processes (default: 1)')
+    parser.add_argument('--max-wait', type=float, default=5.,
+        help='time to wait for other requests to batch together, in ms (default: 5)')
+    parser.add_argument('--gpu', type=int, default=-1,
+        help='GPU id, or -1 to use the CPU (default: -1)')
+    args = parser.parse_args()
+
+    # 特徴量設定とモデルを読み込む
+    ftels = psc.read_feature_elements(args.feature_setting_file)
+    try:
+        model, gpu_id = load_model(args.model_file, args.gpu, ftels=ftels)
+    except ValueError as e:
+        print('Error: {}'.format(e))
+        sys.exit(1)
+
+    server = PredictServer(model, gpu_id, ftels,
+        workers=args.workers, max_wait=args.max_wait / 1000)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
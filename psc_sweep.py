@@ -0,0 +1,295 @@
+#! python3
+# encoding: utf-8
+
+# 隠れ層のノード数、学習率、バッチサイズ、特徴量の組み合わせを変えながら学習・評価して、
+# 評価用データでの精度の順に並べた結果の表を作るプログラム。
+# モデル名は、モデルフォルダ (models フォルダのサブフォルダ) の名前。
+# 特徴量は、すべての候補で使われる特徴量について一度だけ抽出し (models/<モデル名>/ft_cache の
+# キャッシュにあればそれを使う)、候補ごとに必要な列を切り出して使う。
+# 候補の学習 (と、特徴量の抽出のための形態素解析) は --jobs N 個のプロセスで並列に行う (CPU のみ)。
+# 結果は models/<モデル名>/sweep_results.csv に保存する。
+
+import os
+import sys
+import csv
+import time
+import random
+import argparse
+import itertools
+from multiprocessing import Pool
+
+import numpy as np
+
+import psclib.psc as psc
+from psclib.features import expand_feature_name, sort_key
+from psclib.extract import extract_file
+from psclib.cache import FeatureCache
+from psclib.tokenpool import TokenizerPool
+
+
+# ワーカープロセスごとに一つだけ受け取るデータ
+_data = None
+
+
+def read_list(list_path):
+    """
+    番号リストファイルを読み込んで、ファイル名 (拡張子なし) のリストを返す
+    """
+    filenames = []
+    with open(list_path, 'r', encoding='utf_8_sig') as f:
+        for i, line in enumerate(f):
+            try:
+                num = int(line.strip())
+                filenames.append("{:0>6}".format(num))
+            except ValueError:
+                print('Warning: {}: Line {} is not number. Ignored.'.format(list_path, i+1))
+    return filenames
+
+
+def read_feature_sets(path):
+    """
+    特徴量の組み合わせのファイルを読み込む
+
+    1行に1つの組み合わせを、特徴名のカンマ区切りで書く。# 以降はコメント。
+    前後の行の特徴量の範囲 (特徴名@-2:+2 など) も書ける。
+    """
+    feature_sets = []
+    with open(path, 'r', encoding='utf_8_sig') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            names = []
+            for x in line.split(','):
+                if x.strip():
+                    names.extend(expand_feature_name(x.strip()))
+            feature_sets.append(tuple(names))
+    return feature_sets
+
+
+def load_columns(filenames, ftnames, ft_cache, pool=None):
+    """
+    台本の特徴量 (ftnames の列) と教師ラベルを、全台本分つなげて返す
+
+    特徴量の列は ft_cache にあればそれを使い、なければ抽出してキャッシュに保存する。
+    pool を渡すと、形態素解析をそのプールで並列に行う。
+
+    Returns
+    -------
+    features : numpy.ndarray
+        (全行数 x 特徴量の数) の float32 の行列
+    labels : numpy.ndarray
+        全行分の教師ラベルの int32 の配列
+    """
+    ftels = [[name, '1'] for name in ftnames]
+    ft_arrays = []
+    lbl_arrays = []
+    for fn in filenames:
+        in_file = "dataset/{}.txt".format(fn)
+        lbl_file = "dataset/{}_lbl.txt".format(fn)
+        if not os.path.isfile(in_file) or not os.path.isfile(lbl_file):
+            print('{} or {} doesn\'t exist. Skipped.'.format(in_file, lbl_file))
+            continue
+        ft_array = extract_file(in_file, ftels=ftels, ft_cache=ft_cache, pool=pool, as_array=True)
+        with open(lbl_file, 'r', encoding='utf_8_sig') as f:
+            lbl = [psc.classes.index(line.strip()) for line in f]
+        if len(ft_array) != len(lbl):
+            print('Warning: {} has {} lines but {} labels. Skipped.'.format(
+                fn, len(ft_array), len(lbl)))
+            continue
+        ft_arrays.append(ft_array)
+        lbl_arrays.append(np.array(lbl, dtype=np.int32))
+
+    if not ft_arrays:
+        return np.zeros((0, len(ftnames)), dtype=np.float32), np.zeros(0, dtype=np.int32)
+    return np.concatenate(ft_arrays), np.concatenate(lbl_arrays)
+
+
+def make_candidates(args, feature_sets):
+    """
+    ハイパーパラメータと特徴量の組み合わせ (候補) のリストを作る
+
+    --samples を指定した場合は、すべての組み合わせからランダムに選ぶ (ランダムサーチ)。
+    """
+    grid = [
+        {'hid_dim': hid_dim, 'lr': lr, 'batch_size': batch_size, 'features': features}
+        for hid_dim, lr, batch_size, features in itertools.product(
+            args.hid_dim, args.lr, args.batch_size, feature_sets)
+    ]
+    if args.samples and args.samples < len(grid):
+        grid = random.Random(args.seed).sample(grid, args.samples)
+    return grid
+
+
+def init_worker(data):
+    """
+    ワーカープロセスの初期化 (特徴量と教師ラベルの受け取り)
+    """
+    global _data
+    _data = data
+
+
+def train_candidate(task):
+    """
+    候補を一つ学習・評価して、結果の辞書を返す (ワーカープロセスで実行)
+    """
+    from chainer import optimizers
+    from psclib.chain import PscChain
+
+    cand, epochs, patience, seed = task
+    cols = [_data['ftnames'].index(name) for name in cand['features']]
+    ds_train = psc.ArrayDataset(_data['train_x'][:, cols], _data['train_t'])
+
+    np.random.seed(seed)
+    model = PscChain(cand['hid_dim'], len(psc.classes))
+    optimizer = optimizers.SGD(lr=cand['lr']).setup(model)
+
+    t0 = time.perf_counter()
+    history = model.train(dataset=ds_train, batch_size=cand['batch_size'], max_epoch=epochs,
+        optimizer=optimizer, gpu_id=-1, verbose=False, patience=patience)
+    train_time = time.perf_counter() - t0
+
+    # 評価用データがあれば評価用データの精度、なければ検証用データの精度で比べる
+    if len(_data['eval_t']) > 0:
+        ds_eval = psc.ArrayDataset(_data['eval_x'][:, cols], _data['eval_t'])
+        _, accuracy = model.validate(ds_eval, cand['batch_size'])
+    else:
+        accuracy = max(h['val_accuracy'] for h in history)
+
+    result = dict(cand)
+    result.update({
+        'accuracy': accuracy,
+        'val_loss': min(h['val_loss'] for h in history),
+        'epochs': history[-1]['epoch'],
+        'train_time': train_time
+    })
+    return result
+
+
+def print_result(r):
+    """
+    候補一つ分の結果を表示する
+    """
+    print('accuracy:{:.4f} time:{:.2f}s hid_dim:{} lr:{} batch_size:{} features:{}'.format(
+        r['accuracy'], r['train_time'], r['hid_dim'], r['lr'], r['batch_size'],
+        len(r['features'])))
+
+
+def write_results(path, results):
+    """
+    精度の順に並べた結果の表を csv で保存する
+    """
+    def write(tmp_path):
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['rank', 'accuracy', 'val_loss', 'train_time', 'epochs',
+                'hid_dim', 'lr', 'batch_size', 'features'])
+            for rank, r in enumerate(results, 1):
+                writer.writerow([rank, '{:.4f}'.format(r['accuracy']),
+                    '{:.4f}'.format(r['val_loss']), '{:.2f}'.format(r['train_time']),
+                    r['epochs'], r['hid_dim'], r['lr'], r['batch_size'],
+                    ';'.join(r['features'])])
+
+    psc.write_atomic(path, write)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='python psc_sweep.py model_name [--hid-dim N ...] [--lr R ...] [--batch-size N ...] '
+            '[--feature-sets FILE | --random-subsets N] [--samples N] [--jobs N] [--cache-size MB]')
+    parser.add_argument('model_name')
+    parser.add_argument('--hid-dim', type=int, nargs='+', default=[20],
+        help='hidden layer sizes to try (default: 20)')
+    parser.add_argument('--lr', type=float, nargs='+', default=[0.01],
+        help='learning rates to try (default: 0.01)')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[100],
+        help='batch sizes to try (default: 100)')
+    parser.add_argument('--feature-sets', metavar='FILE',
+        help='file with one comma-separated feature set per line (default: mdl_fts.txt)')
+    parser.add_argument('--random-subsets', type=int, default=0, metavar='N',
+        help='try N random subsets of the features in mdl_fts.txt')
+    parser.add_argument('--subset-size', type=int,
+        help='number of features in each random subset (default: half of mdl_fts.txt)')
+    parser.add_argument('--samples', type=int, default=0,
+        help='train only N randomly chosen candidates from the grid (random search)')
+    parser.add_argument('--epochs', type=int, default=20,
+        help='max number of epochs per candidate (default: 20)')
+    parser.add_argument('--patience', type=psc.positive_int,
+        help='early stopping patience (default: no early stopping)')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of worker processes (default: 1)')
+    parser.add_argument('--cache-size', type=int, default=256,
+        help='max size of the feature cache in MB (default: 256)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed for the search and the weight initialization (default: 0)')
+    args = parser.parse_args()
+
+    model_name = args.model_name
+    model_dir = "models/" + model_name
+    fts_path = model_dir + "/mdl_fts.txt"
+    if not os.path.isfile(fts_path):
+        print('{} doesn\'t exist. Terminated.'.format(fts_path))
+        sys.exit(1)
+
+    # 特徴量の組み合わせ
+    base = tuple(ftel[0] for ftel in psc.read_feature_elements(fts_path))
+    if args.feature_sets:
+        feature_sets = read_feature_sets(args.feature_sets)
+    elif args.random_subsets > 0:
+        rng = random.Random(args.seed)
+        size = args.subset_size or max(1, len(base) // 2)
+        feature_sets = [tuple(sorted(rng.sample(base, size), key=base.index))
+            for _ in range(args.random_subsets)]
+    else:
+        feature_sets = [base]
+
+    candidates = make_candidates(args, feature_sets)
+    if not candidates:
+        print('No candidates. Terminated.')
+        sys.exit(1)
+
+    # すべての候補で使われる特徴量の列を、一度だけ抽出する
+    ftnames = sorted({name for cand in candidates for name in cand['features']},
+        key=sort_key)
+    ft_cache = FeatureCache(model_dir + "/ft_cache", args.cache_size * 1024 * 1024)
+    pool = TokenizerPool(args.jobs) if args.jobs > 1 else None
+    try:
+        train_x, train_t = load_columns(
+            read_list(model_dir + "/ds_train_list.txt"), ftnames, ft_cache, pool)
+        eval_list_path = model_dir + "/ds_eval_list.txt"
+        eval_names = read_list(eval_list_path) if os.path.isfile(eval_list_path) else []
+        eval_x, eval_t = load_columns(eval_names, ftnames, ft_cache, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    ft_cache.evict()
+    data = {'ftnames': ftnames, 'train_x': train_x, 'train_t': train_t,
+        'eval_x': eval_x, 'eval_t': eval_t}
+
+    print('{} candidates, {} features, {} training lines.'.format(
+        len(candidates), len(ftnames), len(train_t)))
+
+    # 候補を並列に学習する
+    tasks = [(cand, args.epochs, args.patience, args.seed) for cand in candidates]
+    results = []
+    if args.jobs > 1:
+        with Pool(args.jobs, initializer=init_worker, initargs=(data,)) as pool:
+            for r in pool.imap_unordered(train_candidate, tasks):
+                print_result(r)
+                results.append(r)
+    else:
+        init_worker(data)
+        for task in tasks:
+            r = train_candidate(task)
+            print_result(r)
+            results.append(r)
+
+    # 精度の高い順 (同じなら学習時間の短い順) に並べて保存する
+    results.sort(key=lambda r: (-r['accuracy'], r['train_time']))
+    result_path = model_dir + "/sweep_results.csv"
+    write_results(result_path, results)
+    print('{} created.'.format(result_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,35 +4,82 @@
 # モデルを指定して、学習した予測モデルを保存するプログラム。
 # モデル名は、モデルフォルダ (models フォルダのサブフォルダ) の名前。
 # 標準出力に、評価用データで評価した結果を出力する。
+# --shards を指定すると、学習用データ全体をメモリに読み込まずに、台本ごとの特徴量ファイルから
+# ミニバッチを読み出しながら学習する (学習用と検証用は台本単位で分ける)。
+# 環境変数 PSC_TRACE にファイル名を指定すると、エポックとバッチごとの所要時間などを記録する。
+# 予測モデルは、重み (mdl.npz) とマニフェスト (mdl.json、モデルの形と特徴量設定) で保存する。
 
+import os
 import sys
-import pickle
+import json
+import argparse
 import numpy as np
 
 import psclib.psc as psc
 from psclib.chain import PscChain
+from psclib.artifact import save_model
 
 from chainer import optimizers
 from chainer.cuda import to_cpu, to_gpu
 
-args = sys.argv
-if len(args) < 2:
-    print('Usage: python psc_train.py model_folder')
-    sys.exit(1)
-"""
-args = [
-    "psc_train.py",
-    "mdl000"
-]
-"""
+def check_dataset_features(model_name, ftels, dataset):
+    """
+    学習用データが、特徴量設定 (mdl_fts.txt) の特徴量で作られているか確かめる
+
+    psc_maketrain.py が台本ごとに残した記録 (*_ft.stamp) の特徴名と、データの列数を
+    特徴量設定と比べる。違えば、理由を説明する ValueError を送出する。
+    """
+    names = [ftel[0] for ftel in ftels]
+    with open("models/" + model_name + "/ds_train_list.txt", 'r', encoding='utf_8_sig') as f:
+        filenames = ["{:0>6}".format(int(x)) for x in f if x.strip().isdigit()]
+    for fn in filenames:
+        stamp_path = "models/{}/train/{}_ft.stamp".format(model_name, fn)
+        if not os.path.isfile(stamp_path):
+            continue
+        with open(stamp_path, 'r', encoding='utf-8') as f:
+            if json.load(f).get('features') != names:
+                raise ValueError("{} was made with a different feature setting. "
+                    "Run psc_maketrain.py again.".format(stamp_path))
+
+    if len(dataset) == 0:
+        return
+    if isinstance(dataset, psc.ShardDataset):
+        n_cols = np.load(dataset.shards[0][0], mmap_mode='r').shape[1]
+    else:
+        n_cols = dataset.features.shape[1]
+    if n_cols != len(ftels):
+        raise ValueError("The training data has {} features but the feature setting has {}. "
+            "Run psc_maketrain.py again.".format(n_cols, len(ftels)))
+
+
+parser = argparse.ArgumentParser(usage='python psc_train.py model_folder [--shards] [--prefetch N] [--valid-every N] [--patience N]')
+parser.add_argument('model_folder')
+parser.add_argument('--shards', action='store_true',
+    help='stream minibatches from the per-script feature files instead of loading all data')
+parser.add_argument('--prefetch', type=int, default=0,
+    help='number of minibatches to prepare (and copy to the GPU) in a background thread (default: 0)')
+parser.add_argument('--valid-every', type=psc.positive_int, default=1,
+    help='validate every N epochs (default: 1)')
+parser.add_argument('--patience', type=psc.positive_int,
+    help='stop after N validations without improvement and restore the best parameters')
+args = parser.parse_args()
 
 # モデル名
-model_name = args[1]
+model_name = args.model_folder
 
 # 学習用番号リストファイル
 train_list_path = "models/" + model_name + "/ds_train_list.txt"
 # 学習用データセット
-ds_train = psc.make_dataset(model_name, 'train')
+# (--shards なら、台本ごとの特徴量ファイルをディスクに置いたまま読み出す)
+ds_train = psc.make_dataset(model_name, 'train', as_array=True, as_shards=args.shards)
+
+# 学習に使う特徴量設定 (マニフェストに記録する)。学習用データと合わなければ、学習せずにやめる。
+ftels = psc.read_feature_elements("models/" + model_name + "/mdl_fts.txt")
+try:
+    check_dataset_features(model_name, ftels, ds_train)
+except ValueError as e:
+    print('Error: {}'.format(e))
+    sys.exit(1)
 
 # モデル定義
 hid_dim = 20                # 隠れ層のノード数 : いい塩梅に決める
@@ -47,23 +94,25 @@ gpu_id=0
 print("Learning with dataset from list: {}".format(train_list_path))
 
 # 学習
-model.train(dataset=ds_train, batch_size=100, max_epoch=20, optimizer=optimizer, gpu_id=gpu_id)
+model.train(dataset=ds_train, batch_size=100, max_epoch=20, optimizer=optimizer, gpu_id=gpu_id,
+    n_prefetch=args.prefetch, valid_every=args.valid_every, patience=args.patience)
 
 # 評価用番号リストファイル
 eval_list_path = "models/" + model_name + "/ds_eval_list.txt"
 # 評価用データセット
-ds_eval = psc.make_dataset(model_name, 'eval')
+ds_eval = psc.make_dataset(model_name, 'eval', as_array=True, as_shards=args.shards)
 
 print("Evaluating with dataset from list: {}".format(eval_list_path))
 
 # 評価して精度を得る
-accuracies = model.evaluate(dataset=ds_eval, batch_size=100, gpu_id=gpu_id)
+accuracies = model.evaluate(dataset=ds_eval, batch_size=100, gpu_id=gpu_id,
+    n_prefetch=args.prefetch)
 
 print('accuracy:{:.04f}'.format(np.mean(accuracies)))
 
 # モデルを保存する (保存するときは CPU 版とする)
-model_save_file = "models/" + model_name + "/mdl.pkl"
-with open(model_save_file, 'wb') as f:
-    pickle.dump(model.to_cpu(), f)
-    
+# 重み (.npz) と、学習に使った特徴量設定を記録したマニフェスト (.json) を保存する
+model_save_file = "models/" + model_name + "/mdl.npz"
+save_model(model_save_file, model.to_cpu(), ftels)
+
 print("Model is saved as {}.".format(model_save_file))
@@ -0,0 +1,115 @@
+"""
+予測モデルの保存形式 (pickle を使わない、バージョン付きの形式)
+
+予測モデルは、重みの .npz (PscChain.export_npz() の形式、圧縮なし) と、同じ名前の
+.json のマニフェストの二つのファイルで保存する。マニフェストには、モデルの形
+(in_dim, hid_dim, out_dim)、ラベルの並び (psc.classes)、学習に使った特徴量設定
+(read_feature_elements() の結果) を記録する。
+
+読み込む時は pickle を使わないので、Chainer のバージョンやクラスの定義が変わっても
+読み込める。予測に使う特徴量設定がマニフェストと違えば、予測を始める前にエラーにする。
+"""
+
+import os
+import json
+
+import psclib.psc as psc
+
+
+# マニフェストの形式の名前とバージョン (形式を変えたら上げる)
+MANIFEST_FORMAT = 'pscmlearn-model'
+MANIFEST_VERSION = 1
+
+
+def manifest_path(weights_path):
+    """
+    重みのファイル (.npz) に対応するマニフェストのパスを返す関数
+    """
+    return os.path.splitext(weights_path)[0] + '.json'
+
+
+def save_model(weights_path, model, ftels):
+    """
+    PscChain を、重み (.npz) とマニフェスト (.json) として保存する関数
+
+    Parameters
+    ----------
+    weights_path : str
+        重みの保存先 (.npz)。マニフェストは拡張子を .json にしたパスに保存する。
+    model : PscChain
+        保存するモデル
+    ftels : list
+        学習に使った (特徴名, ハイパーパラメータ) のタプルのリスト。特徴量の数が
+        モデルの入力の次元数と違えば、何も保存せずに ValueError を送出する。
+    """
+    W1 = model.l1.W.array
+    if W1.shape[1] != len(ftels):
+        raise ValueError("The model takes {} features but ftels has {}.".format(
+            W1.shape[1], len(ftels)))
+
+    psc.write_atomic(weights_path, model.export_npz)
+
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'version': MANIFEST_VERSION,
+        'weights': os.path.basename(weights_path),
+        'in_dim': int(W1.shape[1]),
+        'hid_dim': int(W1.shape[0]),
+        'out_dim': int(model.l3.W.array.shape[0]),
+        'classes': list(psc.classes),
+        'ftels': [[name, v] for name, v in ftels]
+    }
+
+    def write(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    psc.write_atomic(manifest_path(weights_path), write)
+
+
+def load_manifest(weights_path):
+    """
+    重みのファイルに対応するマニフェストを読み込む関数
+
+    Returns
+    -------
+    manifest : dict
+        マニフェストの内容。マニフェストがなければ None
+    """
+    path = manifest_path(weights_path)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError("{} is not a model manifest.".format(path))
+    if manifest.get('version', 0) > MANIFEST_VERSION:
+        raise ValueError("{} has a newer manifest version ({}) than supported ({}).".format(
+            path, manifest['version'], MANIFEST_VERSION))
+    if manifest['classes'] != list(psc.classes):
+        raise ValueError("{}: The model was trained with different classes.".format(path))
+    return manifest
+
+
+def check_features(manifest, ftels):
+    """
+    特徴量設定が、モデルの学習に使ったもの (マニフェストの ftels) と同じか確かめる関数
+
+    違えば、違いを説明する ValueError を送出する。
+    """
+    expected = [(name, float(v)) for name, v in manifest['ftels']]
+    actual = [(name, float(v)) for name, v in ftels]
+    if actual == expected:
+        return
+
+    expected_names = [x[0] for x in expected]
+    actual_names = [x[0] for x in actual]
+    missing = [x for x in expected_names if x not in actual_names]
+    extra = [x for x in actual_names if x not in expected_names]
+    if missing or extra:
+        detail = 'missing: {}, unexpected: {}'.format(missing or '-', extra or '-')
+    elif actual_names != expected_names:
+        detail = 'the order differs: expected {}'.format(expected_names)
+    else:
+        detail = 'the hyperparameters differ: expected {}'.format(expected)
+    raise ValueError("The feature setting doesn't match the model ({}).".format(detail))
@@ -0,0 +1,264 @@
+import os
+import shutil
+import struct
+import hashlib
+
+import numpy as np
+
+import psclib.psc as psc
+
+
+# キャッシュファイルの形式を変えたら上げる。
+CACHE_FORMAT_VERSION = 2
+
+# キャッシュディレクトリを指定する環境変数
+CACHE_DIR_ENV = 'PSC_TOKEN_CACHE'
+
+
+def janome_version():
+    """
+    Janome (とそれに同梱されたシステム辞書) のバージョンを返す関数
+    """
+    try:
+        from janome.version import JANOME_VERSION
+        return JANOME_VERSION
+    except ImportError:
+        return 'unknown'
+
+
+# ユーザー辞書のファイル -> ((更新時刻, サイズ), 内容のハッシュ)
+_user_dic_keys = {}
+
+
+def user_dic_key():
+    """
+    環境変数 PSC_USER_DIC で指定されたユーザー辞書の内容のハッシュを返す関数
+
+    指定されていなければ空文字列を返す。
+    """
+    names_file = os.environ.get(psc.USER_DIC_ENV)
+    if not names_file:
+        return ''
+    st = os.stat(names_file)
+    stamp = (st.st_mtime, st.st_size)
+    cached = _user_dic_keys.get(names_file)
+    if cached is None or cached[0] != stamp:
+        h = hashlib.sha1()
+        for name in psc.read_user_dic(names_file):
+            h.update(name.encode('utf-8'))
+            h.update(b'\n')
+        cached = (stamp, h.hexdigest())
+        _user_dic_keys[names_file] = cached
+    return cached[1]
+
+
+def script_key(lines):
+    """
+    台本の行 (str) のリストから、キャッシュのキーを作る関数
+
+    台本の内容のハッシュに、キャッシュ形式、Janome のバージョンとユーザー辞書を混ぜたもの。
+    """
+    h = hashlib.sha1()
+    h.update('{}:{}\n'.format(CACHE_FORMAT_VERSION, janome_version()).encode('utf-8'))
+    # (ユーザー辞書を使わない場合のキーは、ユーザー辞書に対応する前と同じにしておく)
+    udic = user_dic_key()
+    if udic:
+        h.update('udic:{}\n'.format(udic).encode('utf-8'))
+    for line in lines:
+        h.update(line.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+class TokenCache:
+    """
+    形態素解析の結果 (TokenLines) をディレクトリに保存しておくキャッシュ
+
+    台本の内容のハッシュと Janome のバージョンをキーとして、台本1冊につき
+    1ファイル (TokenLines.to_bytes() の形式) を保存する。
+    合計サイズが max_bytes を超えたら、最後に使われたのが古いものから消す。
+    """
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        cache_dir : str
+            キャッシュディレクトリ。なければ作る。
+        max_bytes : int
+            キャッシュの合計サイズの上限 (バイト)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        環境変数 PSC_TOKEN_CACHE で指定されたディレクトリのキャッシュを返す。
+        指定されていなければ None を返す。
+        """
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+        if not cache_dir:
+            return None
+        return cls(cache_dir)
+
+    def path(self, key):
+        """
+        キーに対応するキャッシュファイルのパスを返すメソッド
+        """
+        return os.path.join(self.cache_dir, key + '.tok')
+
+    def load(self, lines):
+        """
+        キャッシュから解析結果を読み込むメソッド
+
+        Returns
+        -------
+        token_lines : TokenLines
+            キャッシュになければ None
+        """
+        path = self.path(script_key(lines))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            token_lines = psc.TokenLines.from_bytes(data)
+        except (ValueError, KeyError, struct.error):
+            # 壊れたファイルは無視する。
+            return None
+        # 使われた時刻を更新する (LRU のため)。
+        os.utime(path)
+        return token_lines
+
+    def store(self, lines, token_lines):
+        """
+        解析結果をキャッシュに保存するメソッド
+        """
+        path = self.path(script_key(lines))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(token_lines.to_bytes())
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        合計サイズが上限を超えていたら、古いファイルから消すメソッド
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.tok'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class FeatureCache:
+    """
+    台本ごと・特徴量ごとに、抽出した特徴量の列を保存しておくキャッシュ
+
+    特徴量設定を一部だけ変えた時に、変わっていない特徴量の列を作り直さずに
+    済むようにする。台本の内容のハッシュごとにディレクトリを作り、その中に
+    特徴名ごとの列を .npy で保存する (特徴抽出した値の型のまま保存するので、
+    読み込んだ値は抽出した値と同じになる)。
+    ハイパーパラメータは特徴抽出に使われないので、キーには含めない。
+    特徴量の計算方法を変えたら CACHE_FORMAT_VERSION を上げること。
+    evict() を呼ぶと、合計サイズが max_bytes を超えていれば、最後に使われたのが
+    古い台本のディレクトリから消す (列を保存するたびには消さないので、まとめて
+    抽出し終わった後に呼ぶ)。
+    """
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        cache_dir : str
+            キャッシュディレクトリ。なければ作る。
+        max_bytes : int
+            キャッシュの合計サイズの上限 (バイト)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key, ftname):
+        """
+        キーと特徴名に対応するキャッシュファイルのパスを返すメソッド
+        """
+        return os.path.join(self.cache_dir, key, ftname + '.npy')
+
+    def load_column(self, key, ftname):
+        """
+        キャッシュから特徴量の列を読み込むメソッド
+
+        Returns
+        -------
+        column : numpy.ndarray
+            各行の特徴量の配列 (読み込み専用のメモリマップ)。キャッシュになければ None
+        """
+        try:
+            column = np.load(self.path(key, ftname), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        except (ValueError, OSError):
+            # 壊れたファイルは無視する。
+            return None
+        if column.ndim != 1:
+            return None
+        # 使われた時刻を更新する (LRU のため)。
+        os.utime(os.path.join(self.cache_dir, key))
+        return column
+
+    def store_column(self, key, ftname, column):
+        """
+        特徴量の列をキャッシュに保存するメソッド
+        """
+        path = self.path(key, ftname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        psc.save_array(path, np.asarray(column))
+
+    def evict(self):
+        """
+        合計サイズが上限を超えていたら、古い台本のディレクトリから消すメソッド
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir():
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, size, entry.path))
+            total += size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -1,3 +1,7 @@
+import time
+import queue
+import threading
+
 import numpy as np
 
 import chainer
@@ -10,6 +14,9 @@ from chainer.dataset import concat_examples
 
 from chainer.cuda import to_cpu, to_gpu
 
+from psclib import trace
+from psclib.psc import ArrayDataset, ShardDataset
+
 
 class PscChain(Chain):
     """
@@ -50,93 +57,184 @@ class PscChain(Chain):
         h2 = F.relu(self.l2(h1))
         return self.l3(h2)
     
+    def export_npz(self, path):
+        """
+        重みを NumpyPscModel で読み込める .npz ファイルに保存する
+
+        Parameters
+        ----------
+        path : str
+            保存先のパス
+        """
+        params = {}
+        for name in ('l1', 'l2', 'l3'):
+            link = getattr(self, name)
+            params[name + '_W'] = to_cpu(link.W.array)
+            params[name + '_b'] = to_cpu(link.b.array)
+        with open(path, 'wb') as f:
+            np.savez(f, **params)
+
     def train(self, *, dataset=None, batch_size=100, max_epoch=20, optimizer=None,
-        gpu_id=-1, verbose=True):
+        gpu_id=-1, verbose=True, n_prefetch=0, valid_every=1, patience=None):
         """
         学習用データを使って学習する
+
+        dataset が psc.ArrayDataset なら、ミニバッチは特徴量の行列から直接切り出す。
+        リストなら、最初に一度だけ float32 の行列 (ArrayDataset) にしてから使う。
+        n_prefetch が 1 以上なら、次の n_prefetch 個のミニバッチを GPU への転送まで含めて
+        バックグラウンドで用意しておく。
+        検証は valid_every エポックごと (と最後のエポック) に行う。patience を指定すると、
+        検証ロスが patience 回続けて最小値を更新しなかった時点で学習をやめ、検証ロスが
+        最小だった時のパラメータに戻す (早期終了)。検証用データがない場合は早期終了をせず、
+        検証ロスが nan (など) の回は、早期終了の判定に数えない (どちらも警告を表示する)。
+        verbose なら、エポックごとに、ミニバッチを待った時間 (data_wait) と、それが
+        エポックの所要時間に占める割合も表示する。
+
+        Returns
+        -------
+        history : list
+            検証ごとの {'epoch', 'val_loss', 'val_accuracy'} の辞書のリスト
         """
         if dataset is None:
             raise ValueError("dataset is required.")
 
         if optimizer is None:
             raise ValueError("optimizer is required.")
+
+        if valid_every < 1:
+            raise ValueError("valid_every must be 1 or more.")
+
+        if not isinstance(dataset, (ArrayDataset, ShardDataset)):
+            dataset = ArrayDataset.from_pairs(dataset)
         
         # 特徴量データと教師ラベルを対にして、学習用と検証用に分ける
         train_count = int(len(dataset) * 0.8) # 8割のデータを学習用に
-        ds_train, ds_valid = split_dataset_random(dataset, train_count, seed=0)
-
-        # 学習用イテレータ
-        train_iter = iterators.SerialIterator(ds_train, batch_size)
-        # 検証用イテレータ
-        valid_iter = iterators.SerialIterator(ds_valid, batch_size, repeat=False, shuffle=False)
+        ds_train, ds_valid = split_dataset(dataset, train_count, seed=0)
+        if patience is not None and len(ds_valid) == 0:
+            print('Warning: No validation data. Early stopping is disabled.')
+            patience = None
 
         # GPU を使うなら 0, 使わないなら -1
         if gpu_id >= 0:
             self.to_gpu(gpu_id)
         else:
             self.to_cpu()
+
+        history = []
+        best = None         # 検証ロスが最小だった時の {'epoch', 'val_loss', 'params'}
+        bad_count = 0       # 検証ロスが続けて最小値を更新しなかった回数
         
-        while train_iter.epoch < max_epoch:
-            # イテレーション
-            train_batch = train_iter.next()
-            
-            # バッチサイズ分の、入力データの array と、教師ラベルの array
-            x, t = concat_examples(train_batch, gpu_id)
-            x = x.astype(np.float32)
-            
-            # 順伝播の結果を得る
-            y = self(x)
-            
-            # ロスの計算
-            loss = F.softmax_cross_entropy(y, t)
-            
-            # 勾配の計算
-            self.cleargrads()
-            loss.backward()
-            
-            # パラメータの更新
-            optimizer.update()
-            
-            # 学習用のデータセットを一周したタイミングでのみ検証を実行
-            if train_iter.is_new_epoch:
-
-                # ロスの表示
-                # print('epoch:{:02d} train_loss:{:.04f} '.format(
-                #    train_iter.epoch, float(to_cpu(loss.data))), end='')
+        for epoch in range(1, max_epoch + 1):
+            epoch_start = time.perf_counter()
+            waits = []  # ミニバッチを待った時間
+            with trace.span('epoch', epoch=epoch):
+                # イテレーション
+                # バッチサイズ分の、入力データの array と、教師ラベルの array
+                batches = iterate_batches(ds_train, batch_size, shuffle=True, gpu_id=gpu_id,
+                    n_prefetch=n_prefetch)
+                for x, t in timed(batches, waits):
+                    with trace.span('batch'):
+                        # 順伝播の結果を得る
+                        y = self(x)
                 
-                valid_losses = []
-                valid_accuracies = []
-                while True:
-                    valid_batch = valid_iter.next()
-                    x_valid, t_valid = concat_examples(valid_batch, gpu_id)
-                    x_valid = x_valid.astype(np.float32)
-
-                    # Validation データを forward
-                    with chainer.using_config('train', False), \
-                            chainer.using_config('enable_backprop', False):
-                        y_valid = self(x_valid)
-                        
-                    # ロスを計算
-                    loss_valid = F.softmax_cross_entropy(y_valid, t_valid)
-                    valid_losses.append(to_cpu(loss_valid.array))
-
-                    # 精度を計算
-                    accuracy = F.accuracy(y_valid, t_valid)
-                    accuracy.to_cpu()
-                    valid_accuracies.append(accuracy.array)
+                        # ロスの計算
+                        loss = F.softmax_cross_entropy(y, t)
+                
+                        # 勾配の計算
+                        self.cleargrads()
+                        loss.backward()
+                
+                        # パラメータの更新
+                        optimizer.update()
 
-                    # 検証用のデータセットを一周したら終了
-                    if valid_iter.is_new_epoch:
-                        # 次回の検証に備えてイテレータをリセット
-                        valid_iter.reset()
-                        break
+            data_wait = sum(waits)
+            trace.emit('data_wait', epoch_start, data_wait, args={'count': len(waits)})
+            epoch_time = time.perf_counter() - epoch_start
+            wait_msg = 'data_wait:{:.02f}s ({:.0%})'.format(
+                data_wait, data_wait / epoch_time if epoch_time > 0 else 0)
 
-                # ロスと精度の表示
+            # 学習用のデータセットを valid_every 周したタイミングで検証を実行
+            if epoch % valid_every != 0 and epoch != max_epoch:
                 if (verbose):
-                    print('{:0=2} val_loss:{:.04f} val_accuracy:{:.04f}'.format(
-                        train_iter.epoch, np.mean(valid_losses), np.mean(valid_accuracies)))
+                    print('{:0=2} {}'.format(epoch, wait_msg))
+                continue
+
+            with trace.span('validate', epoch=epoch):
+                val_loss, val_accuracy = self.validate(
+                    ds_valid, batch_size, gpu_id=gpu_id, n_prefetch=n_prefetch)
+            history.append({'epoch': epoch, 'val_loss': val_loss, 'val_accuracy': val_accuracy})
+
+            # ロスと精度の表示
+            if (verbose):
+                print('{:0=2} val_loss:{:.04f} val_accuracy:{:.04f} {}'.format(
+                    epoch, val_loss, val_accuracy, wait_msg))
+
+            if patience is None:
+                continue
+
+            if not np.isfinite(val_loss):
+                print('Warning: val_loss is {} at epoch {}. Skipped for early stopping.'.format(
+                    val_loss, epoch))
+                continue
+
+            # 検証ロスが最小なら、その時のパラメータを (同じデバイス上に) 取っておく
+            if best is None or val_loss < best['val_loss']:
+                best = {
+                    'epoch': epoch,
+                    'val_loss': val_loss,
+                    'params': {name: param.array.copy() for name, param in self.namedparams()}
+                }
+                bad_count = 0
+            else:
+                bad_count += 1
+                if bad_count >= patience:
+                    if (verbose):
+                        print('Early stopping at epoch {}.'.format(epoch))
+                    break
+
+        # 検証ロスが最小だった時のパラメータに戻す
+        if best is not None:
+            for name, param in self.namedparams():
+                param.array[...] = best['params'][name]
+            if (verbose):
+                print('Restored the parameters of epoch {} (val_loss:{:.04f}).'.format(
+                    best['epoch'], best['val_loss']))
+
+        return history
+
+    def validate(self, dataset, batch_size=100, gpu_id=-1, n_prefetch=0):
+        """
+        検証用データでのロスと精度を返すメソッド
+
+        バッチごとのロスと精度はデバイス上で足していき、最後に一度だけ CPU に転送する。
 
-    def evaluate(self, *, dataset=None, batch_size=100, gpu_id=-1):
+        Returns
+        -------
+        val_loss : float
+            バッチごとのロスの平均
+        val_accuracy : float
+            バッチごとの精度の平均
+        """
+        xp = self.xp
+        total = xp.zeros(2, dtype=np.float32)   # ロスと精度の合計
+        count = 0
+        for x, t in iterate_batches(dataset, batch_size, gpu_id=gpu_id, n_prefetch=n_prefetch):
+            # Validation データを forward
+            with chainer.using_config('train', False), \
+                    chainer.using_config('enable_backprop', False):
+                y = self(x)
+                
+                # ロスと精度を計算
+                total[0] += F.softmax_cross_entropy(y, t).array
+                total[1] += F.accuracy(y, t).array
+            count += 1
+
+        if count == 0:
+            return float('nan'), float('nan')
+        total = to_cpu(total) / count
+        return float(total[0]), float(total[1])
+
+    def evaluate(self, *, dataset=None, batch_size=100, gpu_id=-1, n_prefetch=0):
         """
         評価用データを使って評価する
 
@@ -148,28 +246,187 @@ class PscChain(Chain):
         if dataset is None:
             raise ValueError("dataset is required.")
 
-        # 評価用イテレータ
-        iter = iterators.SerialIterator(dataset, batch_size, repeat=False, shuffle=False)
-
         # 評価用データでの評価
         accuracies = []
-        while True:
-            batch = iter.next()
-            x, t = concat_examples(batch, gpu_id)
-            x = x.astype(np.float32)
-            
-            # 評価用データをforward
-            with chainer.using_config('train', False), \
-                    chainer.using_config('enable_backprop', False):
-                y = self(x)
-            
-            # 精度を計算
-            accuracy = F.accuracy(y, t)
-            accuracy.to_cpu()
-            accuracies.append(accuracy.array)
-
-            if iter.is_new_epoch:
-                iter.reset()
-                break
+        with trace.span('evaluate'):
+            for x, t in iterate_batches(dataset, batch_size, gpu_id=gpu_id, n_prefetch=n_prefetch):
+                with trace.span('batch'):
+                    # 評価用データをforward
+                    with chainer.using_config('train', False), \
+                            chainer.using_config('enable_backprop', False):
+                        y = self(x)
+                    
+                    # 精度を計算
+                    accuracy = F.accuracy(y, t)
+                    accuracy.to_cpu()
+                    accuracies.append(accuracy.array)
         
         return accuracies
+
+
+def split_dataset(dataset, first_size, seed=None):
+    """
+    データセットをランダムに二つに分ける関数
+
+    split_dataset_random() と同じ分け方をするが、psc.ArrayDataset なら
+    行列のまま (ArrayDataset として) 分ける。psc.ShardDataset ならシャード単位で分ける
+    (シャードが一つなら行単位)。
+    """
+    if isinstance(dataset, ShardDataset):
+        return dataset.split(first_size, seed=seed)
+    if isinstance(dataset, ArrayDataset):
+        order = np.random.RandomState(seed).permutation(len(dataset))
+        return dataset.take(order[:first_size]), dataset.take(order[first_size:])
+    return split_dataset_random(dataset, first_size, seed=seed)
+
+
+def iterate_batches(dataset, batch_size, shuffle=False, gpu_id=-1, n_prefetch=0):
+    """
+    データセットを一周する間、ミニバッチを返すジェネレータ
+
+    psc.ArrayDataset なら行列から直接切り出し、psc.ShardDataset ならシャードを
+    バックグラウンドのスレッドで読み込みながら切り出す。それ以外は SerialIterator と
+    concat_examples でまとめる。
+    n_prefetch が 1 以上なら、次の n_prefetch 個のミニバッチを、GPU への転送まで含めて
+    バックグラウンドのスレッドで用意しておく (GPU の計算と、次のミニバッチの用意を重ねる)。
+
+    Yields
+    ------
+    x : numpy.ndarray or cupy.ndarray
+        (バッチサイズ x 特徴ベクトルの次元数) の float32 の入力データ
+    t : numpy.ndarray or cupy.ndarray
+        教師ラベル
+    """
+    batches = iterate_host_batches(dataset, batch_size, shuffle)
+    if n_prefetch > 0:
+        yield from prefetch(to_device(batches, gpu_id, async_copy=True), n_prefetch)
+    elif isinstance(dataset, ShardDataset):
+        # シャードの読み込みだけはバックグラウンドで行う
+        yield from to_device(prefetch(batches), gpu_id)
+    else:
+        yield from to_device(batches, gpu_id)
+
+
+def iterate_host_batches(dataset, batch_size, shuffle=False):
+    """
+    データセットを一周する間、CPU 上のミニバッチ (float32 の入力データと教師ラベル) を返すジェネレータ
+    """
+    if isinstance(dataset, ArrayDataset):
+        n = len(dataset)
+        order = np.random.permutation(n) if shuffle else None
+        for start in range(0, n, batch_size):
+            if order is None:
+                x = np.asarray(dataset.features[start:start + batch_size])
+                t = np.asarray(dataset.labels[start:start + batch_size])
+            else:
+                idx = order[start:start + batch_size]
+                x = dataset.features[idx]
+                t = dataset.labels[idx]
+            yield x, t
+        return
+
+    if isinstance(dataset, ShardDataset):
+        yield from dataset.iter_batches(batch_size, shuffle)
+        return
+
+    iter = iterators.SerialIterator(dataset, batch_size, repeat=False, shuffle=shuffle)
+    for batch in iter:
+        x, t = concat_examples(batch)
+        yield x.astype(np.float32), t
+
+
+def to_device(batches, gpu_id=-1, async_copy=False):
+    """
+    ミニバッチを GPU に転送しながら返すジェネレータ (gpu_id が -1 ならそのまま返す)
+
+    async_copy が True なら、ページロックされた (pinned) メモリを経由して、専用の
+    CUDA ストリームで転送する。転送が終わるのを待ってから返すので、別のスレッドで
+    動かしても、返した配列はすぐに使える。
+    """
+    if gpu_id < 0:
+        yield from batches
+        return
+
+    if not async_copy:
+        for x, t in batches:
+            yield to_gpu(x, gpu_id), to_gpu(t, gpu_id)
+        return
+
+    import cupy
+    with cupy.cuda.Device(gpu_id):
+        stream = cupy.cuda.Stream(non_blocking=True)
+        for batch in batches:
+            device_arrays = []
+            pinned_arrays = []  # 転送が終わるまで参照を持っておく
+            for a in batch:
+                a = np.ascontiguousarray(a)
+                mem = cupy.cuda.alloc_pinned_memory(a.nbytes)
+                pinned = np.frombuffer(mem, a.dtype, a.size).reshape(a.shape)
+                pinned[...] = a
+                d = cupy.empty(a.shape, a.dtype)
+                d.set(pinned, stream=stream)
+                device_arrays.append(d)
+                pinned_arrays.append(pinned)
+            stream.synchronize()
+            yield tuple(device_arrays)
+
+
+def timed(iterable, waits):
+    """
+    iterable の要素を返しながら、次の要素を待った時間 (秒) を waits に足していくジェネレータ
+    """
+    it = iter(iterable)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        waits.append(time.perf_counter() - t0)
+        yield item
+
+
+def prefetch(iterable, size=2):
+    """
+    iterable の要素を、バックグラウンドのスレッドで size 個先まで作っておくジェネレータ
+
+    iterable の中で起きた例外は、呼び出し側で改めて送出する。
+    途中でやめた場合 (ジェネレータが閉じられた場合) は、スレッドも止める。
+    """
+    q = queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # 呼び出し側がやめたら、空きを待たずに終わる。
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
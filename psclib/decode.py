@@ -0,0 +1,278 @@
+"""
+行の種類の並びに制約をかけて、台本全体で最もありそうなラベルの並びを求める (制約付きデコード)
+
+各行の出力 (softmax をかける前の値) を対数確率にして、制約を満たすラベルの並びのうち
+対数確率の和が最大のものを、Viterbi アルゴリズム (動的計画法) で求める。
+
+制約は Constraints で表す。
+- 遷移の制約 : ある行の種類の直後に、ある行の種類が来てはいけない (遷移の表)
+- 先頭の制約 : 台本の先頭に来てはいけない行の種類
+- 以降の制約 : ある行の種類が一度出たら、それ以降はある行の種類が来てはいけない
+  (「タイトル行は1行のみ」など)。以降の制約は「もう出たか」のフラグとして状態に持たせる
+  ので、一つ増やすごとに状態の数が2倍になる。
+
+制約のファイルは、1行に1つの制約を書く。# 以降はコメント。行の種類の代わりに * と書くと、
+すべての行の種類を表す。
+    forbid 前の行の種類 次の行の種類       (直後に来てはいけない)
+    only_after 行の種類 前の行の種類 ...   (直前が、前の行の種類のいずれかでなければならない)
+    forbid_start 行の種類                  (先頭に来てはいけない)
+    never_after きっかけの行の種類 行の種類 (きっかけが出たら、それ以降は来てはいけない)
+    once 行の種類                          (台本内に1行まで。never_after 行の種類 行の種類 と同じ)
+"""
+
+import numpy as np
+
+import psclib.psc as psc
+
+
+# *_CONTINUED の行の種類 -> その前に来るべき行の種類
+continued_of = {
+    'CHARACTER_CONTINUED': 'CHARACTER',
+    'DIRECTION_CONTINUED': 'DIRECTION',
+    'DIALOGUE_CONTINUED': 'DIALOGUE',
+    'COMMENT_CONTINUED': 'COMMENT'
+}
+
+
+class Constraints:
+    """
+    行の種類の並びに対する制約
+    """
+
+    def __init__(self):
+        """
+        コンストラクタ (制約のない状態で作る)
+        """
+        n = len(psc.classes)
+        self.transitions = np.ones((n, n), dtype=bool)  # [前の行, 次の行] の遷移を許すか
+        self.start = np.ones(n, dtype=bool)             # 先頭に来てよいか
+        self.after_rules = []   # (きっかけの行の種類のマスク, 来てはいけない行の種類のマスク)
+
+    @staticmethod
+    def _indexes(label):
+        """
+        行の種類の名前 (または *) から、classes のインデックスのリストを返す
+        """
+        if label == '*':
+            return list(range(len(psc.classes)))
+        if label not in psc.classes:
+            raise ValueError("Class '{}' not defined.".format(label))
+        return [psc.classes.index(label)]
+
+    def forbid(self, prev, label):
+        """
+        prev の直後に label が来ることを禁止するメソッド
+        """
+        for i in self._indexes(prev):
+            self.transitions[i, self._indexes(label)] = False
+
+    def only_after(self, label, prevs):
+        """
+        label の直前を、prevs のいずれかに限るメソッド
+        """
+        allowed = np.zeros(len(psc.classes), dtype=bool)
+        for prev in prevs:
+            allowed[self._indexes(prev)] = True
+        for j in self._indexes(label):
+            self.transitions[~allowed, j] = False
+
+    def forbid_start(self, label):
+        """
+        台本の先頭に label が来ることを禁止するメソッド
+        """
+        self.start[self._indexes(label)] = False
+
+    def never_after(self, trigger, label):
+        """
+        trigger が出たら、それ以降は label が来ることを禁止するメソッド
+        """
+        triggers = np.zeros(len(psc.classes), dtype=bool)
+        triggers[self._indexes(trigger)] = True
+        banned = np.zeros(len(psc.classes), dtype=bool)
+        banned[self._indexes(label)] = True
+        self.after_rules.append((triggers, banned))
+
+    def once(self, label):
+        """
+        label を台本内に1行までにするメソッド
+        """
+        self.never_after(label, label)
+
+    @classmethod
+    def default(cls):
+        """
+        既定の制約を返す
+
+        - *_CONTINUED は、その元の行の種類か、同じ *_CONTINUED の直後にしか来ない
+          (台本の先頭にも来ない)。
+        - タイトル行は1行のみ。
+        - セリフ行の後に登場人物行はない。
+        """
+        c = cls()
+        for label, base in continued_of.items():
+            c.only_after(label, [base, label])
+            c.forbid_start(label)
+        c.once('TITLE')
+        c.never_after('DIALOGUE', 'CHARACTER')
+        return c
+
+    @classmethod
+    def load(cls, path):
+        """
+        制約のファイルを読み込む (書式はモジュールの説明を参照)
+        """
+        c = cls()
+        with open(path, 'r', encoding='utf_8_sig') as f:
+            for i, line in enumerate(f):
+                words = line.split('#')[0].split()
+                if not words:
+                    continue
+                op, args = words[0], words[1:]
+                if op == 'forbid' and len(args) == 2:
+                    c.forbid(*args)
+                elif op == 'only_after' and len(args) >= 2:
+                    c.only_after(args[0], args[1:])
+                elif op == 'forbid_start' and len(args) == 1:
+                    c.forbid_start(args[0])
+                elif op == 'never_after' and len(args) == 2:
+                    c.never_after(*args)
+                elif op == 'once' and len(args) == 1:
+                    c.once(args[0])
+                else:
+                    raise ValueError("{}: Line {} is not a valid constraint.".format(path, i+1))
+        return c
+
+    def is_valid(self, labels):
+        """
+        ラベル (classes のインデックス) の並びが、制約を満たすかを返すメソッド
+        """
+        labels = np.asarray(labels)
+        if len(labels) == 0:
+            return True
+        if not self.start[labels[0]]:
+            return False
+        if not self.transitions[labels[:-1], labels[1:]].all():
+            return False
+        for triggers, banned in self.after_rules:
+            hits = np.flatnonzero(triggers[labels])
+            if len(hits) > 0 and banned[labels[hits[0] + 1:]].any():
+                return False
+        return True
+
+    def expand(self):
+        """
+        「以降の制約」のフラグを状態に含めた、Viterbi アルゴリズム用の表を作るメソッド
+
+        状態は (フラグ, 行の種類) の組。先頭の状態からたどり着けない状態は除く。
+
+        Returns
+        -------
+        trans : numpy.ndarray
+            (状態数 x 状態数) の、遷移を許すかの表
+        start : numpy.ndarray
+            状態ごとの、先頭の状態になれるか
+        state_labels : numpy.ndarray
+            状態ごとの行の種類 (classes のインデックス)
+        """
+        n = len(psc.classes)
+        n_flags = 1 << len(self.after_rules)
+        state_labels = np.tile(np.arange(n), n_flags)
+        state_flags = np.repeat(np.arange(n_flags), n)
+
+        # 行の種類ごとの、その行で立つフラグと、フラグごとの来てはいけない行の種類
+        sets = np.zeros(n, dtype=np.int64)
+        banned_by = np.zeros((n_flags, n), dtype=bool)
+        for k, (triggers, banned) in enumerate(self.after_rules):
+            sets[triggers] |= 1 << k
+            banned_by[(np.arange(n_flags) >> k) & 1 == 1] |= banned
+
+        # 次の状態のフラグは、前の状態のフラグと次の行で立つフラグを合わせたもの
+        next_flags = state_flags[:, None] | sets[None, state_labels]
+        trans = (self.transitions[state_labels[:, None], state_labels[None, :]]
+            & (next_flags == state_flags[None, :])
+            & ~banned_by[state_flags[:, None], state_labels[None, :]])
+        start = self.start[state_labels] & (state_flags == sets[state_labels])
+
+        # 先頭の状態からたどり着ける状態だけを残す
+        reachable = start.copy()
+        while True:
+            grown = reachable | trans[reachable].any(axis=0)
+            if (grown == reachable).all():
+                break
+            reachable = grown
+        return trans[np.ix_(reachable, reachable)], start[reachable], state_labels[reachable]
+
+
+def log_softmax(logits):
+    """
+    各行の出力 (softmax をかける前の値) を、対数確率にする関数
+    """
+    x = np.asarray(logits, dtype=np.float64)
+    x = x - x.max(axis=1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=1, keepdims=True))
+
+
+def viterbi(logits, constraints=None):
+    """
+    制約を満たすラベルの並びのうち、対数確率の和が最大のものを返す関数
+
+    制約なしで各行の最大値を取った並びが制約を満たしていれば、それが答えなので、
+    そのまま返す。
+
+    Parameters
+    ----------
+    logits : numpy.ndarray
+        (行数 x 行の種類の数) の、各行の出力 (softmax をかける前の値)
+    constraints : Constraints
+        制約。省略すると既定の制約 (Constraints.default())
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        各行のラベル (classes のインデックス)
+    """
+    if constraints is None:
+        constraints = Constraints.default()
+    labels = np.asarray(logits).argmax(axis=1)
+    if constraints.is_valid(labels):
+        return labels
+
+    trans, start, state_labels = constraints.expand()
+    emit = log_softmax(logits)[:, state_labels]
+    n_lines, n_states = emit.shape
+
+    # 遷移の表の列 (次の状態から見た、来てよい前の状態の集合) は、同じものが多いので
+    # まとめて、まとまりごとに前の状態のスコアの最大値を取る。
+    # 来てよい前の状態がないまとまりには、スコアが常に -inf の番兵 (n_states) を入れる。
+    groups, group_of = np.unique(trans.T, axis=0, return_inverse=True)
+    group_of = group_of.ravel()
+    members = [np.flatnonzero(g) if g.any() else np.array([n_states]) for g in groups]
+    sizes = [len(m) for m in members]
+    bounds = np.cumsum([0] + sizes[:-1])
+    members = np.concatenate(members)
+
+    scores = np.empty((n_lines, n_states + 1))
+    scores[:, n_states] = -np.inf
+    scores[0, :n_states] = np.where(start, emit[0], -np.inf)
+    for t in range(1, n_lines):
+        best = np.maximum.reduceat(scores[t - 1].take(members), bounds)
+        np.add(emit[t], best.take(group_of), out=scores[t, :n_states])
+
+    last = scores[-1, :n_states]
+    if not np.isfinite(last.max()):
+        raise ValueError("No label sequence satisfies the constraints.")
+
+    # 各行・各まとまりで最大値を取った前の状態 (同点なら先のもの) を、まとめて求める
+    cand = scores[:-1].take(members, axis=1)
+    best = np.maximum.reduceat(cand, bounds, axis=1)
+    member_group = np.repeat(np.arange(len(sizes)), sizes)
+    pos = np.where(cand == best[:, member_group], np.arange(len(members)), len(members))
+    back = members[np.minimum.reduceat(pos, bounds, axis=1)].tolist()
+
+    # 最後の行から、たどってきた状態を逆にたどる
+    group_of = group_of.tolist()
+    states = [0] * n_lines
+    states[-1] = int(last.argmax())
+    for t in range(n_lines - 1, 0, -1):
+        states[t - 1] = back[t - 1][group_of[states[t]]]
+    return state_labels[states]
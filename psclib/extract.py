@@ -1,9 +1,47 @@
+import time
+
 import psclib.psc as psc
-import copy
+from psclib import trace
+from psclib.cache import script_key
+from psclib.features import line_inputs, first_pos, needs_tokens, get_feature, context_margin
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def make_extractor(lines, ftels, tokenizer=None, cache=None, stats=None, pool=None):
+    """
+    行のリストから Extractor を作る関数
+
+    ftels に形態素解析の結果を使う特徴量がある時だけ形態素解析をする。なければ、
+    行の文字列だけから特徴抽出する Extractor を作る。
+
+    Parameters
+    ----------
+    lines : list
+        行 (str) のリスト
+    ftels : list
+        (特徴名, ハイパーパラメータ) のタプルのリスト
+    tokenizer : janome.tokenizer.Tokenizer
+        使う Tokenizer。省略するとプロセス内で共有のものを使う。
+    cache : psclib.cache.TokenCache
+        形態素解析結果のキャッシュ
+    stats : ScriptStats
+        台本全体に関する統計 (Extractor を参照)
+    pool : psclib.tokenpool.TokenizerPool
+        形態素解析を並列に行うプール
+
+    Returns
+    -------
+    ex : Extractor
+    """
+    token_lines = None
+    if needs_tokens(ftels):
+        token_lines = psc.tokenize_lines(lines, tokenizer, cache, pool)
+    return Extractor(token_lines, ftels, stats, texts=lines)
 
 
-def extract_file(in_file, fts_file):
+def extract_file(in_file, fts_file=None, *, ftels=None, tokenizer=None, cache=None,
+        ft_cache=None, pool=None, as_array=False):
     """
     ファイルの内容を特徴量にして返す
     
@@ -12,29 +50,289 @@ def extract_file(in_file, fts_file):
     in_file : str
         入力となるファイルの名前
     fts_file : str
-        特徴量設定ファイルの名前
+        特徴量設定ファイルの名前。ftels を渡す場合は不要。
+    ftels : list
+        読み込み済みの (特徴名, ハイパーパラメータ) のタプルのリスト
+    tokenizer : janome.tokenizer.Tokenizer
+        使う Tokenizer。省略するとプロセス内で共有のものを使う。
+    cache : psclib.cache.TokenCache
+        形態素解析結果のキャッシュ
+    ft_cache : psclib.cache.FeatureCache
+        特徴量の列のキャッシュ。キャッシュにない特徴量だけを抽出する。
+    pool : psclib.tokenpool.TokenizerPool
+        形態素解析を並列に行うプール。省略するとこのプロセスで形態素解析する。
+    as_array : bool
+        True なら、リストの代わりに (行数 x 特徴量の数) の float32 の行列を返す。
+        キャッシュにある列は、Python のリストにせずにそのまま行列に並べる。
     
     Returns
     -------
     ft_list : list
-        各行の特徴ベクトル (リスト) のリスト
+        各行の特徴ベクトル (リスト) のリスト (as_array が True なら numpy.ndarray)
     """
 
     # 入力データをリストに
     with open(in_file, 'r', encoding='utf_8_sig') as f:
         lines = [l.rstrip() for l in f.readlines()]
 
-    # 形態素解析
-    token_lines = psc.tokenize_lines(lines)
+    # 特徴量の設定を読み込む
+    if ftels is None:
+        ftels = psc.read_feature_elements(fts_file)
+
+    if ft_cache is None:
+        # 形態素解析 (必要な場合だけ) と特徴抽出
+        ex = make_extractor(lines, ftels, tokenizer, cache, pool=pool)
+        return ex.extract_array() if as_array else ex.extract()
+
+    # キャッシュにある特徴量の列を読み込む
+    key = script_key(lines)
+    columns = {ftel[0]: ft_cache.load_column(key, ftel[0]) for ftel in ftels}
+
+    # キャッシュになかった特徴量だけを抽出して、キャッシュに保存する
+    missing = [ftel for ftel in ftels if columns[ftel[0]] is None]
+    if missing:
+        ex = make_extractor(lines, missing, tokenizer, cache, pool=pool)
+        rows = ex.extract()
+        for i, ftel in enumerate(missing):
+            column = np.array([row[i] for row in rows])
+            ft_cache.store_column(key, ftel[0], column)
+            columns[ftel[0]] = column
+
+    if as_array:
+        ft_array = np.zeros((len(lines), len(ftels)), dtype=np.float32)
+        for j, ftel in enumerate(ftels):
+            ft_array[:, j] = columns[ftel[0]]
+        return ft_array
+
+    # 列を行ごとの特徴ベクトルに並べ直す
+    ft_list = [list(row) for row in zip(*[columns[ftel[0]].tolist() for ftel in ftels])]
+    if not ftels:
+        ft_list = [[] for _ in lines]
+
+    return ft_list
+
+
+def scan_file(in_file, ftels, tokenizer=None):
+    """
+    ファイルを1行ずつ読んで、台本全体に関する統計だけを集める (ストリーミング抽出の1パス目)
+
+    形態素解析の結果は保持しない。形態素解析が必要な台本レベルの特徴量が
+    ftels になければ、形態素解析もしない。
+
+    Parameters
+    ----------
+    in_file : str
+        入力となるファイルの名前
+    ftels : list
+        (特徴名, ハイパーパラメータ) のタプルのリスト
+    tokenizer : janome.tokenizer.Tokenizer
+        使う Tokenizer。省略するとプロセス内で共有のものを使う。
+
+    Returns
+    -------
+    stats : ScriptStats
+        台本全体に関する統計
+    """
+    # 前後の行の特徴量は、元の特徴量と同じ統計を使う。
+    ftnames = [(get_feature(ftel[0]).base or get_feature(ftel[0])).name for ftel in ftels]
+    with_heads = 'ln_length_of_common_head' in ftnames
+    need_tokens = with_heads or 'sc_count_of_lines_with_bracket' in ftnames
+    if need_tokens and tokenizer is None:
+        tokenizer = psc.get_tokenizer()
+
+    stats = ScriptStats(with_heads)
+    with open(in_file, 'r', encoding='utf_8_sig') as f:
+        for line in f:
+            if need_tokens:
+                stats.add_line([(token.surface, token.part_of_speech)
+                    for token in tokenizer.tokenize(line.rstrip())])
+            else:
+                stats.count_of_lines += 1
+    return stats
+
+
+def iter_extract_file(in_file, fts_file=None, *, ftels=None, chunk_lines=1000, tokenizer=None,
+        pool=None):
+    """
+    ファイルの内容を、chunk_lines 行ずつ特徴量にして返すジェネレータ
+
+    1パス目 (scan_file()) で台本全体に関する統計を集め、2パス目で chunk_lines 行ずつ
+    形態素解析と特徴抽出をする。台本全体の形態素解析の結果を保持しないので、
+    巨大なファイルでもメモリ使用量が一定に収まる (その代わり、台本レベルの特徴量や
+    共通の行頭を使う場合は、形態素解析を2回することになる)。
+    前後の行の特徴量を使う場合は、チャンクの前後に参照する行数分の行を付けて特徴抽出する。
 
+    Parameters
+    ----------
+    in_file : str
+        入力となるファイルの名前
+    fts_file : str
+        特徴量設定ファイルの名前。ftels を渡す場合は不要。
+    ftels : list
+        読み込み済みの (特徴名, ハイパーパラメータ) のタプルのリスト
+    chunk_lines : int
+        一度に処理する行数
+    tokenizer : janome.tokenizer.Tokenizer
+        使う Tokenizer。省略するとプロセス内で共有のものを使う。
+    pool : psclib.tokenpool.TokenizerPool
+        2パス目の形態素解析を並列に行うプール
+
+    Yields
+    ------
+    lines : list
+        処理した行 (str) のリスト
+    ft_array : numpy.ndarray
+        (行数 x 特徴量の数) の float32 の行列
+    """
     # 特徴量の設定を読み込む
-    ftels = psc.read_feature_elements(fts_file)
+    if ftels is None:
+        ftels = psc.read_feature_elements(fts_file)
+
+    # 1パス目 : 台本全体に関する統計
+    stats = scan_file(in_file, ftels, tokenizer)
+
+    # 2パス目 : chunk_lines 行ずつ特徴抽出
+    before, after = context_margin(ftels)
+    history = []    # 前のチャンクまでの最後の before 行
+    pending = []    # まだ特徴抽出していない行
+
+    def extract_chunk():
+        nonlocal history, pending
+        lines = pending[:chunk_lines]
+        tail = pending[chunk_lines:chunk_lines + after]
+        ex = make_extractor(history + lines + tail, ftels, tokenizer, stats=stats, pool=pool)
+        ft_array = ex.extract_array()[len(history):len(history) + len(lines)]
+        history = (history + lines)[max(0, len(history) + len(lines) - before):]
+        pending = pending[chunk_lines:]
+        return lines, ft_array
 
-    # 特徴抽出・保存
-    ex = Extractor(token_lines, ftels)
-    ft_list = ex.extract()
+    with open(in_file, 'r', encoding='utf_8_sig') as f:
+        for line in f:
+            pending.append(line.rstrip())
+            if len(pending) >= chunk_lines + after:
+                yield extract_chunk()
+    while pending:
+        yield extract_chunk()
 
-    return ft_list
+
+def first_pos_by_line(line_idx, pos_idx, n):
+    """
+    各行で最初に出現する位置 (単語または文字の位置) から、「早さ」の配列を作る関数
+
+    Parameters
+    ----------
+    line_idx : numpy.ndarray
+        出現した単語 (文字) ごとの行番号 (行順に並んでいること)
+    pos_idx : numpy.ndarray
+        出現した単語 (文字) ごとの行内の位置
+    n : int
+        行数
+
+    Returns
+    -------
+    column : numpy.ndarray
+        位置 (0, 1, ...) を x とし、e^(-x/4) の値。出現しない行では 0.
+    """
+    # 行順に並んでいるので、各行で最初に現れるものが最初の出現位置。
+    lnums, first = np.unique(line_idx, return_index=True)
+    column = np.zeros(n)
+    column[lnums] = np.exp(-pos_idx[first] / 4)
+    return column
+
+
+def shift_column(column, offsets, pad=0):
+    """
+    各行について、offsets の各行数だけずらした行の値を並べた行列を返す関数
+
+    column の前後を pad で埋めてから、前後の行を含む窓を1行ずつずらしたビュー
+    (コピーしない) を作り、各オフセットの位置を取り出す。
+
+    Parameters
+    ----------
+    column : numpy.ndarray
+        各行の値
+    offsets : list
+        ずらす行数のリスト。負なら前の行、正なら後の行。
+    pad : int
+        台本の外の行の値
+
+    Returns
+    -------
+    shifted : numpy.ndarray
+        (行数 x オフセットの数) の行列
+    """
+    column = np.asarray(column)
+    before = max([0] + [-x for x in offsets])
+    after = max([0] + list(offsets))
+    padded = np.concatenate([np.full(before, pad, dtype=column.dtype), column,
+        np.full(after, pad, dtype=column.dtype)])
+    step = padded.strides[0]
+    windows = as_strided(padded, shape=(len(column), before + after + 1), strides=(step, step),
+        writeable=False)
+    return windows[:, np.asarray(offsets, dtype=np.int64) + before]
+
+
+class ScriptStats:
+    """
+    台本全体に関する統計
+
+    台本レベルの特徴量 (行数、括弧を含む行の数) と、共通の行頭を数えるための
+    トライ木を持つ。トライ木の各ノードは [その行頭を持つ行数, 子ノードの辞書] という
+    リストで、子ノードの辞書のキーは (表層形, 品詞) のタプル。
+    """
+
+    def __init__(self, with_heads=True):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        with_heads : bool
+            共通の行頭を数えるためのトライ木を作るか
+        """
+        self.count_of_lines = 0
+        self.count_of_lines_with_bracket = 0
+        self.head_trie = [0, {}] if with_heads else None
+
+    @classmethod
+    def from_token_lines(cls, token_lines, with_heads=True):
+        """
+        TokenLines (台本1冊分) から統計を作る
+        """
+        stats = cls(with_heads)
+        surfaces = token_lines.surfaces
+        parts_of_speech = token_lines.parts_of_speech
+        for lnum in range(len(token_lines)):
+            stats.add_line([(surfaces[s], parts_of_speech[p]) for s, p in zip(
+                token_lines.line_surface_ids(lnum), token_lines.line_pos_ids(lnum))])
+        return stats
+
+    def add_line(self, words):
+        """
+        1行分の単語を統計に加えるメソッド
+
+        Parameters
+        ----------
+        words : list
+            (表層形, 品詞) のタプルのリスト
+        """
+        self.count_of_lines += 1
+        for surface, _ in words:
+            if surface in psc.brackets:
+                self.count_of_lines_with_bracket += 1
+                break
+
+        if self.head_trie is None:
+            return
+        node = self.head_trie
+        node[0] += 1
+        for key in words:
+            child = node[1].get(key)
+            if child is None:
+                child = [0, {}]
+                node[1][key] = child
+            child[0] += 1
+            node = child
 
 
 class Extractor:
@@ -42,15 +340,70 @@ class Extractor:
     特徴量を抽出するクラス
     """
     
-    def __init__(self, lines, ftels):
+    def __init__(self, lines, ftels, stats=None, texts=None):
         """
         コンストラクタ
+
+        Parameters
+        ----------
+        lines : TokenLines
+            形態素解析された行。形態素解析の結果を使う特徴量がなければ None でもよい
+            (その場合は texts を渡す)。
+        ftels : list
+            (特徴名, ハイパーパラメータ) のタプルのリスト
+        stats : ScriptStats
+            台本全体に関する統計。lines が台本の一部の場合に、台本全体について
+            集めたものを渡す。省略すると lines から作る。
+        texts : list
+            形態素解析する前の行 (str) のリスト。省略すると lines から作る。
         """
-        self.lines = lines # 形態素解析された行のリスト (台本1冊分)
+        # 形態素解析された行 (台本1冊分)
+        # 従来の辞書形式のリストが渡されたら TokenLines に変換する。
+        if lines is not None and not isinstance(lines, psc.TokenLines):
+            lines = psc.TokenLines.from_dicts(lines)
+        if lines is None and texts is None:
+            raise ValueError("Either lines or texts must be given.")
+        self.lines = lines
         self.ftels = ftels # (特徴名, ハイパーパラメータ) のタプルのリスト
 
-        # 抽出中に使うワーク変数
-        self.common_heads = [] # (よくある行頭, 出現行数) のタプルのリスト
+        # 形態素解析する前の行 (文字単位の特徴量に使う)
+        self.raw_texts = texts
+
+        # 台本全体に関する統計 (省略されたら get_stats() で作る)
+        self.stats = stats
+        # lines が台本の一部で、統計が台本全体について集めたものか
+        self.partial = stats is not None
+
+        # 特徴名から引いた、特徴量ごとの Feature の表 (ftels の順)
+        self.dispatch = []
+        for ftel in ftels:
+            feature = get_feature(ftel[0])
+            self.dispatch.append(feature)
+            if lines is None and feature.needs_tokens:
+                raise ValueError("Feature '{}' needs tokenized lines.".format(ftel[0]))
+
+        # 前後の行の特徴量の列を作るために計算する、元の特徴量 (重複なし)
+        self.bases = []
+        for feature in self.dispatch:
+            base = feature.base
+            if base is not None and base not in self.dispatch and base not in self.bases:
+                self.bases.append(base)
+
+        # 設定された特徴量が必要とする、行ごとの入力の名前 (重複なし)
+        self.input_names = []
+        for feature in self.dispatch:
+            for name in feature.inputs:
+                if name not in self.input_names:
+                    self.input_names.append(name)
+
+        # 計測が有効な時に、行ごとの入力と特徴量の所要時間を足していく辞書
+        # (名前 -> [呼び出し回数, 合計時間])
+        self.line_times = {}
+
+    def __len__(self):
+        if self.lines is not None:
+            return len(self.lines)
+        return len(self.raw_texts)
     
     def extract(self):
         """
@@ -61,19 +414,305 @@ class Extractor:
         ft_list : list
             各行の特徴ベクトル (リスト) のリスト
         """
-        ft_list = []
-        for lnum in range(len(self.lines)):
-            ft_list.append(self.extract_line(lnum))
+        start = time.perf_counter()
+        with trace.span('extract', lines=len(self)):
+            if not self.has_context():
+                ft_list = []
+                for lnum in range(len(self)):
+                    ft_list.append(self.extract_line(lnum))
+            else:
+                # 前後の行の特徴量以外 (と、その元の特徴量) を行ごとに計算してから、
+                # 前後の行の特徴量の列を、元の特徴量の列をずらして作る。
+                dispatch = [f for f in self.dispatch if f.base is None] + self.bases
+                rows = [self.extract_line(lnum, dispatch) for lnum in range(len(self))]
+                columns = {f.name: [row[i] for row in rows] for i, f in enumerate(dispatch)}
+                columns.update({name: column.tolist()
+                    for name, column in self.get_context_columns(columns).items()})
+                ft_list = [list(row) for row in zip(*[columns[f.name] for f in self.dispatch])]
+        self.emit_line_times(start)
         return ft_list
 
-    def extract_line(self, lnum):
+    def extract_array(self):
+        """
+        lines のすべての行の特徴を、特徴量ごとに列単位で NumPy で計算するメソッド
+
+        extract() と同じ値を、そのままモデルに入力できる行列で返す。
+
+        Returns
+        -------
+        ft_array : numpy.ndarray
+            (行数 x 特徴量の数) の float32 の行列
+        """
+        n = len(self)
+        start = time.perf_counter()
+        with trace.span('extract_array', lines=n):
+            ft_array = np.zeros((n, len(self.ftels)), dtype=np.float32)
+            columns = {}    # 同じ特徴名が複数あっても一度だけ計算する
+            per_line = []   # 列単位の計算が定義されていない特徴量の列番号
+            for j, feature in enumerate(self.dispatch):
+                if feature.name in columns or feature.base is not None:
+                    continue
+                elif feature.column_func is not None:
+                    with trace.span('feature:' + feature.name, cat='feature', lines=n):
+                        columns[feature.name] = feature.column_func(self)
+                else:
+                    per_line.append(j)
+
+            # 残りは、行ごとの計算を全行に適用する。
+            if per_line:
+                dispatch = [self.dispatch[j] for j in per_line]
+                for lnum in range(n):
+                    ft_array[lnum, per_line] = self.extract_line(lnum, dispatch)
+                for j in per_line:
+                    columns[self.dispatch[j].name] = ft_array[:, j]
+
+            # 前後の行の特徴量は、元の特徴量の列をずらして作る。
+            if self.has_context():
+                per_line = []   # 列単位の計算が定義されていない元の特徴量
+                for base in self.bases:
+                    if base.column_func is not None:
+                        with trace.span('feature:' + base.name, cat='feature', lines=n):
+                            columns[base.name] = base.column_func(self)
+                    else:
+                        per_line.append(base)
+                if per_line:
+                    rows = np.array([self.extract_line(lnum, per_line) for lnum in range(n)],
+                        dtype=np.float32).reshape(n, len(per_line))
+                    for i, base in enumerate(per_line):
+                        columns[base.name] = rows[:, i]
+                with trace.span('context', lines=n):
+                    columns.update(self.get_context_columns(columns))
+
+            for j, feature in enumerate(self.dispatch):
+                if feature.name in columns:
+                    ft_array[:, j] = columns[feature.name]
+        self.emit_line_times(start)
+        return ft_array
+
+    def has_context(self):
+        """
+        前後の行の特徴量があるかを返すメソッド
+        """
+        return any(feature.base is not None for feature in self.dispatch)
+
+    def get_context_columns(self, columns):
+        """
+        元の特徴量の列から、前後の行の特徴量の列を作るメソッド
+
+        元の特徴量ごとに、すべてのオフセットの列をまとめて shift_column() で作る。
+
+        Parameters
+        ----------
+        columns : dict
+            元の特徴名 -> 各行の値
+
+        Returns
+        -------
+        context_columns : dict
+            前後の行の特徴名 -> 各行の値の配列
+        """
+        groups = {}     # 元の特徴名 -> 前後の行の特徴量のリスト
+        for feature in self.dispatch:
+            if feature.base is not None:
+                group = groups.setdefault(feature.base.name, [])
+                if feature not in group:
+                    group.append(feature)
+
+        context_columns = {}
+        for name, group in groups.items():
+            shifted = shift_column(columns[name], [f.offset for f in group], group[0].pad)
+            for i, feature in enumerate(group):
+                context_columns[feature.name] = shifted[:, i]
+        return context_columns
+
+    def get_token_arrays(self):
+        """
+        列単位の計算に使う、台本全体の単語の配列を返すメソッド
+
+        Returns
+        -------
+        arr : dict
+            'surface_ids', 'pos_ids' : 単語ごとの表層形 ID, 品詞 ID
+            'line_idx' : 単語ごとの行番号
+            'word_idx' : 単語ごとの行内の位置
+            'counts' : 行ごとの単語数
+            'first_idx', 'last_idx' : 行ごとの最初と最後の単語の位置 (単語がない行では 0)
+        """
+        if hasattr(self, 'token_arrays'):
+            return self.token_arrays
+        lines = self.lines
+        offsets = np.frombuffer(lines.offsets, dtype=np.int32).astype(np.int64)
+        counts = np.diff(offsets)
+        line_idx = np.repeat(np.arange(len(lines)), counts)
+        has_words = counts > 0
+        self.token_arrays = {
+            'surface_ids': np.frombuffer(lines.surface_ids, dtype=np.int32),
+            'pos_ids': np.frombuffer(lines.pos_ids, dtype=np.int32),
+            'line_idx': line_idx,
+            'word_idx': np.arange(len(line_idx)) - offsets[line_idx],
+            'counts': counts,
+            'first_idx': np.where(has_words, offsets[:-1], 0),
+            'last_idx': np.where(has_words, offsets[1:] - 1, 0)
+        }
+        return self.token_arrays
+
+    def get_word_mask(self, words):
+        """
+        台本全体の単語について、words のいずれかであるかのマスクを返すメソッド
+        """
+        arr = self.get_token_arrays()
+        # 表層形 ID ごとの表を作ってから、各単語の ID で引く。
+        # (単語が一つもない台本でも引けるように、末尾に False を足しておく)
+        table = np.array([x in words for x in self.lines.surfaces] + [False])
+        return table[arr['surface_ids']]
+
+    def get_count_column(self, words):
+        """
+        各行の、words のいずれかである単語の数の配列を返すメソッド
+        """
+        arr = self.get_token_arrays()
+        mask = self.get_word_mask(words)
+        return np.bincount(arr['line_idx'][mask], minlength=len(self))
+
+    def get_first_pos_column(self, words):
+        """
+        各行で words のいずれかの語が最初に出現する「早さ」の配列を返すメソッド
+
+        値は get_first_pos_in_line() と同じ。
+        """
+        arr = self.get_token_arrays()
+        mask = self.get_word_mask(words)
+        return first_pos_by_line(arr['line_idx'][mask], arr['word_idx'][mask], len(self))
+
+    def get_common_head_column(self):
+        """
+        各行の、他の行と共通する行頭の単語数の配列を返すメソッド
+
+        値は len(get_length_of_common_head()) と同じ。lines が台本全体なら、トライ木を
+        作らずに、行頭から1単語ずつ、同じ行頭を持つ行の数を np.unique でまとめて数える。
+        台本の一部なら、台本全体の統計のトライ木をたどる。
+        """
+        n = len(self)
+        if self.partial:
+            return np.fromiter((len(self.get_length_of_common_head(lnum)) for lnum in range(n)),
+                dtype=np.int64, count=n)
+
+        arr = self.get_token_arrays()
+        counts = arr['counts']
+        # 単語ごとの (表層形, 品詞) の組の番号
+        words = arr['surface_ids'].astype(np.int64) * len(self.lines.parts_of_speech) \
+            + arr['pos_ids']
+
+        column = np.zeros(n, dtype=np.int64)
+        prefix = np.zeros(n, dtype=np.int64)   # 行ごとの、ここまでの行頭の番号
+        active = np.flatnonzero(counts > 0)     # ここまでの行頭が他の行と共通する行
+        k = 0
+        while len(active) > 0:
+            # ここまでの行頭と k 単語目の組が同じ行をまとめる。
+            pairs = np.stack([prefix[active], words[arr['first_idx'][active] + k]], axis=1)
+            _, inverse, shared = np.unique(pairs, axis=0, return_inverse=True,
+                return_counts=True)
+            inverse = inverse.reshape(-1)
+            # 他の行と共通でなくなった行は終了。
+            keep = shared[inverse] >= 2
+            active = active[keep]
+            prefix[active] = inverse[keep]
+            column[active] += 1
+            k += 1
+            active = active[counts[active] > k]
+        return column
+
+    def get_texts(self):
+        """
+        各行の、行頭の空白文字列を除いた文字列のリストを返すメソッド
+
+        形態素解析する前の行が渡されていなければ、TokenLines に記録された行を使う
+        (TokenLines.from_dicts() などで作った TokenLines では、行末の空白文字が含まれない)。
+        """
+        if not hasattr(self, 'texts'):
+            raw_texts = self.raw_texts if self.raw_texts is not None else self.lines.texts
+            self.texts = [text[len(indent):]
+                for text, indent in zip(raw_texts, self.get_indents())]
+        return self.texts
+
+    def get_indents(self):
+        """
+        各行の、行頭の空白文字列のリストを返すメソッド
+        """
+        if self.lines is not None:
+            return self.lines.indents
+        if not hasattr(self, 'indents'):
+            self.indents = [psc.get_indent(text) for text in self.raw_texts]
+        return self.indents
+
+    def get_char_arrays(self):
+        """
+        文字単位の列の計算に使う、台本全体の文字の配列を返すメソッド
+
+        Returns
+        -------
+        arr : dict
+            'codes' : 文字ごとの文字コード (行頭の空白文字列を除く)
+            'line_idx' : 文字ごとの行番号
+            'char_idx' : 文字ごとの行内の位置
+            'counts' : 行ごとの文字数
+            'last_idx' : 行ごとの最後の文字の位置 (文字がない行では 0)
+        """
+        if hasattr(self, 'char_arrays'):
+            return self.char_arrays
+        texts = self.get_texts()
+        n = len(texts)
+        counts = np.fromiter((len(x) for x in texts), dtype=np.int64, count=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        line_idx = np.repeat(np.arange(n), counts)
+        self.char_arrays = {
+            'codes': np.frombuffer(''.join(texts).encode('utf-32-le'), dtype='<u4'),
+            'line_idx': line_idx,
+            'char_idx': np.arange(len(line_idx)) - offsets[line_idx],
+            'counts': counts,
+            'last_idx': np.where(counts > 0, offsets[1:] - 1, 0)
+        }
+        return self.char_arrays
+
+    def get_char_mask(self, chars):
+        """
+        台本全体の文字について、chars のいずれかであるかのマスクを返すメソッド
+        """
+        arr = self.get_char_arrays()
+        return np.isin(arr['codes'], np.array([ord(c) for c in chars], dtype='<u4'))
+
+    def get_char_count_column(self, chars):
+        """
+        各行の、chars のいずれかである文字の数の配列を返すメソッド
+        """
+        arr = self.get_char_arrays()
+        mask = self.get_char_mask(chars)
+        return np.bincount(arr['line_idx'][mask], minlength=len(self))
+
+    def get_first_char_pos_column(self, chars):
+        """
+        各行で chars のいずれかの文字が最初に出現する「早さ」の配列を返すメソッド
+
+        値は features.first_char_pos() と同じ。
+        """
+        arr = self.get_char_arrays()
+        mask = self.get_char_mask(chars)
+        return first_pos_by_line(arr['line_idx'][mask], arr['char_idx'][mask], len(self))
+
+    def extract_line(self, lnum, dispatch=None):
         """
         lnum 行目の特徴を抽出し、リストにして返すメソッド
 
+        特徴量が必要とする行ごとの入力 (表層形のリストなど) は、1行につき一度だけ
+        作って、各特徴量の関数に渡す。
+
         Parameters
         ----------
         lnum : int
             注目している行の番号
+        dispatch : list
+            抽出する Feature のリスト。省略すると ftels のすべての特徴量。
         
         Returns
         -------
@@ -81,114 +720,112 @@ class Extractor:
             その行の特徴ベクトル
 
         """
-        feature_vec = []
-        line = self.lines[lnum]
-        for ftname in [ftel[0] for ftel in self.ftels]:
-            """
-            ftels の各要素の特徴名にもとづいて、特徴量を取得するメソッド
-            """
-            if ftname == 'sc_count_of_lines': # 台本内の行数
-                ft = len(self.lines)
-
-            elif ftname == 'sc_count_of_lines_with_bracket': # 台本内の括弧を含む行の数
-                ft = self.get_count_of_lines_with_bracket()
-
-            elif ftname == 'ln_count_of_words': # 行内の語数
-                ft = len(line['tokenized_words'])
-
-            elif ftname == 'ln_count_of_brackets': # 行内の括弧の数
-                lw = [word['surface'] for word in line['tokenized_words']]
-                lb = [x for x in lw if x in psc.brackets]
-                ft = len(lb)
-
-            elif ftname == 'ln_length_of_common_head': # 行頭の何単語まで他の行と共通するか
-                ft = len(self.get_length_of_common_head(lnum))
-                # とりあえず、共通の行頭が存在する最大の単語数を特徴として使ってみる。
-                # "単語数 * 存在する行数" などを特徴として使う手もある。
-
-            elif ftname == 'ln_first_open_bracket_pos': # 開き括弧がどれくらい早く出現するか
-                ft = self.get_first_pos_in_line(lnum, psc.open_brackets)
-
-            elif ftname == 'ln_first_close_bracket_pos': # 閉じ括弧がどれくらい早く出現するか
-                ft = self.get_first_pos_in_line(lnum, psc.close_brackets)
-
-            elif ftname == 'ln_first_space_pos': # 空白がどれくらい早く出現するか
-                ft = self.get_first_pos_in_line(lnum, psc.spaces)
-
-            elif ftname == 'ln_first_comma_pos': # 読点がどれくらい早く出現するか
-                ft = self.get_first_pos_in_line(lnum, psc.commas)
-
-            elif ftname == 'ln_first_period_pos': # 句点がどれくらい早く出現するか
-                ft = self.get_first_pos_in_line(lnum, psc.periods)
-
-            elif ftname == 'ln_length_of_indent': # インデントの長さ
-                ft = len(line['indent_chars'])
-
-            elif ftname == 'ln_begins_with_name': # 最初の単語が名詞/固有名詞/人名か
-                tw = line['tokenized_words']
-                ft = 0
-                if len(tw) > 0:
-                    pos = tw[0]['part_of_speech'].split(',')
-                    ft += (pos[0] == '名詞')        # 名詞なら 1
-                    ft += (pos[1] == '固有名詞')    # さらに固有名詞なら 2
-                    ft += (pos[2] == '人名') * 2    # さらに人名なら 4
-            
-            elif ftname == 'ln_ends_with_close_bracket': # 行の最後が閉じ括弧か
-                tw = line['tokenized_words']
-                if len(tw) > 0:
-                    ft = int(tw[-1]['surface'] in psc.close_brackets)
-                else:
-                    ft = 0
+        if dispatch is None:
+            dispatch = self.dispatch
+            input_names = self.input_names
+        else:
+            input_names = {name for feature in dispatch for name in feature.inputs}
+        if trace.enabled:
+            return self.extract_line_traced(lnum, dispatch, input_names)
+
+        inputs = {name: line_inputs[name](self, lnum) for name in input_names}
 
-            feature_vec.append(ft)
+        feature_vec = []
+        for feature in dispatch:
+            if feature.base is not None:
+                feature_vec.append(self.extract_context_value(lnum, feature))
+                continue
+            feature_vec.append(feature.func(**{name: inputs[name] for name in feature.inputs}))
         return feature_vec
-    
-    def get_count_of_lines_with_bracket(self):
+
+    def extract_context_value(self, lnum, feature):
         """
-        台本内の括弧を含む行の数を返すメソッド
+        lnum 行目の、前後の行の特徴量 (feature) の値を返すメソッド
+
+        ずらした先の行で元の特徴量を計算する。全行分を求める時は、extract() や
+        extract_array() が元の特徴量の列をずらして作るので、このメソッドは使わない。
         """
-        if hasattr(self, 'count_of_lines_with_bracket'):
-            return self.count_of_lines_with_bracket
-        count = 0
-        for line in self.lines:
-            words = [w['surface'] for w in line['tokenized_words']]
-            for w in words:
-                if w in psc.brackets:
-                    count += 1
-                    break
-        self.count_of_lines_with_bracket = count
-        return count
+        target = lnum + feature.offset
+        if target < 0 or target >= len(self):
+            return feature.pad
+        return self.extract_line(target, [feature.base])[0]
 
-    def get_count_of_lines_with_head(self, head, lnum = 0):
+    def extract_line_traced(self, lnum, dispatch, input_names):
         """
-        lnum 行目以降の、行頭が head である行の数を返すメソッド
+        extract_line() と同じ処理をしながら、行ごとの入力と特徴量の所要時間を
+        line_times に足していくメソッド (計測が有効な時に使う)
+        """
+        times = self.line_times
+        clock = time.perf_counter
 
-        get_length_of_common_head() から呼ばれる。
+        inputs = {}
+        for name in input_names:
+            t0 = clock()
+            inputs[name] = line_inputs[name](self, lnum)
+            t = times.setdefault('input:' + name, [0, 0.])
+            t[0] += 1
+            t[1] += clock() - t0
+
+        feature_vec = []
+        for feature in dispatch:
+            if feature.base is not None:
+                feature_vec.append(self.extract_context_value(lnum, feature))
+                continue
+            t0 = clock()
+            feature_vec.append(feature.func(**{name: inputs[name] for name in feature.inputs}))
+            t = times.setdefault('feature:' + feature.name, [0, 0.])
+            t[0] += 1
+            t[1] += clock() - t0
+        return feature_vec
+
+    def emit_line_times(self, start):
+        """
+        line_times にたまった所要時間を、名前ごとに1つのイベントとして記録するメソッド
 
         Parameters
         ----------
-        head : list
-            {surface, part_of_speech} の辞書のリスト
-        lnum : int
-            注目している行の番号
+        start : float
+            抽出を始めた時刻 (time.perf_counter() の値)
         """
-        count = 0
-        for line in self.lines[lnum:]:
-            match = True
-            for i in range(len(head)):
-                if len(line['tokenized_words']) < i + 1:
-                    match = False
-                    break
-                tokenized_words = line['tokenized_words'][i]
-                surface = head[i]['surface']
-                part_of_speech = head[i]['part_of_speech']
-                if tokenized_words['surface'] != surface \
-                    or tokenized_words['part_of_speech'] != part_of_speech:
-                    match = False
-                    break
-            if match:
-                count += 1
-        return count
+        for name, (count, seconds) in self.line_times.items():
+            trace.emit(name, start, seconds, cat='line', args={'count': count})
+        self.line_times = {}
+    
+    def get_count_of_lines(self):
+        """
+        台本内の行数を返すメソッド (形態素解析の結果は使わない)
+        """
+        if self.stats is not None:
+            return self.stats.count_of_lines
+        return len(self)
+
+    def get_stats(self):
+        """
+        台本全体に関する統計を返すメソッド
+
+        コンストラクタで渡されていなければ、lines から一度だけ作る。
+        トライ木は ln_length_of_common_head を使う時だけ作る。
+        """
+        if self.stats is None:
+            with_heads = 'ln_length_of_common_head' in [
+                (feature.base or feature).name for feature in self.dispatch]
+            self.stats = ScriptStats.from_token_lines(self.lines, with_heads)
+        return self.stats
+
+    def get_count_of_lines_with_bracket(self):
+        """
+        台本内の括弧を含む行の数を返すメソッド
+        """
+        return self.get_stats().count_of_lines_with_bracket
+
+    def get_head_trie(self):
+        """
+        台本内の全行の行頭をまとめたトライ木 (ScriptStats.head_trie) を返すメソッド
+        """
+        stats = self.get_stats()
+        if stats.head_trie is None:
+            raise ValueError("stats has no head trie.")
+        return stats.head_trie
 
     def get_length_of_common_head(self, lnum):
         """
@@ -205,27 +842,18 @@ class Extractor:
             1単語目～n単語目までの、同じ行頭を持つ行数 (自分自身もカウントする) のリスト
 
         """
-        line = self.lines[lnum]
-        length = 0
-        head = []
+        lines = self.lines
+        surfaces = lines.surfaces
+        parts_of_speech = lines.parts_of_speech
+        node = self.get_head_trie()
         count = []
-        for w in line['tokenized_words']: # 行頭からの各単語について
-            # 「行頭」の定義に追加
-            head.append({'surface': w['surface'], 'part_of_speech': w['part_of_speech']})
-            # その「行頭」がすでにカウントされていれば、それ (common_heads の要素) を使う。
-            counted = [x for x in self.common_heads if x[0] == head]
-            if len(counted) > 0:
-                count.append(counted[0][1])
-            else:
-                # まだ common_heads としてカウントされてなければ lnum 行目以降でカウント。
-                line_count = self.get_count_of_lines_with_head(head, lnum)
-                if line_count > 1:
-                    # lnum 行目以外にも、行頭が head のものがあったなら、common_heads に追加。
-                    # ※ タプルとして追加する。
-                    self.common_heads.append((copy.deepcopy(head), line_count))
-                    count.append(line_count)
-                else:
-                    break
+        # 行頭からの各単語について
+        for s, p in zip(lines.line_surface_ids(lnum), lines.line_pos_ids(lnum)):
+            node = node[1][(surfaces[s], parts_of_speech[p])]
+            # 他の行と共通でなくなったら終了。
+            if node[0] < 2:
+                break
+            count.append(node[0])
         return count
 
     def get_first_pos_in_line(self, lnum, words):
@@ -244,11 +872,4 @@ class Extractor:
         position : float
             返り値は、位置 (0, 1, ...) を x とし、e^(-x/4) の値。なければ 0.
         """
-        line = self.lines[lnum]
-        lw = [word['surface'] for word in line['tokenized_words']]
-        li = [i for i, x in enumerate(lw) if x in words]
-        if len(li) > 0:
-            x = li[0]
-            return np.exp(-x/4)
-        else:
-            return 0.
+        return first_pos(self.lines.line_surfaces(lnum), words)
@@ -0,0 +1,592 @@
+"""
+特徴量の定義
+
+特徴量は feature() デコレータで登録する。登録した関数は、行ごとの入力 (line_input() で
+登録したもの) のうち、引数名で指定したものを受け取って、その行の特徴量を返す。
+Extractor は、設定された特徴量が必要とする入力だけを、1行につき一度だけ計算して渡す。
+
+特徴量オブジェクトの column デコレータで、台本全体の列をまとめて計算する関数
+(Extractor を受け取って、各行の特徴量の配列を返す) も登録できる。登録しなければ、
+Extractor.extract_array() は行ごとの関数を全行に適用する。
+
+行ごとの入力のうち、行の文字列だけから作れるもの (line_input() に tokens=False を
+指定したもの) しか使わない特徴量は、形態素解析をしなくても抽出できる。設定された
+特徴量がすべてそうなら、形態素解析 (Janome) を省く (needs_tokens() を参照)。
+
+前後の行の特徴量は、"元の特徴名@オフセット" という名前で指定する (例えば ln_is_empty@-1 は
+前の行が空行か、ln_count_of_words@+2 は2行後の行内の語数)。登録は不要で、get_feature() が
+元の特徴量から ContextFeature を作る。Extractor は元の特徴量の列を一度だけ計算し、それを
+ずらして前後の行の特徴量の列にする。台本の外の行の値は、元の特徴量の pad (省略時は 0)。
+
+例
+    @feature('ln_count_of_words')
+    def ln_count_of_words(count_of_words):
+        '''行内の語数'''
+        return count_of_words
+
+    @ln_count_of_words.column
+    def _(ex):
+        return ex.get_token_arrays()['counts']
+"""
+
+import inspect
+from collections import OrderedDict
+
+import numpy as np
+
+
+# 特徴名 -> Feature (登録順)
+registry = OrderedDict()
+
+# 行ごとの入力の名前 -> (Extractor, 行番号) を受け取って入力を返す関数
+line_inputs = {}
+
+# 形態素解析の結果を使わない、行ごとの入力の名前
+text_inputs = set()
+
+# 前後の行の特徴量の名前の区切り ("元の特徴名@オフセット")
+CONTEXT_SEP = '@'
+
+# 前後の行の特徴名 -> ContextFeature (get_feature() で作ったもの)
+_context_features = {}
+
+
+class Feature:
+    """
+    登録された特徴量
+    """
+
+    # 前後の行の特徴量の、元の特徴量とオフセット (ContextFeature 以外は None と 0)
+    base = None
+    offset = 0
+
+    def __init__(self, name, func, pad=0):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        name : str
+            特徴名
+        func : function
+            行ごとの特徴量を計算する関数。引数名が、必要とする行ごとの入力の名前。
+        pad : int
+            前後の行の特徴量で、台本の外の行に使う値
+        """
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inspect.signature(func).parameters)
+        self.doc = inspect.getdoc(func) or ''
+        self.column_func = None
+        self.pad = pad
+
+    @property
+    def needs_tokens(self):
+        """
+        形態素解析の結果を使うか
+        """
+        return any(name not in text_inputs for name in self.inputs)
+
+    def __call__(self, **inputs):
+        return self.func(**inputs)
+
+    def column(self, func):
+        """
+        台本全体の列をまとめて計算する関数を登録するデコレータ
+        """
+        self.column_func = func
+        return func
+
+
+class ContextFeature(Feature):
+    """
+    前後の行の特徴量 (元の特徴量の値を、offset 行ずらしたもの)
+    """
+
+    def __init__(self, base, offset):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        base : Feature
+            元の特徴量
+        offset : int
+            ずらす行数。負なら前の行、正なら後の行。
+        """
+        self.name = '{}{}{:+d}'.format(base.name, CONTEXT_SEP, offset)
+        self.func = None
+        self.inputs = ()    # 行ごとの入力は、元の特徴量が使う
+        self.doc = '{} ({}行{})'.format(base.doc, abs(offset), '前' if offset < 0 else '後')
+        self.column_func = None
+        self.pad = base.pad
+        self.base = base
+        self.offset = offset
+
+    @property
+    def needs_tokens(self):
+        return self.base.needs_tokens
+
+
+def feature(name, pad=0):
+    """
+    特徴量を登録するデコレータ
+
+    pad は、前後の行の特徴量で、台本の外の行に使う値。
+    """
+    def register(func):
+        f = Feature(name, func, pad)
+        registry[name] = f
+        return f
+    return register
+
+
+def line_input(name, tokens=True):
+    """
+    行ごとの入力を登録するデコレータ
+
+    形態素解析の結果を使わない入力は、tokens=False を指定して登録する。
+    """
+    def register(func):
+        line_inputs[name] = func
+        if not tokens:
+            text_inputs.add(name)
+        return func
+    return register
+
+
+def _parse_offset(name, text):
+    """
+    前後の行の特徴名のオフセットの部分を int にする関数
+    """
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError("Feature '{}' not defined.".format(name))
+
+
+def get_feature(name):
+    """
+    特徴名から Feature を返す関数
+
+    "元の特徴名@オフセット" の形の名前なら、元の特徴量から ContextFeature を作って返す。
+    未定義の特徴名なら ValueError を送出する。
+    """
+    if name in registry:
+        return registry[name]
+    if name in _context_features:
+        return _context_features[name]
+    base_name, sep, offset = name.rpartition(CONTEXT_SEP)
+    if not sep or base_name not in registry:
+        raise ValueError("Feature '{}' not defined.".format(name))
+    offset = _parse_offset(name, offset)
+    if offset == 0:
+        raise ValueError("Feature '{}' has no offset.".format(name))
+    f = ContextFeature(registry[base_name], offset)
+    _context_features[name] = f
+    return f
+
+
+def expand_feature_name(name):
+    """
+    特徴量設定ファイルに書かれた特徴名を、特徴名のリストにする関数
+
+    "元の特徴名@-2:+2" のような範囲は、範囲内のオフセットごとの名前 (元の特徴名@-2,
+    元の特徴名@-1, 元の特徴名@+1, 元の特徴名@+2) にする (0 は元の特徴量なので含めない)。
+    前後の行の特徴名は、オフセットに符号を付けた形 (@1 なら @+1) にそろえる。
+    未定義の特徴名なら ValueError を送出する。
+    """
+    if name in registry:
+        return [name]
+    base_name, sep, offsets = name.rpartition(CONTEXT_SEP)
+    if sep and ':' in offsets:
+        first, last = (_parse_offset(name, x) for x in offsets.split(':', 1))
+        names = ['{}{}{:+d}'.format(base_name, CONTEXT_SEP, offset)
+            for offset in range(first, last + 1) if offset != 0]
+    else:
+        names = [name]
+    return [get_feature(x).name for x in names]
+
+
+def sort_key(name):
+    """
+    特徴名を、登録順 (前後の行の特徴量は、元の特徴量の後にオフセット順) に並べるためのキー
+    """
+    f = get_feature(name)
+    return (list(registry).index((f.base or f).name), f.offset)
+
+
+def needs_tokens(ftels):
+    """
+    特徴量設定に、形態素解析の結果を使う特徴量があるかを返す関数
+
+    Parameters
+    ----------
+    ftels : list
+        (特徴名, ハイパーパラメータ) のタプルのリスト
+    """
+    for ftel in ftels:
+        try:
+            if get_feature(ftel[0]).needs_tokens:
+                return True
+        except ValueError:
+            # 未定義の特徴名は、Extractor でエラーにするので、ここでは形態素解析が必要とみなす。
+            return True
+    return False
+
+
+def context_margin(ftels):
+    """
+    特徴量設定の、前後の行の特徴量が参照する行数 (前の行数, 後の行数) を返す関数
+    """
+    offsets = [get_feature(ftel[0]).offset for ftel in ftels]
+    return max([0] + [-x for x in offsets]), max([0] + offsets)
+
+
+# 行ごとの入力
+
+@line_input('lnum', tokens=False)
+def _lnum(ex, lnum):
+    return lnum
+
+
+@line_input('count_of_lines', tokens=False)
+def _count_of_lines(ex, lnum):
+    return ex.get_count_of_lines()
+
+
+@line_input('text', tokens=False)
+def _text(ex, lnum):
+    # 行頭の空白文字列を除いた、行の文字列
+    return ex.get_texts()[lnum]
+
+
+@line_input('stats')
+def _stats(ex, lnum):
+    return ex.get_stats()
+
+
+@line_input('count_of_words')
+def _count_of_words(ex, lnum):
+    return ex.lines.count_of_words(lnum)
+
+
+@line_input('surfaces')
+def _surfaces(ex, lnum):
+    return ex.lines.line_surfaces(lnum)
+
+
+@line_input('parts_of_speech')
+def _parts_of_speech(ex, lnum):
+    lines = ex.lines
+    return [lines.parts_of_speech[p] for p in lines.line_pos_ids(lnum)]
+
+
+@line_input('indent_chars', tokens=False)
+def _indent_chars(ex, lnum):
+    return ex.get_indents()[lnum]
+
+
+@line_input('common_head')
+def _common_head(ex, lnum):
+    return ex.get_length_of_common_head(lnum)
+
+
+def first_pos(surfaces, words):
+    """
+    surfaces の中で、words 内のいずれかの語が最初に出現する「早さ」を返す関数
+
+    返り値は、位置 (0, 1, ...) を x とし、e^(-x/4) の値。なければ 0.
+    """
+    for x, surface in enumerate(surfaces):
+        if surface in words:
+            return np.exp(-x/4)
+    return 0.
+
+
+def first_char_pos(text, chars):
+    """
+    text の中で、chars 内のいずれかの文字が最初に出現する「早さ」を返す関数
+
+    返り値は、位置 (0, 1, ...) を x とし、e^(-x/4) の値。なければ 0.
+    """
+    for x, c in enumerate(text):
+        if c in chars:
+            return np.exp(-x/4)
+    return 0.
+
+
+# Feature elements of the script
+
+@feature('sc_count_of_lines')
+def sc_count_of_lines(count_of_lines):
+    """台本内の行数"""
+    return count_of_lines
+
+
+@sc_count_of_lines.column
+def _(ex):
+    return np.full(len(ex), ex.get_count_of_lines())
+
+
+@feature('sc_count_of_lines_with_bracket')
+def sc_count_of_lines_with_bracket(stats):
+    """台本内の括弧を含む行の数"""
+    return stats.count_of_lines_with_bracket
+
+
+@sc_count_of_lines_with_bracket.column
+def _(ex):
+    return np.full(len(ex), ex.get_stats().count_of_lines_with_bracket)
+
+
+# Feature elements of the line
+
+@feature('ln_count_of_words')
+def ln_count_of_words(count_of_words):
+    """行内の語数"""
+    return count_of_words
+
+
+@ln_count_of_words.column
+def _(ex):
+    return ex.get_token_arrays()['counts']
+
+
+@feature('ln_count_of_brackets')
+def ln_count_of_brackets(surfaces):
+    """行内の括弧の数 (括弧の定義は、psc.brackets)"""
+    return len([x for x in surfaces if x in psc.brackets])
+
+
+@ln_count_of_brackets.column
+def _(ex):
+    return ex.get_count_column(psc.brackets)
+
+
+@feature('ln_length_of_common_head')
+def ln_length_of_common_head(common_head):
+    """行頭の何単語まで他の行と共通するか"""
+    # とりあえず、共通の行頭が存在する最大の単語数を特徴として使ってみる。
+    # "単語数 * 存在する行数" などを特徴として使う手もある。
+    return len(common_head)
+
+
+@ln_length_of_common_head.column
+def _(ex):
+    return ex.get_common_head_column()
+
+
+@feature('ln_first_open_bracket_pos')
+def ln_first_open_bracket_pos(surfaces):
+    """行内の開き括弧の出現の早さ。大きいほど早く出現。なければ 0。"""
+    return first_pos(surfaces, psc.open_brackets)
+
+
+@ln_first_open_bracket_pos.column
+def _(ex):
+    return ex.get_first_pos_column(psc.open_brackets)
+
+
+@feature('ln_first_close_bracket_pos')
+def ln_first_close_bracket_pos(surfaces):
+    """行内の閉じ括弧の出現の早さ。大きいほど早く出現。なければ 0。"""
+    return first_pos(surfaces, psc.close_brackets)
+
+
+@ln_first_close_bracket_pos.column
+def _(ex):
+    return ex.get_first_pos_column(psc.close_brackets)
+
+
+@feature('ln_first_space_pos')
+def ln_first_space_pos(surfaces):
+    """行内の空白文字の出現の早さ。大きいほど早く出現。なければ 0。"""
+    return first_pos(surfaces, psc.spaces)
+
+
+@ln_first_space_pos.column
+def _(ex):
+    return ex.get_first_pos_column(psc.spaces)
+
+
+@feature('ln_first_comma_pos')
+def ln_first_comma_pos(surfaces):
+    """行内の読点の出現の早さ。大きいほど早く出現。なければ 0。"""
+    return first_pos(surfaces, psc.commas)
+
+
+@ln_first_comma_pos.column
+def _(ex):
+    return ex.get_first_pos_column(psc.commas)
+
+
+@feature('ln_first_period_pos')
+def ln_first_period_pos(surfaces):
+    """行内の句点の出現の早さ。大きいほど早く出現。なければ 0。"""
+    return first_pos(surfaces, psc.periods)
+
+
+@ln_first_period_pos.column
+def _(ex):
+    return ex.get_first_pos_column(psc.periods)
+
+
+@feature('ln_length_of_indent')
+def ln_length_of_indent(indent_chars):
+    """インデントの長さ"""
+    return len(indent_chars)
+
+
+@ln_length_of_indent.column
+def _(ex):
+    return np.fromiter((len(x) for x in ex.get_indents()), dtype=np.int64, count=len(ex))
+
+
+def name_score(part_of_speech):
+    """
+    品詞が名詞なら 1, 固有名詞なら 2, 人名なら 4 を返す関数
+    """
+    pos = part_of_speech.split(',')
+    ft = 0
+    ft += (pos[0] == '名詞')        # 名詞なら 1
+    ft += (pos[1] == '固有名詞')    # さらに固有名詞なら 2
+    ft += (pos[2] == '人名') * 2    # さらに人名なら 4
+    return ft
+
+
+@feature('ln_begins_with_name')
+def ln_begins_with_name(parts_of_speech):
+    """行頭の単語が名詞なら 1, 固有名詞なら 2, 人名なら 4"""
+    if len(parts_of_speech) > 0:
+        return name_score(parts_of_speech[0])
+    return 0
+
+
+@ln_begins_with_name.column
+def _(ex):
+    arr = ex.get_token_arrays()
+    # 品詞 ID ごとの値の表を作ってから、各行の最初の単語で引く。
+    # (単語が一つもない台本でも引けるように、末尾に 0 と -1 を足しておく)
+    table = np.array([name_score(x) for x in ex.lines.parts_of_speech] + [0], dtype=np.int64)
+    pos_ids = np.append(arr['pos_ids'], -1)
+    first = np.where(arr['counts'] > 0, pos_ids[arr['first_idx']], -1)
+    return table[first]
+
+
+@feature('ln_ends_with_close_bracket')
+def ln_ends_with_close_bracket(surfaces):
+    """行の最後が閉じ括弧か"""
+    if len(surfaces) > 0:
+        return int(surfaces[-1] in psc.close_brackets)
+    return 0
+
+
+@ln_ends_with_close_bracket.column
+def _(ex):
+    arr = ex.get_token_arrays()
+    mask = np.append(ex.get_word_mask(psc.close_brackets), False)
+    return (arr['counts'] > 0) & mask[arr['last_idx']]
+
+
+@feature('ln_is_empty', pad=1)
+def ln_is_empty(text):
+    """空行か (行頭の空白文字列しかない行も空行とする)。前後の行の特徴量では、台本の外も空行。"""
+    return int(len(text) == 0)
+
+
+@ln_is_empty.column
+def _(ex):
+    return np.fromiter((len(x) == 0 for x in ex.get_texts()), dtype=bool, count=len(ex))
+
+
+# Feature elements of the line (文字単位)
+# 形態素解析をせずに、行頭の空白文字列を除いた行の文字列から計算する。
+# Janome は連続する記号を一つの単語にすることがある (例えば "･･･」") ので、
+# 単語単位の同名の特徴量とは値が違うことがある。
+
+@feature('ln_count_of_bracket_chars')
+def ln_count_of_bracket_chars(text):
+    """行内の括弧の文字数 (括弧の定義は、psc.brackets)"""
+    return len([x for x in text if x in psc.brackets])
+
+
+@ln_count_of_bracket_chars.column
+def _(ex):
+    return ex.get_char_count_column(psc.brackets)
+
+
+@feature('ln_first_open_bracket_char_pos')
+def ln_first_open_bracket_char_pos(text):
+    """行内の開き括弧の出現の早さ (文字単位)。大きいほど早く出現。なければ 0。"""
+    return first_char_pos(text, psc.open_brackets)
+
+
+@ln_first_open_bracket_char_pos.column
+def _(ex):
+    return ex.get_first_char_pos_column(psc.open_brackets)
+
+
+@feature('ln_first_close_bracket_char_pos')
+def ln_first_close_bracket_char_pos(text):
+    """行内の閉じ括弧の出現の早さ (文字単位)。大きいほど早く出現。なければ 0。"""
+    return first_char_pos(text, psc.close_brackets)
+
+
+@ln_first_close_bracket_char_pos.column
+def _(ex):
+    return ex.get_first_char_pos_column(psc.close_brackets)
+
+
+@feature('ln_first_space_char_pos')
+def ln_first_space_char_pos(text):
+    """行内の空白文字の出現の早さ (文字単位)。大きいほど早く出現。なければ 0。"""
+    return first_char_pos(text, psc.spaces)
+
+
+@ln_first_space_char_pos.column
+def _(ex):
+    return ex.get_first_char_pos_column(psc.spaces)
+
+
+@feature('ln_first_comma_char_pos')
+def ln_first_comma_char_pos(text):
+    """行内の読点の出現の早さ (文字単位)。大きいほど早く出現。なければ 0。"""
+    return first_char_pos(text, psc.commas)
+
+
+@ln_first_comma_char_pos.column
+def _(ex):
+    return ex.get_first_char_pos_column(psc.commas)
+
+
+@feature('ln_first_period_char_pos')
+def ln_first_period_char_pos(text):
+    """行内の句点の出現の早さ (文字単位)。大きいほど早く出現。なければ 0。"""
+    return first_char_pos(text, psc.periods)
+
+
+@ln_first_period_char_pos.column
+def _(ex):
+    return ex.get_first_char_pos_column(psc.periods)
+
+
+@feature('ln_ends_with_close_bracket_char')
+def ln_ends_with_close_bracket_char(text):
+    """行の最後の文字が閉じ括弧か"""
+    if len(text) > 0:
+        return int(text[-1] in psc.close_brackets)
+    return 0
+
+
+@ln_ends_with_close_bracket_char.column
+def _(ex):
+    arr = ex.get_char_arrays()
+    mask = np.append(ex.get_char_mask(psc.close_brackets), False)
+    return (arr['counts'] > 0) & mask[arr['last_idx']]
+
+
+# psc は定数 (括弧の定義など) を呼び出し時に参照するだけなので、最後に読み込む。
+# (psc は読み込みの最後にこのモジュールの registry から特徴名の一覧を作るため、
+# どちらから先に読み込まれても、その時点で全特徴量が登録済みになるようにする)
+from psclib import psc  # noqa: E402
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class NumpyPscModel:
+    """
+    PscChain と同じ順伝播を NumPy だけで行う、予測専用のモデル
+
+    PscChain.export_npz() で保存した重みを読み込んで使う。
+    Chainer (と CuPy) を import しないので、CPU だけの環境でもすぐに起動できる。
+    """
+
+    # 層の名前 (PscChain と同じ順)
+    layers = ('l1', 'l2', 'l3')
+
+    def __init__(self, params):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        params : dict
+            'l1_W', 'l1_b' などの名前の重み (numpy.ndarray) の辞書
+        """
+        self.weights = [np.asarray(params[name + '_W'], dtype=np.float32)
+            for name in self.layers]
+        self.biases = [np.asarray(params[name + '_b'], dtype=np.float32)
+            for name in self.layers]
+
+    @classmethod
+    def load(cls, path):
+        """
+        export_npz() で保存した .npz ファイルから読み込む
+        """
+        with np.load(path) as params:
+            return cls(params)
+
+    def __call__(self, x):
+        """
+        順伝播して、softmax をかける前の出力を返すメソッド
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            (バッチサイズ x 特徴ベクトルの次元数) の、入力データ
+        """
+        h = np.asarray(x, dtype=np.float32)
+        last = len(self.weights) - 1
+        for i, (W, b) in enumerate(zip(self.weights, self.biases)):
+            # L.Linear と同じく y = x W^T + b
+            h = h @ W.T + b
+            if i < last:
+                h = np.maximum(h, 0)    # ReLU
+        return h
+
+    def predict(self, x):
+        """
+        各行の出力の最大値のインデックス (classes のインデックス) を返すメソッド
+        """
+        return self(x).argmax(axis=1)
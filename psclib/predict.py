@@ -0,0 +1,128 @@
+import pickle
+
+import numpy as np
+
+from psclib.npmodel import NumpyPscModel
+from psclib.artifact import load_manifest, check_features
+from psclib.decode import viterbi
+
+
+def load_model(model_file, gpu_id=-1, ftels=None):
+    """
+    予測モデルを読み込む関数
+
+    model_file が .npz なら NumpyPscModel として (Chainer も pickle も使わずに) 読み込み、
+    それ以外なら pickle された PscChain として読み込む。
+    .npz にマニフェスト (.json) があり、ftels が渡されたら、特徴量設定が学習時と
+    同じか確かめる。マニフェストがなければ、特徴量の数がモデルの入力の次元数と
+    同じかだけを確かめる。
+
+    Parameters
+    ----------
+    model_file : str
+        予測モデルのファイル
+    gpu_id : int
+        GPU を使うなら 0 以上, 使わないなら -1
+    ftels : list
+        予測に使う (特徴名, ハイパーパラメータ) のタプルのリスト
+
+    Returns
+    -------
+    model : NumpyPscModel or PscChain
+        予測モデル
+    gpu_id : int
+        実際に使う GPU (NumpyPscModel なら常に -1)
+    """
+    if model_file.endswith('.npz'):
+        manifest = load_manifest(model_file)
+        if manifest is not None and ftels is not None:
+            check_features(manifest, ftels)
+        model = NumpyPscModel.load(model_file)
+        if manifest is not None and model.weights[0].shape[1] != manifest['in_dim']:
+            raise ValueError("{} doesn't match its manifest.".format(model_file))
+        if manifest is None and ftels is not None:
+            check_in_dim(model_file, model.weights[0].shape[1], ftels)
+        # NumPy だけで予測するので、GPU は使わない
+        return model, -1
+
+    with open(model_file, mode='rb') as f:
+        model = pickle.load(f)
+    if ftels is not None and model.l1.W.array is not None:
+        check_in_dim(model_file, model.l1.W.array.shape[1], ftels)
+
+    # GPU を使うかのフラグ (使うなら 0, 使わないなら -1)
+    if gpu_id >= 0:
+        model.to_gpu(gpu_id)
+    return model, gpu_id
+
+
+def check_in_dim(model_file, in_dim, ftels):
+    """
+    モデルの入力の次元数と、特徴量設定の特徴量の数が同じか確かめる関数
+
+    違えば ValueError を送出する。
+    """
+    if in_dim != len(ftels):
+        raise ValueError("{} takes {} features but the feature setting has {}.".format(
+            model_file, in_dim, len(ftels)))
+
+
+def predict_array(model, ft_array, gpu_id=-1, constraints=None):
+    """
+    特徴量の行列を順伝播して、各行のラベル (classes のインデックス) を返す関数
+
+    constraints (psclib.decode.Constraints) を渡すと、ft_array を台本1冊分の行とみなして、
+    制約を満たすラベルの並びを求める (制約付きデコード)。
+    """
+    if len(ft_array) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if constraints is not None:
+        return viterbi(predict_logits(model, ft_array, gpu_id), constraints)
+
+    # NumPy だけで予測する
+    if isinstance(model, NumpyPscModel):
+        return model.predict(ft_array)
+
+    import chainer
+
+    # 特徴量データの ndarray を作成
+    if gpu_id >= 0:
+        import cupy
+        in_dataset = cupy.asarray(ft_array)
+    else:
+        in_dataset = ft_array
+
+    # 順伝播
+    with chainer.using_config('train', False), \
+            chainer.using_config('enable_backprop', False):
+        out = model(in_dataset)
+
+    # 個々の出力の最大値のインデックス
+    return chainer.cuda.to_cpu(out.array.argmax(axis=1))
+
+
+def predict_logits(model, ft_array, gpu_id=-1):
+    """
+    特徴量の行列を順伝播して、各行の出力 (softmax をかける前の値) を返す関数
+
+    Returns
+    -------
+    logits : numpy.ndarray
+        (行数 x 行の種類の数) の行列 (GPU を使った場合も CPU に戻したもの)
+    """
+    if isinstance(model, NumpyPscModel):
+        return model(ft_array)
+
+    import chainer
+
+    if gpu_id >= 0:
+        import cupy
+        in_dataset = cupy.asarray(ft_array)
+    else:
+        in_dataset = ft_array
+
+    with chainer.using_config('train', False), \
+            chainer.using_config('enable_backprop', False):
+        out = model(in_dataset)
+    return chainer.cuda.to_cpu(out.array)
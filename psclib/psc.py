@@ -1,6 +1,18 @@
+import os
 import re
+import sys
 import csv
-from janome.tokenizer import Tokenizer
+import json
+import struct
+import tempfile
+import argparse
+from array import array
+
+import numpy as np
+
+from psclib import trace
+
+# Janome は、読み込むだけで時間がかかるので、get_tokenizer() で初めて使う時に読み込む。
 
 
 classes = (
@@ -22,24 +34,6 @@ classes = (
     "COMMENT_CONTINUED"     # 15
 )
 
-features = (
-    # Feature elements of the script
-    "sc_count_of_lines",
-    "sc_count_of_lines_with_bracket",
-    # Feature elements of the line
-    "ln_count_of_words",
-    "ln_count_of_brackets",
-    "ln_length_of_common_head",
-    "ln_first_open_bracket_pos",
-    "ln_first_close_bracket_pos",
-    "ln_first_space_pos",
-    "ln_first_comma_pos",
-    "ln_first_period_pos",
-    "ln_length_of_indent",
-    "ln_begins_with_name",
-    "ln_ends_with_close_bracket"
-)
-
 open_brackets = ('「', '『')
 close_brackets = ('」', '』')
 brackets = open_brackets + close_brackets
@@ -86,7 +80,287 @@ def isolate_labels_from_lines(lines):
     return data, labels
 
 
-def tokenize_lines(lines):
+class TokenLines:
+    """
+    形態素解析された行 (台本1冊分) をコンパクトに保持するクラス
+
+    単語ごとに辞書を作る代わりに、表層形と品詞をそれぞれ ID に置き換えて
+    台本全体で一つの配列に詰め、行ごとの開始位置 (offsets) で区切って持つ。
+    lines[lnum]['tokenized_words'][i]['surface'] のような従来の辞書形式での
+    アクセスもできる (その都度辞書を作るので、大量に使う処理では避けること)。
+    """
+
+    def __init__(self):
+        """
+        コンストラクタ
+        """
+        self.surfaces = []          # ID -> 表層形 (str)
+        self.parts_of_speech = []   # ID -> 品詞 (str)
+        self.surface_ids = array('i')   # 単語ごとの表層形 ID
+        self.pos_ids = array('i')       # 単語ごとの品詞 ID
+        self.offsets = array('i', [0])  # 行ごとの、最初の単語の位置
+        self.indents = []               # 行ごとの、行頭の空白文字列
+        self.texts = []                 # 行ごとの、形態素解析する前の行
+
+        # 文字列から ID を引くための辞書
+        self._surface_index = {}
+        self._pos_index = {}
+
+    @classmethod
+    def from_dicts(cls, token_lines):
+        """
+        従来の辞書形式の解析結果から TokenLines を作る
+
+        Parameters
+        ----------
+        token_lines : list
+            {'indent_chars', 'tokenized_words'} の辞書のリスト
+        """
+        tl = cls()
+        for line in token_lines:
+            tl.append(line['indent_chars'],
+                [(w['surface'], w['part_of_speech']) for w in line['tokenized_words']])
+        return tl
+
+    def append(self, indent_chars, words, text=None):
+        """
+        1行分の解析結果を追加する
+
+        Parameters
+        ----------
+        indent_chars : str
+            行頭の空白文字列
+        words : iterable
+            (表層形, 品詞) のタプル
+        text : str
+            形態素解析する前の行。省略すると、行頭の空白文字列と単語の表層形を
+            つなげて作る (Janome が捨てる行末の空白文字は含まれない)。
+        """
+        start = len(self.surface_ids)
+        for surface, part_of_speech in words:
+            self.surface_ids.append(self._intern(surface, self.surfaces, self._surface_index))
+            self.pos_ids.append(self._intern(part_of_speech, self.parts_of_speech, self._pos_index))
+        self.offsets.append(len(self.surface_ids))
+        self.indents.append(indent_chars)
+        if text is None:
+            text = indent_chars + ''.join(self.surfaces[i] for i in self.surface_ids[start:])
+        self.texts.append(text)
+
+    def extend(self, other):
+        """
+        別の TokenLines の行を、後ろに追加する
+
+        other の ID は、このオブジェクトの ID に付け替える。
+        """
+        surface_map = [self._intern(x, self.surfaces, self._surface_index)
+            for x in other.surfaces]
+        pos_map = [self._intern(x, self.parts_of_speech, self._pos_index)
+            for x in other.parts_of_speech]
+        base = len(self.surface_ids)
+        self.surface_ids.extend(surface_map[i] for i in other.surface_ids)
+        self.pos_ids.extend(pos_map[i] for i in other.pos_ids)
+        self.offsets.extend(base + x for x in other.offsets[1:])
+        self.indents.extend(other.indents)
+        self.texts.extend(other.texts)
+
+    @staticmethod
+    def _intern(value, names, index):
+        """
+        value の ID を返す。未登録なら登録する。
+        """
+        i = index.get(value)
+        if i is None:
+            i = len(names)
+            names.append(value)
+            index[value] = i
+        return i
+
+    def __len__(self):
+        return len(self.indents)
+
+    def __iter__(self):
+        for lnum in range(len(self)):
+            yield self[lnum]
+
+    def __getitem__(self, lnum):
+        """
+        lnum 行目を従来の辞書形式で返す (互換用)
+        """
+        if lnum < 0:
+            lnum += len(self)
+        if not 0 <= lnum < len(self):
+            raise IndexError('line number out of range')
+        return {
+            'indent_chars': self.indents[lnum],
+            'tokenized_words': [
+                {'surface': self.surfaces[s], 'part_of_speech': self.parts_of_speech[p]}
+                for s, p in zip(self.line_surface_ids(lnum), self.line_pos_ids(lnum))
+            ]
+        }
+
+    def count_of_words(self, lnum):
+        """
+        lnum 行目の単語数を返す
+        """
+        return self.offsets[lnum + 1] - self.offsets[lnum]
+
+    def line_surface_ids(self, lnum):
+        """
+        lnum 行目の表層形 ID の配列を返す
+        """
+        return self.surface_ids[self.offsets[lnum]:self.offsets[lnum + 1]]
+
+    def line_pos_ids(self, lnum):
+        """
+        lnum 行目の品詞 ID の配列を返す
+        """
+        return self.pos_ids[self.offsets[lnum]:self.offsets[lnum + 1]]
+
+    def line_surfaces(self, lnum):
+        """
+        lnum 行目の表層形 (str) のリストを返す
+        """
+        return [self.surfaces[i] for i in self.line_surface_ids(lnum)]
+
+    def to_bytes(self):
+        """
+        バイト列に変換する (キャッシュ用)
+
+        先頭 4 バイトがヘッダ (JSON) の長さで、ヘッダに文字列の表、その後ろに
+        ID と offsets の配列 (32 bit 整数, リトルエンディアン) が続く。
+        """
+        header = json.dumps({
+            'surfaces': self.surfaces,
+            'parts_of_speech': self.parts_of_speech,
+            'indents': self.indents,
+            'texts': self.texts,
+            'count_of_words': len(self.surface_ids)
+        }, ensure_ascii=False).encode('utf-8')
+        body = array('i')
+        body.extend(self.surface_ids)
+        body.extend(self.pos_ids)
+        body.extend(self.offsets)
+        if sys.byteorder != 'little':
+            body.byteswap()
+        return struct.pack('<I', len(header)) + header + body.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        to_bytes() で作ったバイト列から TokenLines を作る
+        """
+        (header_len,) = struct.unpack_from('<I', data)
+        header = json.loads(bytes(data[4:4 + header_len]).decode('utf-8'))
+        body = array('i')
+        body.frombytes(data[4 + header_len:])
+        if sys.byteorder != 'little':
+            body.byteswap()
+        n = header['count_of_words']
+
+        tl = cls()
+        tl.surfaces = header['surfaces']
+        tl.parts_of_speech = header['parts_of_speech']
+        tl.indents = header['indents']
+        tl.texts = header['texts']
+        tl.surface_ids = body[:n]
+        tl.pos_ids = body[n:2 * n]
+        tl.offsets = body[2 * n:]
+        tl._surface_index = {x: i for i, x in enumerate(tl.surfaces)}
+        tl._pos_index = {x: i for i, x in enumerate(tl.parts_of_speech)}
+        return tl
+
+
+# プロセスごとに一つだけ作る Tokenizer (get_tokenizer() で作る)
+_tokenizer = None
+
+# 登場人物名のユーザー辞書 (1行に1つの名前を書いたファイル) を指定する環境変数
+USER_DIC_ENV = 'PSC_USER_DIC'
+
+# ユーザー辞書の1語分の行 (IPADIC 形式)。
+# 文脈 ID (1289) とコストは、システム辞書の「名詞,固有名詞,人名,一般」に合わせたもの。
+_USER_DIC_ENTRY = '{0},1289,1289,1000,名詞,固有名詞,人名,一般,*,*,{0},*,*\n'
+
+# 行頭の空白文字列のパターン
+_indent_pattern = re.compile(r"[\s　]+")
+
+
+def get_tokenizer():
+    """
+    プロセス内で共有する Tokenizer を返す関数
+
+    辞書の読み込みに時間がかかるので、最初に呼ばれた時に一度だけ作る。
+    システム辞書はメモリマップで読み込む (ワーカープロセス間でもメモリを共有できる)。
+    環境変数 PSC_USER_DIC に登場人物名のファイルが指定されていれば、ユーザー辞書として使う。
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        from janome.tokenizer import Tokenizer
+        with trace.span('tokenizer_init'):
+            names_file = os.environ.get(USER_DIC_ENV)
+            if names_file:
+                _tokenizer = _make_user_dic_tokenizer(Tokenizer, read_user_dic(names_file))
+            else:
+                _tokenizer = Tokenizer(mmap=True)
+    return _tokenizer
+
+
+def _make_user_dic_tokenizer(tokenizer_class, names):
+    """
+    登場人物名をユーザー辞書に登録した Tokenizer を作る関数
+
+    Janome はユーザー辞書をファイルから読み込むので、IPADIC 形式の一時ファイルに書き出す。
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8',
+            delete=False) as f:
+        f.writelines(_USER_DIC_ENTRY.format(name) for name in names)
+    try:
+        return tokenizer_class(f.name, udic_enc='utf8', mmap=True)
+    finally:
+        os.remove(f.name)
+
+
+def read_user_dic(names_file):
+    """
+    登場人物名のファイルを読み込んで、名前のリストを返す関数
+
+    1行に1つの名前を書く。空行と # で始まる行は無視する。
+    """
+    names = []
+    with open(names_file, 'r', encoding='utf_8_sig') as f:
+        for line in f:
+            name = line.strip()
+            # IPADIC 形式の区切り文字を含む名前は登録できない。
+            if name and not name.startswith('#') and ',' not in name:
+                names.append(name)
+    return names
+
+
+def set_user_dic(names_file):
+    """
+    登場人物名のユーザー辞書を設定する関数
+
+    環境変数 PSC_USER_DIC に設定するので、後から作る子プロセスにも引き継がれる。
+    None を渡すと解除する。次に get_tokenizer() を呼んだ時に Tokenizer を作り直す。
+    """
+    global _tokenizer
+    if names_file:
+        os.environ[USER_DIC_ENV] = os.path.abspath(names_file)
+    else:
+        os.environ.pop(USER_DIC_ENV, None)
+    _tokenizer = None
+
+
+def get_indent(line):
+    """
+    行頭の空白文字列を返す関数 (なければ空文字列)
+    """
+    matched = _indent_pattern.match(line)
+    if matched:
+        return matched.group()
+    return ""
+
+
+def tokenize_lines(lines, tokenizer=None, cache=None, pool=None):
     """
     複数の行を形態素解析する関数
 
@@ -94,47 +368,52 @@ def tokenize_lines(lines):
     ----------
     lines : list
         行 (str) のリスト
+    tokenizer : janome.tokenizer.Tokenizer
+        使う Tokenizer。省略すると get_tokenizer() のものを使う。
+    cache : psclib.cache.TokenCache
+        解析結果のキャッシュ。キャッシュにあれば形態素解析をしない。
+    pool : psclib.tokenpool.TokenizerPool
+        形態素解析を並列に行うプール。渡すと (tokenizer を渡さなければ) プールで解析する。
     
     Returns
     -------
-    token_lines : list
-        解析結果（dict）のリスト
-    """
-    t = Tokenizer()
-    # token_lines は、行ごとの解析結果（辞書型）を要素とするリストになる。
-    token_lines = []
-    # 正規表現マッチングに使うパターン
-    space_pattern = re.compile(r"[\s　]+")
-    
+    token_lines : TokenLines
+        解析結果
+    """
+    if cache is not None:
+        with trace.span('token_cache_load', lines=len(lines)):
+            token_lines = cache.load(lines)
+        if token_lines is not None:
+            return token_lines
+
+    with trace.span('tokenize', lines=len(lines)):
+        if pool is not None and tokenizer is None:
+            token_lines = pool.tokenize(lines)
+        else:
+            token_lines = _tokenize(lines, tokenizer)
+
+    if cache is not None:
+        cache.store(lines, token_lines)
+    return token_lines
+
+
+def _tokenize(lines, tokenizer=None):
+    """
+    複数の行を形態素解析して、TokenLines を返す関数 (tokenize_lines() の本体)
+    """
+    t = tokenizer if tokenizer is not None else get_tokenizer()
+    token_lines = TokenLines()
+
     for data in lines:
         # 行頭の空白文字列を、形態素解析とは別に取っておく。
         # Space characters in indent
-        matched = re.match(space_pattern, data)
-        if matched:
-            indent_chars = matched.group()
-        else:
-            indent_chars = ""
+        indent_chars = get_indent(data)
 
-        # この行の単語リストを作る。
+        # 行頭の空白文字列と、解析した単語 (表層形と品詞) を追加する。
         # List words in the line
-        tokenized_words = []
-        for token in t.tokenize(data):
-            token_info = {
-                'surface': token.surface,
-                'part_of_speech': token.part_of_speech,
-                'infl_type': token.infl_type,
-                'infl_form': token.infl_form,
-                'base_form': token.base_form,
-                'reading': token.reading,
-                'phonetic': token.phonetic
-            }
-            tokenized_words.append(token_info)
-
-        # 行頭の空白文字列と、解析した単語のリストを、辞書型にしてリストに追加する。
-        token_lines.append({
-            'indent_chars': indent_chars,
-            'tokenized_words': tokenized_words
-        })
+        token_lines.append(indent_chars,
+            ((token.surface, token.part_of_speech) for token in t.tokenize(data)), data)
+
     return token_lines
 
 
@@ -168,16 +447,21 @@ def read_feature_elements(fts_file):
         if len(ftel) < 2:
             ftel.append('1')
         # 定義された特徴名なら、リストに追加。
-        if ftel[0] in features:
-            ftin.append(ftel)
-        elif ftel[0]:
-            print('Warning: Feature \'' + ftel[0] + '\' not defined.')
+        # 前後の行の特徴量の範囲 (特徴名@-2:+2 など) は、オフセットごとの特徴名にする。
+        try:
+            ftnames = _expand_feature_name(ftel[0])
+        except ValueError:
+            if ftel[0]:
+                print('Warning: Feature \'' + ftel[0] + '\' not defined.')
+            continue
+        for ftname in ftnames:
+            ftin.append([ftname] + ftel[1:])
     
     # 特徴量の名前のリスト
     ftnames = [ftel[0] for ftel in ftin]
 
     # Check duplicates.
-    for ft in features:
+    for ft in sorted(set(ftnames), key=ftnames.index):
         if ftnames.count(ft) > 1:
             print('Warning: \'' + ft + '\' is duplicated in feature elements.')
 
@@ -196,7 +480,363 @@ def read_feature_elements(fts_file):
     return ftels
 
 
-def make_dataset(model_name, list_type='train'):
+def positive_int(value):
+    """
+    1 以上の整数だけを受け付ける、argparse の type
+    """
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be 1 or more: {}'.format(value))
+    return n
+
+
+def write_atomic(dest_path, write):
+    """
+    一時ファイルに書き込んでから置き換えることで、途中までしか書かれていない
+    ファイルが残らないようにする関数
+
+    Parameters
+    ----------
+    dest_path : str
+        保存先のパス
+    write : function
+        一時ファイルのパスを受け取って書き込む関数
+    """
+    tmp_path = '{}.{}.tmp'.format(dest_path, os.getpid())
+    try:
+        with trace.span('write', path=dest_path):
+            write(tmp_path)
+            os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_array(dest_path, a):
+    """
+    ndarray を .npy 形式で (atomic に) 保存する関数
+    """
+    def write(path):
+        with open(path, 'wb') as f:
+            np.save(f, a)
+
+    write_atomic(dest_path, write)
+
+
+def save_concatenated(dest_path, arrays, dtype, shape):
+    """
+    配列のリストを行方向につなげたものを、.npy 形式で (atomic に) 保存する関数
+
+    保存先のファイルを np.lib.format.open_memmap で開き、配列を一つずつ書き込むので、
+    つなげた配列をメモリ上に作らない。
+
+    Parameters
+    ----------
+    dest_path : str
+        保存先のパス
+    arrays : list
+        配列のリスト
+    dtype : numpy.dtype
+        保存する配列の型
+    shape : tuple
+        つなげた配列の形
+    """
+    def write(path):
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        start = 0
+        for a in arrays:
+            out[start:start + len(a)] = a
+            start += len(a)
+        out.flush()
+        # 置き換える前にメモリマップを閉じる。
+        del out
+
+    write_atomic(dest_path, write)
+
+
+def write_feature_store(dest_dir, names, ft_arrays, lbl_arrays):
+    """
+    学習用 (または評価用) データ全体を、バイナリの特徴量ストアとして保存する関数
+
+    以下の3ファイルを dest_dir に作る。
+    - store_ft.npy : 全台本の特徴量を行方向につなげた float32 の行列
+    - store_lbl.npy : 全台本の教師ラベル (classes のインデックス) の int32 の配列
+    - store_index.txt : 台本ごとの "ファイル名 開始行 終了行" (終了行は含まない)
+
+    Parameters
+    ----------
+    dest_dir : str
+        保存先ディレクトリ
+    names : list
+        ファイル名 (拡張子なし) のリスト
+    ft_arrays : list
+        台本ごとの特徴量の行列のリスト。np.load(mmap_mode='r') で開いたものでもよい。
+    lbl_arrays : list
+        台本ごとの教師ラベルの配列のリスト
+
+    全台本をつなげた行列はメモリ上に作らず、保存先のファイルをメモリマップで開いて
+    台本ごとに書き込むので、データ全体がメモリに収まらなくても作れる。
+    """
+    n_rows = sum(len(ft) for ft in ft_arrays)
+    n_cols = ft_arrays[0].shape[1] if ft_arrays else 0
+
+    index = []
+    start = 0
+    for name, ft in zip(names, ft_arrays):
+        index.append("{} {} {}\n".format(name, start, start + len(ft)))
+        start += len(ft)
+
+    # インデックスを最後に書くことで、途中で止まった時に古いインデックスと
+    # 新しい行列が組み合わさらないようにする。
+    index_path = os.path.join(dest_dir, 'store_index.txt')
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    save_concatenated(os.path.join(dest_dir, 'store_ft.npy'), ft_arrays, np.float32,
+        (n_rows, n_cols))
+    save_concatenated(os.path.join(dest_dir, 'store_lbl.npy'), lbl_arrays, np.int32, (n_rows,))
+
+    def write_index(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(index)
+
+    write_atomic(index_path, write_index)
+
+
+def load_feature_store(dest_dir, mmap_mode='r'):
+    """
+    write_feature_store() で保存した特徴量ストアを読み込む関数
+
+    Parameters
+    ----------
+    dest_dir : str
+        保存先ディレクトリ
+    mmap_mode : str
+        np.load() の mmap_mode。'r' ならコピーせずにメモリマップで開く。
+
+    Returns
+    -------
+    features : numpy.ndarray
+        (全行数 x 特徴量の数) の float32 の行列
+    labels : numpy.ndarray
+        全行分の教師ラベルの int32 の配列
+    index : list
+        台本ごとの (ファイル名, 開始行, 終了行) のタプルのリスト
+        ストアがなければ None
+    """
+    index_path = os.path.join(dest_dir, 'store_index.txt')
+    if not os.path.isfile(index_path):
+        return None, None, None
+
+    index = []
+    with open(index_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            name, start, end = line.split()
+            index.append((name, int(start), int(end)))
+
+    with trace.span('read', path=dest_dir):
+        features = np.load(os.path.join(dest_dir, 'store_ft.npy'), mmap_mode=mmap_mode)
+        labels = np.load(os.path.join(dest_dir, 'store_lbl.npy'), mmap_mode=mmap_mode)
+    return features, labels, index
+
+
+class ArrayDataset:
+    """
+    特徴量データの行列と教師ラベルの配列による、TupleDataset 形式のデータセット
+
+    dataset[i] は (特徴量データ, 教師ラベル) のタプルを返すので、Chainer の
+    イテレータなどでもそのまま使える。features と labels を直接スライスすれば、
+    例ごとの Python の処理なしにミニバッチを作れる。
+    """
+
+    def __init__(self, features, labels):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        features : numpy.ndarray
+            (データ数 x 特徴量の数) の float32 の行列
+        labels : numpy.ndarray
+            データ数分の int32 の配列
+        """
+        if len(features) != len(labels):
+            raise ValueError("features and labels must have the same length.")
+        self.features = features
+        self.labels = labels
+
+    @classmethod
+    def from_pairs(cls, dataset, n_features=None):
+        """
+        (特徴量データ, 教師ラベル) のタプルのリストから作る
+
+        n_features を省略すると、特徴量の数は最初のデータの長さにする
+        (データがなければ 0)。データがなくても、特徴量データは2次元の行列になる。
+        """
+        if n_features is None:
+            n_features = len(dataset[0][0]) if len(dataset) else 0
+        features = np.asarray([x for x, _ in dataset], dtype=np.float32)
+        labels = np.asarray([t for _, t in dataset], dtype=np.int32)
+        return cls(features.reshape(len(dataset), n_features), labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(self.features[index], self.labels[index]))
+        return self.features[index], self.labels[index]
+
+    def take(self, indices):
+        """
+        indices の順に並べた、新しい ArrayDataset を返すメソッド
+        """
+        return ArrayDataset(self.features[indices], self.labels[indices])
+
+
+class ShardDataset:
+    """
+    台本ごとの特徴量ファイル (シャード) をディスクに置いたまま、ミニバッチを読み出すデータセット
+
+    全体をメモリに読み込まず、シャードを順に読み込んでミニバッチにする。
+    シャッフルする場合は、エポックごとにシャードの順番を並べ替えた上で、
+    buffer_size 行たまるごとにバッファ内の行をシャッフルしてミニバッチにする。
+    """
+
+    def __init__(self, shards, buffer_size=100000, rows=None):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        shards : list
+            (特徴量ファイル (.npy), 教師ラベルファイル) のタプルのリスト
+        buffer_size : int
+            シャッフルする時に、まとめてシャッフルする行数
+        rows : list
+            シャードごとの、使う行の番号の配列 (None ならすべての行) のリスト。
+            省略するとすべてのシャードのすべての行を使う。
+        """
+        self.shards = list(shards)
+        self.buffer_size = buffer_size
+        self.rows = list(rows) if rows is not None else [None] * len(self.shards)
+        # 行数は .npy のヘッダだけ読んで数える
+        self.lengths = [
+            len(r) if r is not None else np.load(ft_path, mmap_mode='r').shape[0]
+            for (ft_path, _), r in zip(self.shards, self.rows)]
+
+    def __len__(self):
+        return sum(self.lengths)
+
+    def load_shard(self, i):
+        """
+        i 番目のシャードを読み込んで、(特徴量の行列, 教師ラベルの配列) を返すメソッド
+        """
+        ft_path, lbl_path = self.shards[i]
+        with trace.span('read', path=ft_path):
+            features = np.load(ft_path).astype(np.float32, copy=False)
+            with open(lbl_path, 'r', encoding='utf_8_sig') as f:
+                labels = np.array([classes.index(line.strip()) for line in f], dtype=np.int32)
+        if len(features) != len(labels):
+            raise ValueError("{} has {} lines but {} has {} labels.".format(
+                ft_path, len(features), lbl_path, len(labels)))
+        if self.rows[i] is not None:
+            features = features[self.rows[i]]
+            labels = labels[self.rows[i]]
+        return features, labels
+
+    def split(self, first_size, seed=None):
+        """
+        シャード単位でランダムに二つに分けるメソッド
+
+        シャードをランダムに並べ、行数の合計が first_size に達するまでを前半とする
+        (シャードが二つ以上あれば、後半にも少なくとも一つ残す)。
+        シャードが一つしかなければ、そのシャードの行をランダムに first_size 行と
+        残りに分ける。
+
+        Returns
+        -------
+        first, second : ShardDataset
+            分けたデータセット
+        """
+        rng = np.random.RandomState(seed)
+        if len(self.shards) == 1:
+            rows = self.rows[0] if self.rows[0] is not None else np.arange(self.lengths[0])
+            perm = rng.permutation(rows)
+            # 読み出す時に、シャード内の順番を保つように並べておく。
+            first = ShardDataset(self.shards, self.buffer_size, [np.sort(perm[:first_size])])
+            second = ShardDataset(self.shards, self.buffer_size, [np.sort(perm[first_size:])])
+            return first, second
+
+        order = rng.permutation(len(self.shards))
+        count = 0
+        for k, i in enumerate(order):
+            if count >= first_size or (k > 0 and k == len(order) - 1):
+                break
+            count += self.lengths[i]
+        else:
+            k = len(order)
+        first = ShardDataset([self.shards[i] for i in order[:k]], self.buffer_size,
+            [self.rows[i] for i in order[:k]])
+        second = ShardDataset([self.shards[i] for i in order[k:]], self.buffer_size,
+            [self.rows[i] for i in order[k:]])
+        return first, second
+
+    def iter_batches(self, batch_size, shuffle=False):
+        """
+        データセットを一周する間、ミニバッチを返すジェネレータ
+
+        Yields
+        ------
+        x : numpy.ndarray
+            (バッチサイズ x 特徴ベクトルの次元数) の float32 の入力データ
+        t : numpy.ndarray
+            教師ラベルの int32 の配列
+        """
+        if shuffle:
+            order = np.random.permutation(len(self.shards))
+            fill = max(self.buffer_size, batch_size)
+        else:
+            order = range(len(self.shards))
+            fill = batch_size
+
+        xs, ts, rows = [], [], 0
+        for k, i in enumerate(order):
+            x, t = self.load_shard(i)
+            xs.append(x)
+            ts.append(t)
+            rows += len(x)
+            last = k == len(order) - 1
+            if rows < fill and not last:
+                continue
+
+            # バッファにたまった行をシャッフルして、ミニバッチに切り分ける。
+            x = np.concatenate(xs)
+            t = np.concatenate(ts)
+            if shuffle:
+                perm = np.random.permutation(len(x))
+                x = x[perm]
+                t = t[perm]
+            # 最後以外は、半端な行を次のバッファに持ち越す。
+            end = len(x) if last else len(x) // batch_size * batch_size
+            for start in range(0, end, batch_size):
+                yield x[start:min(start + batch_size, end)], t[start:min(start + batch_size, end)]
+            xs, ts = [x[end:]], [t[end:]]
+            rows = len(x) - end
+
+
+def _no_features(model_name):
+    """
+    行が一つもない特徴量データを、(0 x 特徴量の数) の2次元の行列として返す関数
+
+    特徴量の数はモデルの特徴量設定 (mdl_fts.txt) から決める (なければ 0)。
+    """
+    fts_path = "models/{}/mdl_fts.txt".format(model_name)
+    n_features = len(read_feature_elements(fts_path)) if os.path.isfile(fts_path) else 0
+    return np.empty((0, n_features), dtype=np.float32)
+
+
+def make_dataset(model_name, list_type='train', as_array=False, as_shards=False):
     """
     特徴量データと教師ラベルが対になったデータのリストを作成
 
@@ -206,11 +846,18 @@ def make_dataset(model_name, list_type='train'):
         モデル名
     list_type : str
         学習用データを作るなら 'train', 評価用データを作るなら 'eval'
+    as_array : bool
+        True なら、リストの代わりに ArrayDataset を返す
+    as_shards : bool
+        True なら、台本ごとの特徴量ファイル (.npy) をディスクに置いたまま読み出す
+        ShardDataset を返す (全体がメモリに収まらない場合に使う)
     
     Returns
     -------
-    dataset : list
+    dataset : list or ArrayDataset or ShardDataset
         (特徴量データ, 教師ラベル) というタプルを要素に持つリスト
+        特徴量ストア (store_ft.npy など) があればそれを使い、なければ台本ごとの
+        特徴量ファイル (.npy または csv) を読む。
     """
 
     # 番号リストファイルのパス
@@ -219,6 +866,7 @@ def make_dataset(model_name, list_type='train'):
     list_path = "models/{}/ds_{}_list.txt".format(model_name, list_type)
     
     # 「特徴量データ, 教師ラベル」 のファイル名リストを読み込む
+    names = []
     ft_files = []
     lbl_files = []
     with open(list_path, 'r', encoding='utf_8_sig') as f:
@@ -226,23 +874,61 @@ def make_dataset(model_name, list_type='train'):
             try:
                 num = int(line.strip())
                 fn = ("{:0>6}".format(num))
+                names.append(fn)
                 ft_files.append("models/{}/{}/{}_ft.csv".format(model_name, list_type, fn))
                 lbl_files.append("models/{}/{}/{}_lbl.txt".format(model_name, list_type, fn))
             except ValueError:
                 print('Warning: {}: Line {} is not number. Ignored.'.format(list_path, i+1))
 
-    # 特徴量データのリストを作成
+    if as_shards:
+        shards = []
+        for ft_file, lbl_file in zip(ft_files, lbl_files):
+            npy_file = ft_file[:-len('.csv')] + '.npy'
+            if not os.path.isfile(npy_file) or not os.path.isfile(lbl_file):
+                print('Warning: {} or {} doesn\'t exist. Skipped.'.format(npy_file, lbl_file))
+                continue
+            shards.append((npy_file, lbl_file))
+        return ShardDataset(shards)
+
+    # 番号リストと同じ内容のバイナリの特徴量ストアがあれば、それをメモリマップで開く
+    features, labels, index = load_feature_store(
+        "models/{}/{}".format(model_name, list_type))
+    if index is not None and [x[0] for x in index] == names:
+        if as_array:
+            if len(features) == 0:
+                features = _no_features(model_name)
+            return ArrayDataset(features, labels)
+        return list(zip(features, labels))
+
+    # 特徴量データのリストを作成 (台本ごとの .npy があればそちらを使う)
     in_fts = []
     for ft_file in ft_files:
-        with open(ft_file, 'r', encoding='utf_8_sig') as f:
+        npy_file = ft_file[:-len('.csv')] + '.npy'
+        if os.path.isfile(npy_file):
+            with trace.span('read', path=npy_file):
+                in_fts.extend(np.load(npy_file))
+            continue
+        with trace.span('read', path=ft_file), open(ft_file, 'r', encoding='utf_8_sig') as f:
             reader = csv.reader(f, quoting=csv.QUOTE_NONNUMERIC)
             in_fts.extend([[float(v) for v in row] for row in reader])
         
     # 教師ラベル (数値に変換したもの) のリストを作成
     in_lbls = []
     for lbl_file in lbl_files:
-        with open(lbl_file, 'r', encoding='utf_8_sig') as f:
+        with trace.span('read', path=lbl_file), open(lbl_file, 'r', encoding='utf_8_sig') as f:
             in_lbls.extend([classes.index(line.strip()) for line in f])
 
+    if as_array:
+        if not in_fts:
+            in_fts = _no_features(model_name)
+        return ArrayDataset(np.asarray(in_fts, dtype=np.float32),
+            np.asarray(in_lbls, dtype=np.int32))
+
     dataset = list(zip(in_fts, in_lbls))
     return dataset
+
+
+# 定義されている特徴名 (定義は psclib/features.py)
+from psclib.features import registry as _feature_registry  # noqa: E402
+from psclib.features import expand_feature_name as _expand_feature_name  # noqa: E402
+features = tuple(_feature_registry)
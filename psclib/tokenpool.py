@@ -0,0 +1,81 @@
+"""
+形態素解析を複数のプロセスで並列に行うプール
+
+台本の行をいくつかのチャンクに分けてワーカープロセスで形態素解析し、結果を元の順に
+つなげて一つの TokenLines にする。ワーカーからは、辞書のリストを pickle する代わりに
+TokenLines.to_bytes() のバイト列 (文字列の表と 32 bit 整数の配列) で受け取る。
+
+Tokenizer (辞書の読み込みに時間がかかる) は、psc.get_tokenizer() によりワーカーごとに
+一度だけ、ワーカーの起動時に作る。
+
+例
+    with TokenizerPool(4) as pool:
+        ft_list = extract_file(in_file, fts_file, pool=pool)
+"""
+
+import math
+from multiprocessing import Pool
+
+import psclib.psc as psc
+
+
+def _init_worker():
+    """
+    ワーカープロセスの初期化 (Tokenizer の準備)
+    """
+    psc.get_tokenizer()
+
+
+def _tokenize_chunk(lines):
+    """
+    行のリストを形態素解析して、TokenLines のバイト列を返す (ワーカープロセスで実行)
+    """
+    return psc.tokenize_lines(lines).to_bytes()
+
+
+class TokenizerPool:
+    """
+    形態素解析を複数のプロセスで並列に行うプール
+    """
+
+    def __init__(self, processes, chunk_lines=500):
+        """
+        コンストラクタ
+
+        Parameters
+        ----------
+        processes : int
+            ワーカープロセスの数
+        chunk_lines : int
+            一つのワーカーに一度に渡す行数の上限
+        """
+        self.processes = processes
+        self.chunk_lines = chunk_lines
+        self.pool = Pool(processes, initializer=_init_worker)
+
+    def tokenize(self, lines):
+        """
+        複数の行を並列に形態素解析して、TokenLines を返すメソッド
+
+        行数が少なくても、すべてのワーカーに行き渡るようにチャンクに分ける。
+        """
+        size = min(self.chunk_lines, math.ceil(len(lines) / self.processes)) or 1
+        chunks = [lines[i:i + size] for i in range(0, len(lines), size)]
+        token_lines = psc.TokenLines()
+        for data in self.pool.imap(_tokenize_chunk, chunks):
+            token_lines.extend(psc.TokenLines.from_bytes(data))
+        return token_lines
+
+    def close(self):
+        """
+        ワーカープロセスを終了するメソッド
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
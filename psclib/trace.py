@@ -0,0 +1,191 @@
+"""
+処理の段階ごとの所要時間と呼び出し回数を記録する、計測用のモジュール
+
+環境変数 PSC_TRACE に保存先のファイル名を指定する (または enable() を呼ぶ) と有効になる。
+記録は1行に1つの JSON (Chrome の Trace Event Format のイベントと同じ形) で書き足していき、
+最後に名前ごとの合計 ("summary" の行) を書き足す。保存先の拡張子が .json なら、最後に
+Chrome のトレース形式 (chrome://tracing や Perfetto で開ける形) に書き換える。
+
+子プロセスにも環境変数で引き継がれ、同じファイルに書き足す (1イベントを1回の書き込みで
+追記するので、複数のプロセスから書いても行が混ざらない)。合計の計算と書き換えは、
+最初に有効にしたプロセスの終了時に行う。
+
+無効な時は、span() は何もしない共通のオブジェクトを返すだけで、記録も時間の計測もしない。
+1行ごとなど、呼び出し回数の多い所では enabled を見て、計測自体を省くこと。
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+
+
+# 保存先を指定する環境変数
+TRACE_ENV = 'PSC_TRACE'
+
+# 最初に有効にしたプロセスの ID を子プロセスに伝える環境変数
+_OWNER_ENV = 'PSC_TRACE_OWNER'
+
+# 有効か
+enabled = False
+
+_path = None
+_fd = None
+
+
+class _NullSpan:
+    """
+    無効な時に span() が返す、何もしないコンテキストマネージャ
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+    """
+    with ブロックの所要時間を記録するコンテキストマネージャ
+    """
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        emit(self.name, self.start, time.perf_counter() - self.start, self.cat, self.args)
+        return False
+
+
+def enable(path):
+    """
+    記録を有効にする関数
+
+    Parameters
+    ----------
+    path : str
+        保存先のファイル名。拡張子が .json なら、最後に Chrome のトレース形式にする。
+    """
+    global enabled, _path, _fd
+    if enabled:
+        return
+    # 子プロセスにも引き継ぐ
+    os.environ[TRACE_ENV] = path
+    if _OWNER_ENV not in os.environ:
+        os.environ[_OWNER_ENV] = str(os.getpid())
+        with open(path, 'w', encoding='utf-8'):
+            pass
+        atexit.register(finish)
+    _path = path
+    _fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    enabled = True
+
+
+def span(name, cat='psc', **args):
+    """
+    with ブロックの所要時間を記録するコンテキストマネージャを返す関数
+
+    例
+        with trace.span('tokenize', lines=len(lines)):
+            ...
+    """
+    if not enabled:
+        return _null_span
+    return _Span(name, cat, args)
+
+
+def emit(name, start, seconds, cat='psc', args=None):
+    """
+    所要時間のイベントを1つ記録する関数
+
+    Parameters
+    ----------
+    name : str
+        イベントの名前
+    start : float
+        開始時刻 (time.perf_counter() の値)
+    seconds : float
+        所要時間 (秒)
+    cat : str
+        イベントの分類
+    args : dict
+        イベントに付ける情報。'count' があれば、合計の計算で呼び出し回数として数える。
+    """
+    if not enabled:
+        return
+    event = {
+        'name': name,
+        'cat': cat,
+        'ph': 'X',
+        'ts': start * 1e6,
+        'dur': seconds * 1e6,
+        'pid': os.getpid(),
+        'tid': threading.get_ident()
+    }
+    if args:
+        event['args'] = args
+    os.write(_fd, (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+
+
+def summarize(events):
+    """
+    イベントのリストから、名前ごとの呼び出し回数と合計時間 (ミリ秒) の辞書を作る関数
+    """
+    summary = {}
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        total = summary.setdefault(event['name'], {'count': 0, 'total_ms': 0.})
+        total['count'] += event.get('args', {}).get('count', 1)
+        total['total_ms'] += event['dur'] / 1000
+    return summary
+
+
+def finish():
+    """
+    記録を終えて、名前ごとの合計を書き足す関数 (最初に有効にしたプロセスの終了時に呼ばれる)
+    """
+    global enabled, _fd
+    if not enabled:
+        return
+    enabled = False
+    os.close(_fd)
+    _fd = None
+    if os.environ.get(_OWNER_ENV) != str(os.getpid()):
+        return
+
+    with open(_path, 'r', encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    summary = summarize(events)
+
+    tmp_path = '{}.{}.tmp'.format(_path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if _path.endswith('.json'):
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms',
+                'otherData': {'summary': summary}
+            }, f, ensure_ascii=False)
+        else:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+            for name, total in summary.items():
+                f.write(json.dumps(dict(summary=name, **total), ensure_ascii=False) + '\n')
+    os.replace(tmp_path, _path)
+    del os.environ[_OWNER_ENV]
+
+
+# 環境変数で指定されていれば有効にする
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# テストはリポジトリのルートにあるパッケージ (psclib) とスクリプトを読み込む。
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psclib.psc as psc  # noqa: E402
+
+
+def read_script(fn):
+    """
+    dataset フォルダの台本を行のリストとして読み込む
+    """
+    with open(os.path.join(ROOT, 'dataset', fn + '.txt'), 'r', encoding='utf_8_sig') as f:
+        return [l.rstrip() for l in f]
+
+
+@pytest.fixture(scope='session')
+def script_lines():
+    """
+    テストに使う台本 (dataset/000002.txt) の行のリスト
+    """
+    return read_script('000002')
+
+
+@pytest.fixture(scope='session')
+def token_lines(script_lines):
+    """
+    script_lines を形態素解析した TokenLines
+    """
+    return psc.tokenize_lines(script_lines)
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import psclib.psc as psc
+from psclib.predict import load_model
+from conftest import ROOT
+
+FTELS = [('ln_count_of_words', 1.), ('ln_length_of_indent', 1.)]
+
+
+def save_weights(path, in_dim, hid_dim=4):
+    rng = np.random.RandomState(0)
+    np.savez(path, l1_W=rng.rand(hid_dim, in_dim), l1_b=rng.rand(hid_dim),
+        l2_W=rng.rand(hid_dim, hid_dim), l2_b=rng.rand(hid_dim),
+        l3_W=rng.rand(len(psc.classes), hid_dim), l3_b=rng.rand(len(psc.classes)))
+
+
+def test_load_model_without_manifest_checks_in_dim(tmp_path):
+    path = str(tmp_path / 'mdl.npz')
+    save_weights(path, len(FTELS))
+    model, gpu_id = load_model(path, 0, ftels=FTELS)
+    assert gpu_id == -1
+    with pytest.raises(ValueError):
+        load_model(path, ftels=FTELS[:1])
+
+
+def test_save_model_checks_features(tmp_path):
+    pytest.importorskip('chainer')
+    from psclib.chain import PscChain
+    from psclib.artifact import save_model, load_manifest
+
+    model = PscChain(4, len(psc.classes))
+    model(np.zeros((1, len(FTELS)), dtype=np.float32))
+    path = str(tmp_path / 'mdl.npz')
+    with pytest.raises(ValueError):
+        save_model(path, model, FTELS[:1])
+    assert not os.path.exists(path)
+
+    save_model(path, model, FTELS)
+    assert load_manifest(path)['in_dim'] == len(FTELS)
+    load_model(path, ftels=FTELS)
+    with pytest.raises(ValueError):
+        load_model(path, ftels=FTELS[::-1])
+
+
+def test_train_rejects_stale_training_data(tmp_path):
+    pytest.importorskip('chainer')
+    # 台本1冊分の学習用データを作ってから、特徴量設定を変える。
+    os.symlink(os.path.join(ROOT, 'dataset'), str(tmp_path / 'dataset'))
+    model_dir = tmp_path / 'models' / 'm'
+    (model_dir / 'train').mkdir(parents=True)
+    (model_dir / 'ds_train_list.txt').write_text('2\n', encoding='utf-8')
+    (model_dir / 'mdl_fts.txt').write_text('ln_count_of_words\n', encoding='utf-8')
+    run = lambda script: subprocess.run([sys.executable, os.path.join(ROOT, script), 'm'],
+        cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert run('psc_maketrain.py').returncode == 0
+    (model_dir / 'mdl_fts.txt').write_text('ln_count_of_words\nln_length_of_indent\n',
+        encoding='utf-8')
+    result = run('psc_train.py')
+    assert result.returncode == 1
+    assert b'different feature setting' in result.stdout
+    assert not (model_dir / 'mdl.npz').exists()
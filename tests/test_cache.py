@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+
+import psclib.psc as psc
+from psclib import cache
+from psclib.cache import TokenCache, FeatureCache, script_key
+from psclib.extract import extract_file
+from conftest import ROOT
+
+
+def test_token_cache_round_trip(tmp_path, script_lines, token_lines):
+    tc = TokenCache(str(tmp_path))
+    assert tc.load(script_lines) is None
+    tc.store(script_lines, token_lines)
+    loaded = tc.load(script_lines)
+    assert loaded.to_bytes() == token_lines.to_bytes()
+    # 台本が変われば、キャッシュは使われない。
+    assert tc.load(script_lines[:-1]) is None
+
+
+def test_token_cache_invalidated_by_janome_version(tmp_path, monkeypatch, script_lines,
+        token_lines):
+    tc = TokenCache(str(tmp_path))
+    tc.store(script_lines, token_lines)
+    monkeypatch.setattr(cache, 'janome_version', lambda: 'other')
+    assert tc.load(script_lines) is None
+
+
+def test_token_cache_evicts_oldest(tmp_path, script_lines, token_lines):
+    size = len(token_lines.to_bytes())
+    tc = TokenCache(str(tmp_path), max_bytes=size * 2)
+    scripts = [script_lines[i:] for i in range(3)]
+    for t, lines in enumerate(scripts):
+        tc.store(lines, psc.tokenize_lines(lines))
+        # 使われた時刻の順を、ファイルシステムの時刻の精度によらず決めておく。
+        os.utime(tc.path(script_key(lines)), (1000 + t, 1000 + t))
+    assert tc.load(scripts[0]) is None
+    assert tc.load(scripts[2]) is not None
+
+
+def test_script_key_depends_on_content():
+    assert script_key(['a', 'b']) == script_key(['a', 'b'])
+    assert script_key(['a', 'b']) != script_key(['ab'])
+
+
+FTELS = [('ln_count_of_words', 1.), ('ln_first_comma_pos', 1.), ('ln_length_of_indent', 1.)]
+
+
+def test_feature_cache_round_trip_is_exact(tmp_path):
+    fc = FeatureCache(str(tmp_path))
+    assert fc.load_column('k', 'f') is None
+    column = np.array([0.1, np.exp(-3 / 4), 1 / 3])
+    fc.store_column('k', 'f', column)
+    loaded = fc.load_column('k', 'f')
+    assert loaded.dtype == column.dtype
+    assert (loaded == column).all()
+
+
+def test_feature_cache_ignores_broken_file(tmp_path):
+    fc = FeatureCache(str(tmp_path))
+    fc.store_column('k', 'f', np.arange(3))
+    with open(fc.path('k', 'f'), 'wb') as f:
+        f.write(b'broken')
+    assert fc.load_column('k', 'f') is None
+
+
+def test_feature_cache_evicts_oldest(tmp_path):
+    column = np.arange(100, dtype=np.float64)
+    fc = FeatureCache(str(tmp_path), max_bytes=2 ** 20)
+    keys = ['a', 'b', 'c']
+    for t, key in enumerate(keys):
+        fc.store_column(key, 'f1', column)
+        fc.store_column(key, 'f2', column)
+        # 使われた時刻の順を、ファイルシステムの時刻の精度によらず決めておく。
+        os.utime(os.path.join(fc.cache_dir, key), (1000 + t, 1000 + t))
+    fc.evict()
+    assert all(fc.load_column(key, 'f1') is not None for key in keys)
+
+    # 上限を台本2冊分にすると、最後に使われたのが一番古い台本が消える。
+    for t, key in enumerate(keys):
+        os.utime(os.path.join(fc.cache_dir, key), (1000 + t, 1000 + t))
+    size = os.path.getsize(fc.path('a', 'f1')) * 2
+    fc.max_bytes = size * 2
+    fc.evict()
+    assert fc.load_column('a', 'f1') is None
+    assert fc.load_column('b', 'f2') is not None and fc.load_column('c', 'f1') is not None
+
+
+def test_extract_file_with_feature_cache(tmp_path):
+    in_file = os.path.join(ROOT, 'dataset', '000002.txt')
+    fc = FeatureCache(str(tmp_path))
+    expected = extract_file(in_file, ftels=FTELS)
+    # 1回目は抽出してキャッシュに保存し、2回目はキャッシュから読み込む。
+    assert extract_file(in_file, ftels=FTELS[:2], ft_cache=fc) == [row[:2] for row in expected]
+    assert extract_file(in_file, ftels=FTELS, ft_cache=fc) == expected
+    assert extract_file(in_file, ftels=FTELS, ft_cache=fc) == expected
+    # 行列で受け取っても、キャッシュなしの行列と同じ値になる。
+    ft_array = extract_file(in_file, ftels=FTELS, ft_cache=fc, as_array=True)
+    assert ft_array.dtype == np.float32
+    assert (ft_array == extract_file(in_file, ftels=FTELS, as_array=True)).all()
+
+
+def test_script_key_depends_on_user_dic(tmp_path, monkeypatch, script_lines, token_lines):
+    tc = TokenCache(str(tmp_path / 'tokens'))
+    tc.store(script_lines, token_lines)
+    key = script_key(script_lines)
+
+    names_file = tmp_path / 'names.txt'
+    names_file.write_text('ほげ\n', encoding='utf-8')
+    monkeypatch.setenv(psc.USER_DIC_ENV, str(names_file))
+    udic_key = script_key(script_lines)
+    assert udic_key != key
+    assert tc.load(script_lines) is None
+
+    # 名前を変えれば、キーも変わる (更新時刻が同じでもサイズで気付く)。
+    names_file.write_text('ほげ\nふが\n', encoding='utf-8')
+    assert script_key(script_lines) not in (key, udic_key)
+
+    monkeypatch.delenv(psc.USER_DIC_ENV)
+    assert script_key(script_lines) == key
+
+
+def test_maketrain_stamp_depends_on_user_dic(tmp_path, monkeypatch):
+    import psc_maketrain
+    monkeypatch.setattr(psc_maketrain, '_ftels', FTELS)
+    in_file = os.path.join(ROOT, 'dataset', '000002.txt')
+    stamp = psc_maketrain.make_stamp(in_file, in_file)
+    assert psc_maketrain.make_stamp(in_file, in_file) == stamp
+
+    names_file = tmp_path / 'names.txt'
+    names_file.write_text('ほげ\n', encoding='utf-8')
+    monkeypatch.setenv(psc.USER_DIC_ENV, str(names_file))
+    assert psc_maketrain.make_stamp(in_file, in_file) != stamp
+
+
+def test_maketrain_init_worker_resets_token_cache(tmp_path, monkeypatch):
+    import psc_maketrain
+    for name in ('_ftels', '_cache', '_ft_cache', '_force', '_write_csv'):
+        monkeypatch.setattr(psc_maketrain, name, getattr(psc_maketrain, name))
+    fts_path = str(tmp_path / 'mdl_fts.txt')
+    with open(fts_path, 'w', encoding='utf-8') as f:
+        f.write('ln_is_empty\n')
+    psc_maketrain.init_worker(fts_path, str(tmp_path / 'ft'), cache_dir=str(tmp_path / 'tk'),
+        cache_size=1)
+    assert isinstance(psc_maketrain._cache, TokenCache)
+    psc_maketrain.init_worker(fts_path, str(tmp_path / 'ft'))
+    assert psc_maketrain._cache is None
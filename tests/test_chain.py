@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+chainer = pytest.importorskip('chainer')
+
+import psclib.psc as psc  # noqa: E402
+from psclib import chain  # noqa: E402
+from psclib.chain import PscChain  # noqa: E402
+from conftest import ROOT  # noqa: E402
+
+
+def make_dataset(n=200, n_cols=4):
+    rng = np.random.RandomState(0)
+    x = rng.rand(n, n_cols).astype(np.float32)
+    t = (x[:, 0] * len(psc.classes)).astype(np.int32)
+    return psc.ArrayDataset(x, t)
+
+
+def train(model, losses=None, **kwargs):
+    """
+    検証ロスを losses の順に返すようにして学習し、(history, 検証ごとのパラメータ) を返す
+    """
+    snapshots = []
+    if losses is not None:
+        losses = iter(losses)
+
+        def validate(dataset, batch_size=100, gpu_id=-1, n_prefetch=0):
+            snapshots.append(model.l1.W.array.copy())
+            return next(losses), 0.
+
+        model.validate = validate
+    optimizer = chainer.optimizers.SGD(lr=0.01).setup(model)
+    history = model.train(dataset=make_dataset(), batch_size=50, optimizer=optimizer,
+        verbose=False, **kwargs)
+    return history, snapshots
+
+
+def test_early_stopping_restores_best_parameters():
+    np.random.seed(0)
+    model = PscChain(5, len(psc.classes))
+    history, snapshots = train(model, [1., 0.5, 0.7, 0.8, 0.9], max_epoch=5, patience=2)
+    assert [h['epoch'] for h in history] == [1, 2, 3, 4]
+    assert (model.l1.W.array == snapshots[1]).all()
+
+
+def test_nan_loss_is_not_used_for_early_stopping(capsys):
+    np.random.seed(0)
+    model = PscChain(5, len(psc.classes))
+    history, snapshots = train(model, [float('nan')] * 3 + [1.], max_epoch=4, patience=1)
+    assert len(history) == 4
+    assert (model.l1.W.array == snapshots[3]).all()
+    assert 'Warning: val_loss is nan' in capsys.readouterr().out
+
+
+def test_no_validation_data_disables_early_stopping(monkeypatch, capsys):
+    monkeypatch.setattr(chain, 'split_dataset',
+        lambda dataset, first_size, seed=None: (dataset, dataset.take(np.arange(0))))
+    np.random.seed(0)
+    model = PscChain(5, len(psc.classes))
+    optimizer = chainer.optimizers.SGD(lr=0.01).setup(model)
+    history = model.train(dataset=make_dataset(), batch_size=50, max_epoch=3,
+        optimizer=optimizer, verbose=False, patience=1)
+    assert len(history) == 3
+    assert 'Warning: No validation data' in capsys.readouterr().out
+
+
+def test_valid_every_must_be_positive():
+    model = PscChain(5, len(psc.classes))
+    with pytest.raises(ValueError):
+        train(model, max_epoch=1, valid_every=0)
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'psc_train.py'), 'mdl000',
+        '--valid-every', '0'], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 2
+    assert b'must be 1 or more' in result.stderr
+
+
+@pytest.mark.parametrize('script', ['psc_train.py', 'psc_sweep.py'])
+@pytest.mark.parametrize('value', ['0', '-1'])
+def test_patience_must_be_positive(script, value):
+    result = subprocess.run([sys.executable, os.path.join(ROOT, script), 'mdl000',
+        '--patience', value], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 2
+    assert b'must be 1 or more' in result.stderr
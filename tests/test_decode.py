@@ -0,0 +1,130 @@
+import itertools
+import os
+import time
+
+import numpy as np
+import pytest
+
+import psclib.psc as psc
+from psclib.decode import Constraints, viterbi, log_softmax
+from conftest import ROOT
+
+N = len(psc.classes)
+ALL_LABELS = np.array(list(itertools.product(range(N), repeat=4)))
+
+
+def brute_force(logits, constraints):
+    """
+    制約を満たすラベルの並びのうち、対数確率の和が最大のものを総当たりで求める
+    """
+    logp = log_softmax(logits)
+    scores = logp[np.arange(len(logits)), ALL_LABELS].sum(axis=1)
+    for i in np.argsort(-scores, kind='stable'):
+        if constraints.is_valid(ALL_LABELS[i]):
+            return scores[i]
+    return None
+
+
+def score_of(logits, labels):
+    return log_softmax(logits)[np.arange(len(labels)), labels].sum()
+
+
+def dense_viterbi_score(logits, constraints):
+    """
+    状態の全組み合わせを足して最大値を取る、素朴な動的計画法で最大の対数確率の和を求める
+    """
+    trans, start, state_labels = constraints.expand()
+    emit = log_softmax(logits)[:, state_labels]
+    score = np.where(start, emit[0], -np.inf)
+    for t in range(1, len(emit)):
+        score = np.where(trans, score[:, None], -np.inf).max(axis=0) + emit[t]
+    return score.max()
+
+
+def custom_constraints():
+    c = Constraints.default()
+    c.never_after('H1', 'TITLE')
+    c.forbid('EMPTY', 'EMPTY')
+    return c
+
+
+@pytest.mark.parametrize('make_constraints', [Constraints.default, custom_constraints])
+def test_viterbi_is_optimal(make_constraints):
+    constraints = make_constraints()
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        logits = rng.randn(4, N) * 3
+        # 各行の最大値を取った並びが制約を破るようにして、動的計画法を通す。
+        logits[0, psc.classes.index('DIALOGUE_CONTINUED')] += 10
+        labels = viterbi(logits, constraints)
+        assert constraints.is_valid(labels)
+        assert score_of(logits, labels) == pytest.approx(brute_force(logits, constraints))
+
+
+@pytest.mark.parametrize('n_lines', [1, 2, 50, 1000])
+def test_viterbi_matches_dense_dp(n_lines):
+    constraints = custom_constraints()
+    rng = np.random.RandomState(n_lines)
+    logits = rng.randn(n_lines, N) * 3
+    logits[0, psc.classes.index('DIALOGUE_CONTINUED')] += 10
+    labels = viterbi(logits, constraints)
+    assert len(labels) == n_lines
+    assert constraints.is_valid(labels)
+    assert score_of(logits, labels) == pytest.approx(dense_viterbi_score(logits, constraints))
+
+
+def test_viterbi_speed():
+    # 1万行の台本でも、制約付きデコードが十分速く終わること (手元では 30 ms 程度)
+    rng = np.random.RandomState(0)
+    logits = rng.randn(10000, N) * 3
+    logits[0, psc.classes.index('DIALOGUE_CONTINUED')] += 10
+    viterbi(logits[:10])
+    start = time.perf_counter()
+    labels = viterbi(logits)
+    elapsed = time.perf_counter() - start
+    assert Constraints.default().is_valid(labels)
+    assert elapsed < 0.5
+
+
+def test_viterbi_keeps_valid_argmax():
+    logits = np.zeros((3, N))
+    logits[np.arange(3), [psc.classes.index(x) for x in ('TITLE', 'EMPTY', 'CHARACTER')]] = 1
+    assert viterbi(logits).tolist() == logits.argmax(axis=1).tolist()
+
+
+def test_is_valid():
+    c = Constraints.default()
+    idx = lambda labels: [psc.classes.index(x) for x in labels]
+    assert c.is_valid([])
+    assert c.is_valid(idx(['TITLE', 'CHARACTER', 'DIALOGUE', 'DIALOGUE_CONTINUED']))
+    assert not c.is_valid(idx(['DIALOGUE_CONTINUED']))
+    assert not c.is_valid(idx(['DIRECTION', 'DIALOGUE_CONTINUED']))
+    assert not c.is_valid(idx(['TITLE', 'EMPTY', 'TITLE']))
+    assert not c.is_valid(idx(['DIALOGUE', 'EMPTY', 'CHARACTER']))
+
+
+def test_constraints_file_matches_default():
+    loaded = Constraints.load(os.path.join(ROOT, 'docs', 'constraints.txt'))
+    default = Constraints.default()
+    assert (loaded.transitions == default.transitions).all()
+    assert (loaded.start == default.start).all()
+    assert len(loaded.after_rules) == len(default.after_rules)
+    for (t1, b1), (t2, b2) in zip(loaded.after_rules, default.after_rules):
+        assert (t1 == t2).all() and (b1 == b2).all()
+
+
+def test_constraints_file_errors(tmp_path):
+    path = tmp_path / 'constraints.txt'
+    path.write_text('forbid TITLE\n', encoding='utf-8')
+    with pytest.raises(ValueError):
+        Constraints.load(str(path))
+    path.write_text('once NO_SUCH_CLASS\n', encoding='utf-8')
+    with pytest.raises(ValueError):
+        Constraints.load(str(path))
+
+
+def test_viterbi_infeasible():
+    c = Constraints()
+    c.forbid('*', '*')
+    with pytest.raises(ValueError):
+        viterbi(np.zeros((2, N)), c)
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+import psclib.psc as psc
+from psclib import features
+from psclib.extract import Extractor, ScriptStats, shift_column, extract_file, \
+    iter_extract_file
+
+
+def naive_common_head(token_lines, lnum):
+    """
+    全行と比べて、lnum 行目の行頭 k 単語を共有する行数を k = 1, 2, ... について数える
+    """
+    words = [list(zip(token_lines.line_surfaces(i),
+        [token_lines.parts_of_speech[p] for p in token_lines.line_pos_ids(i)]))
+        for i in range(len(token_lines))]
+    count = []
+    for k in range(1, len(words[lnum]) + 1):
+        n = sum(1 for w in words if w[:k] == words[lnum][:k])
+        if n < 2:
+            break
+        count.append(n)
+    return count
+
+
+def test_common_head_matches_naive(token_lines):
+    ex = Extractor(token_lines, [('ln_length_of_common_head', 1.)])
+    for lnum in range(0, len(token_lines), 7):
+        assert ex.get_length_of_common_head(lnum) == naive_common_head(token_lines, lnum)
+
+
+def test_stats_from_chunk_use_whole_script(script_lines, token_lines):
+    # 台本の一部から作った Extractor でも、台本全体の統計を渡せば同じ値になる。
+    ftels = [('ln_length_of_common_head', 1.), ('sc_count_of_lines', 1.)]
+    whole = Extractor(token_lines, ftels).extract()
+    stats = ScriptStats.from_token_lines(token_lines)
+    part = psc.tokenize_lines(script_lines[100:200])
+    assert Extractor(part, ftels, stats).extract() == whole[100:200]
+
+
+def test_extract_array_matches_extract_for_all_features(script_lines, token_lines):
+    ftels = [(name, 1.) for name in psc.features]
+    ex = Extractor(token_lines, ftels, texts=script_lines)
+    expected = np.array(Extractor(token_lines, ftels).extract(), dtype=np.float32)
+    assert (ex.extract_array() == expected).all()
+
+
+def test_texts_keep_trailing_spaces():
+    # Janome は行末の空白文字を捨てるが、形態素解析する前の行は TokenLines に残る。
+    lines = ['　山田　こんにちは  ', 'abc\t', '   ', '', 'テスト　 ']
+    token_lines = psc.TokenLines.from_bytes(psc.tokenize_lines(lines).to_bytes())
+    assert token_lines.texts == lines
+    ftels = [(name, 1.) for name in psc.features]
+    ex = Extractor(token_lines, ftels)
+    assert ex.get_texts() == ['山田　こんにちは  ', 'abc\t', '', '', 'テスト　 ']
+    assert ex.extract() == Extractor(token_lines, ftels, texts=lines).extract()
+
+
+def test_common_head_column(script_lines, token_lines):
+    ex = Extractor(token_lines, [('ln_length_of_common_head', 1.)])
+    expected = [len(ex.get_length_of_common_head(lnum)) for lnum in range(len(token_lines))]
+    assert ex.get_common_head_column().tolist() == expected
+    # 台本の一部では、台本全体の統計で数える。
+    stats = ScriptStats.from_token_lines(token_lines)
+    part = Extractor(psc.tokenize_lines(script_lines[100:200]),
+        [('ln_length_of_common_head', 1.)], stats)
+    assert part.get_common_head_column().tolist() == expected[100:200]
+
+
+def test_shift_column():
+    shifted = shift_column(np.array([1, 2, 3]), [-1, 2], pad=9)
+    assert shifted.tolist() == [[9, 3], [1, 9], [2, 9]]
+    assert shift_column(np.array([1, 2]), [-3]).tolist() == [[0], [0]]
+
+
+CONTEXT_NAMES = ['ln_is_empty', 'ln_is_empty@-2:+2', 'ln_count_of_words@+1',
+    'ln_length_of_common_head@-1', 'ln_count_of_words']
+CONTEXT_FTELS = [(name, 1.) for x in CONTEXT_NAMES for name in features.expand_feature_name(x)]
+
+
+def test_context_features(script_lines, token_lines):
+    ex = Extractor(token_lines, CONTEXT_FTELS, texts=script_lines)
+    ft_list = ex.extract()
+    assert [ex.extract_line(lnum) for lnum in range(len(ex))] == ft_list
+    assert (ex.extract_array() == np.array(ft_list, dtype=np.float32)).all()
+
+    # 元の特徴量の値を、前後の行から取ってきたものと同じ。
+    bases = ['ln_is_empty', 'ln_count_of_words', 'ln_length_of_common_head']
+    base_list = Extractor(token_lines, [(name, 1.) for name in bases]).extract()
+    base_columns = dict(zip(bases, zip(*base_list)))
+    n = len(token_lines)
+    for j, (name, _) in enumerate(CONTEXT_FTELS):
+        f = features.get_feature(name)
+        if f.base is None:
+            expected = base_columns[name]
+        else:
+            column = base_columns[f.base.name]
+            expected = [column[lnum + f.offset] if 0 <= lnum + f.offset < n else f.pad
+                for lnum in range(n)]
+        assert [row[j] for row in ft_list] == pytest.approx(list(expected)), name
+
+
+@pytest.mark.parametrize('chunk_lines', [1, 7])
+def test_iter_extract_file_matches_whole_script(tmp_path, script_lines, chunk_lines):
+    path = str(tmp_path / 'script.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(script_lines[:60]) + '\n')
+    ftels = CONTEXT_FTELS + [('sc_count_of_lines', 1.)]
+    whole = extract_file(path, ftels=ftels, as_array=True)
+    chunks = list(iter_extract_file(path, ftels=ftels, chunk_lines=chunk_lines))
+    assert [len(lines) for lines, _ in chunks[:-1]] == [chunk_lines] * (len(chunks) - 1)
+    assert sum((lines for lines, _ in chunks), []) == script_lines[:60]
+    assert (np.concatenate([ft_array for _, ft_array in chunks]) == whole).all()
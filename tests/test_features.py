@@ -0,0 +1,68 @@
+import pytest
+
+import psclib.psc as psc
+from psclib import features
+from psclib.extract import Extractor
+
+
+def test_registry_lists_all_features():
+    assert psc.features == tuple(features.registry)
+    for name, f in features.registry.items():
+        assert f.name == name
+        assert f.doc
+        assert all(x in features.line_inputs for x in f.inputs)
+
+
+def test_undefined_feature_is_rejected(token_lines):
+    with pytest.raises(ValueError):
+        Extractor(token_lines, [('no_such_feature', 1.)])
+
+
+def test_needs_tokens():
+    assert not features.needs_tokens([('ln_length_of_indent', 1.), ('ln_is_empty', 1.)])
+    assert features.needs_tokens([('ln_length_of_indent', 1.), ('ln_count_of_words', 1.)])
+
+
+def test_read_feature_elements(tmp_path, capsys):
+    path = tmp_path / 'fts.txt'
+    path.write_text('ln_count_of_words  # comment\nno_such_feature\n\nln_length_of_indent, 2\n'
+        'ln_count_of_words\n', encoding='utf-8')
+    ftels = psc.read_feature_elements(str(path))
+    assert ftels == [('ln_count_of_words', 1.), ('ln_length_of_indent', 2.)]
+    out = capsys.readouterr().out
+    assert "'no_such_feature' not defined" in out
+    assert "'ln_count_of_words' is duplicated" in out
+
+
+def test_expand_feature_name():
+    assert features.expand_feature_name('ln_is_empty') == ['ln_is_empty']
+    assert features.expand_feature_name('ln_is_empty@1') == ['ln_is_empty@+1']
+    assert features.expand_feature_name('ln_is_empty@-2:+2') == [
+        'ln_is_empty@-2', 'ln_is_empty@-1', 'ln_is_empty@+1', 'ln_is_empty@+2']
+
+
+@pytest.mark.parametrize('name', ['no_such_feature@-1', 'ln_is_empty@0', 'ln_is_empty@x',
+    'ln_is_empty@'])
+def test_get_feature_rejects_bad_context_name(name):
+    with pytest.raises(ValueError):
+        features.get_feature(name)
+
+
+def test_get_feature_builds_context_feature():
+    f = features.get_feature('ln_is_empty@-1')
+    assert f is features.get_feature('ln_is_empty@-1')
+    assert f.base is features.registry['ln_is_empty']
+    assert f.offset == -1
+    # 台本の外の行は空行とみなす。
+    assert f.pad == 1
+    assert not f.needs_tokens
+    assert features.get_feature('ln_count_of_words@+2').needs_tokens
+
+
+def test_read_feature_elements_expands_context(tmp_path):
+    path = tmp_path / 'fts.txt'
+    path.write_text('ln_is_empty@-1:+1, 2\nln_count_of_words@1\n', encoding='utf-8')
+    ftels = psc.read_feature_elements(str(path))
+    assert [ftel[0] for ftel in ftels] == \
+        ['ln_is_empty@-1', 'ln_is_empty@+1', 'ln_count_of_words@+1']
+    assert dict(ftels)['ln_is_empty@-1'] == 2.
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import psc_predict
+from conftest import ROOT
+
+
+def test_list_scripts_skips_non_script_files():
+    dataset = os.path.join(ROOT, 'dataset')
+    scripts = psc_predict.list_scripts([dataset])
+    assert [os.path.basename(x) for x in scripts] == ['000001.txt', '000002.txt']
+
+
+def test_list_scripts_pattern(tmp_path):
+    for name in ['000001.txt', 'memo.txt', 'a.txt']:
+        (tmp_path / name).write_text('x', encoding='utf-8')
+    scripts = psc_predict.list_scripts([str(tmp_path)], '[0-9]*.txt')
+    assert [os.path.basename(x) for x in scripts] == ['000001.txt']
+
+
+def test_result_files_rejects_duplicate_names(tmp_path):
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    for d in (a, b):
+        d.mkdir()
+        (d / 'x.txt').write_text('x', encoding='utf-8')
+    scripts = psc_predict.list_scripts([str(a), str(b)])
+    with pytest.raises(ValueError):
+        psc_predict.result_files(scripts, 'out')
+    # 同じファイルを2回指定するのは構わない。
+    assert psc_predict.result_files([str(a / 'x.txt')] * 2, 'out') == \
+        [os.path.join('out', 'x_lbl.txt')] * 2
@@ -0,0 +1,42 @@
+import asyncio
+
+import numpy as np
+
+import psclib.psc as psc
+from psclib.npmodel import NumpyPscModel
+from psc_serve import PredictServer
+from conftest import read_script
+
+
+def random_model(in_dim, hid_dim=8):
+    rng = np.random.RandomState(0)
+    shapes = {'l1': (hid_dim, in_dim), 'l2': (hid_dim, hid_dim), 'l3': (len(psc.classes), hid_dim)}
+    params = {}
+    for name, shape in shapes.items():
+        params[name + '_W'] = rng.randn(*shape)
+        params[name + '_b'] = rng.randn(shape[0])
+    return NumpyPscModel(params)
+
+
+def test_every_worker_can_extract():
+    # 文字単位の特徴量だけなら、ワーカーは形態素解析をせずに、すぐに次のリクエストを受け取る。
+    ftels = [('ln_count_of_bracket_chars', 1.), ('ln_length_of_indent', 1.),
+        ('ln_is_empty', 1.)]
+    lines = read_script('000002')[:50]
+    server = PredictServer(random_model(len(ftels)), -1, ftels, workers=4)
+    loop = asyncio.new_event_loop()
+    try:
+        batcher = loop.create_task(server.batcher.run())
+
+        async def run():
+            return await asyncio.gather(*[server.predict(lines) for _ in range(64)])
+
+        results = loop.run_until_complete(run())
+        batcher.cancel()
+        loop.run_until_complete(asyncio.gather(batcher, return_exceptions=True))
+    finally:
+        server.pool.shutdown()
+        loop.close()
+    assert len(results) == 64
+    assert all(labels == results[0] for labels in results)
+    assert len(results[0]) == len(lines)
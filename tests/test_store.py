@@ -0,0 +1,121 @@
+import numpy as np
+
+import psclib.psc as psc
+
+
+def make_store(tmp_path, lengths, n_cols=3):
+    rng = np.random.RandomState(0)
+    names = ['{:0>6}'.format(i) for i in range(len(lengths))]
+    ft_arrays = [rng.rand(n, n_cols).astype(np.float32) for n in lengths]
+    lbl_arrays = [rng.randint(len(psc.classes), size=n).astype(np.int32) for n in lengths]
+    psc.write_feature_store(str(tmp_path), names, ft_arrays, lbl_arrays)
+    return names, ft_arrays, lbl_arrays
+
+
+def test_write_feature_store(tmp_path):
+    names, ft_arrays, lbl_arrays = make_store(tmp_path, [5, 0, 7])
+    features, labels, index = psc.load_feature_store(str(tmp_path))
+    assert (features == np.concatenate(ft_arrays)).all()
+    assert (labels == np.concatenate(lbl_arrays)).all()
+    assert features.dtype == np.float32 and labels.dtype == np.int32
+    assert [tuple(x) for x in index] == [(names[0], 0, 5), (names[1], 5, 5), (names[2], 5, 12)]
+
+
+def test_write_feature_store_from_memmaps(tmp_path):
+    # 台本ごとの .npy をメモリマップで開いたまま渡せる。
+    src = tmp_path / 'src'
+    src.mkdir()
+    arrays = []
+    for i, n in enumerate([4, 6]):
+        path = str(src / '{}.npy'.format(i))
+        psc.save_array(path, np.full((n, 2), i, dtype=np.float32))
+        arrays.append(np.load(path, mmap_mode='r'))
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    psc.write_feature_store(str(dest), ['a', 'b'], arrays, [np.zeros(4), np.ones(6)])
+    features, labels, _ = psc.load_feature_store(str(dest))
+    assert features.shape == (10, 2)
+    assert (features[4:] == 1).all() and labels.tolist() == [0] * 4 + [1] * 6
+
+
+def test_write_empty_feature_store(tmp_path):
+    psc.write_feature_store(str(tmp_path), [], [], [])
+    features, labels, index = psc.load_feature_store(str(tmp_path))
+    assert features.shape == (0, 0) and len(labels) == 0 and len(index) == 0
+
+
+def test_array_dataset_from_pairs():
+    pairs = [(np.array([1., 2., 3.]), 4), (np.array([5., 6., 7.]), 8)]
+    dataset = psc.ArrayDataset.from_pairs(pairs)
+    assert dataset.features.shape == (2, 3) and dataset.features.dtype == np.float32
+    assert dataset.labels.tolist() == [4, 8] and dataset.labels.dtype == np.int32
+
+
+def test_array_dataset_from_no_pairs():
+    assert psc.ArrayDataset.from_pairs([]).features.shape == (0, 0)
+    dataset = psc.ArrayDataset.from_pairs([], n_features=3)
+    assert dataset.features.shape == (0, 3) and len(dataset) == 0
+    assert dataset.take(np.arange(0)).features.shape == (0, 3)
+
+
+def test_make_dataset_without_rows(tmp_path, monkeypatch):
+    # 学習用データが1行もなくても、特徴量設定の列数の2次元の行列になる。
+    monkeypatch.chdir(tmp_path)
+    model_dir = tmp_path / 'models' / 'm'
+    (model_dir / 'train').mkdir(parents=True)
+    (model_dir / 'ds_train_list.txt').write_text('', encoding='utf-8')
+    (model_dir / 'mdl_fts.txt').write_text('ln_is_empty\nln_count_of_words\n', encoding='utf-8')
+    dataset = psc.make_dataset('m', 'train', as_array=True)
+    assert dataset.features.shape == (0, 2) and len(dataset) == 0
+
+    # 空の特徴量ストアがあっても同じ
+    psc.write_feature_store(str(model_dir / 'train'), [], [], [])
+    dataset = psc.make_dataset('m', 'train', as_array=True)
+    assert dataset.features.shape == (0, 2) and len(dataset) == 0
+
+
+def make_shards(tmp_path, lengths, n_cols=2):
+    # 特徴量の1列目に、全体の通し番号を入れておく。
+    shards = []
+    start = 0
+    for i, n in enumerate(lengths):
+        ft_path = str(tmp_path / '{}_ft.npy'.format(i))
+        lbl_path = str(tmp_path / '{}_lbl.txt'.format(i))
+        ft = np.zeros((n, n_cols), dtype=np.float32)
+        ft[:, 0] = np.arange(start, start + n)
+        psc.save_array(ft_path, ft)
+        with open(lbl_path, 'w', encoding='utf-8') as f:
+            f.writelines(psc.classes[j % len(psc.classes)] + '\n' for j in range(start, start + n))
+        shards.append((ft_path, lbl_path))
+        start += n
+    return shards
+
+
+def rows_of(dataset, shuffle=False):
+    batches = list(dataset.iter_batches(7, shuffle=shuffle))
+    if not batches:
+        return []
+    x = np.concatenate([b[0] for b in batches])
+    t = np.concatenate([b[1] for b in batches])
+    ids = x[:, 0].astype(int)
+    assert (t == ids % len(psc.classes)).all()
+    return sorted(ids.tolist())
+
+
+def test_split_single_shard_by_rows(tmp_path):
+    dataset = psc.ShardDataset(make_shards(tmp_path, [50]))
+    first, second = dataset.split(40, seed=0)
+    assert (len(first), len(second)) == (40, 10)
+    a, b = rows_of(first, shuffle=True), rows_of(second)
+    assert len(a) == 40 and len(b) == 10
+    assert sorted(a + b) == list(range(50))
+    # 分けたものをさらに分けても、元の行だけを使う。
+    c, d = second.split(6, seed=1)
+    assert sorted(rows_of(c) + rows_of(d)) == b
+
+
+def test_split_multiple_shards(tmp_path):
+    dataset = psc.ShardDataset(make_shards(tmp_path, [10, 20, 30]))
+    first, second = dataset.split(55, seed=0)
+    assert len(first) > 0 and len(second) > 0
+    assert sorted(rows_of(first) + rows_of(second)) == list(range(60))